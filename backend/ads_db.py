@@ -0,0 +1,16 @@
+"""
+Location of the ads database.
+
+Every backend module opens the database through here, so pointing the app at
+another file (bench_anomalies.py, scratch copies) is one assignment to
+ads_db.DB_FILE. DB_FILE is read on every connect, never copied at import.
+"""
+import os
+import sqlite3
+
+# Path to DB
+DB_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ads_data.sqlite')
+
+
+def get_db_connection(timeout: float = 30):
+    return sqlite3.connect(DB_FILE, timeout=timeout)
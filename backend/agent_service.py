@@ -5,7 +5,9 @@ import pandas as pd
 from typing import List, Dict, Any, TypedDict, Annotated
 import operator
 import json
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 from langchain_openai import ChatOpenAI
@@ -16,12 +18,35 @@ from langgraph.graph import StateGraph, END
 from langgraph.prebuilt import ToolNode
 
 from expert_system import ContextGuard  # ExpertEngine removed - now using pure LLM analysis
+from anomaly_engine import (
+    load_campaign_frame, load_product_frame, window_start,
+    detect_campaign_anomalies, detect_product_anomalies,
+    detect_campaign_anomalies_range, detect_product_anomalies_range,
+    iter_product_anomaly_shards, risk_status_label,
+)
+from anomaly_parallel import detect_product_anomalies_sharded
+import anomaly_store
+import anomaly_state
+import anomaly_ewma
+import anomaly_backtest
+from anomaly_rootcause import explain_campaign_changes, DIMENSIONS as ROOT_CAUSE_DIMENSIONS
+from data_version import get_data_versions, bump_data_version, init_data_versions
+from result_cache import ResultCache
+from pagination import page_sorted, encode_cursor, decode_cursor
+import table_query
+import schema_catalog
+import kpi_summary
+import data_events
+import change_log
+import columnar
+import arrow_stream
+from db_pool import ConnectionPool
+import ads_db
+from constants import CAMPAIGN_DETAIL_TABLES
 
 # Load env vars
 load_dotenv()
 
-# Path to DB
-DB_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ads_data.sqlite')
 
 # Configuration
 MAIN_MODEL_NAME = os.getenv("MAIN_MODEL_NAME")
@@ -29,6 +54,10 @@ SUB_MODEL_NAME = os.getenv("SUB_MAIN_MODEL_NAM")
 BASE_URL = os.getenv("BASE_URL")
 API_KEY = os.getenv("API_KEY")
 MAX_CONTEXT_CHARACTERS = int(os.getenv("MAX_CONTEXT_CHARACTERS", 30000))
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", 256))
+RESULT_CACHE_MAX_MB = int(os.getenv("RESULT_CACHE_MAX_MB", 256))
+# >1: product anomaly detection shards items across this many processes
+PRODUCT_ANOMALY_WORKERS = int(os.getenv("PRODUCT_ANOMALY_WORKERS", 1))
 
 # Initialize LLMs Globally
 main_llm = ChatOpenAI(
@@ -277,7 +306,11 @@ sub_llm = ChatOpenAI(
 # --- Database Helpers ---
 
 def get_db_connection():
-    return sqlite3.connect(DB_FILE)
+    return sqlite3.connect(ads_db.DB_FILE)
+
+# Reusable read connections (concurrent detail reads, schema catalog lookups)
+read_pool = ConnectionPool(lambda: ads_db.DB_FILE, size=8)
+detail_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='detail')
 
 def query_db(query: str, params: tuple = ()) -> List[Dict[str, Any]]:
     conn = get_db_connection()
@@ -295,6 +328,16 @@ def query_db(query: str, params: tuple = ()) -> List[Dict[str, Any]]:
     finally:
         conn.close()
 
+def publish_data_event(event: str, tables: list, detail: dict = None, bump: bool = True):
+    """data_events.publish_event on this module's DB; failures are logged, never raised"""
+    conn = get_db_connection()
+    try:
+        data_events.publish_event(event, tables, detail, conn, bump=bump)
+    except Exception as e:
+        print(f"Event publish failed ({event}): {e}")
+    finally:
+        conn.close()
+
 def query_value(query: str, params: tuple = ()):
     """Helper to get a single value from DB"""
     res = query_db(query, params)
@@ -830,7 +873,11 @@ def scan_campaigns_for_anomalies(target_date: str = None) -> str:
     4. Report: Aggregate findings into a decision-grade report.
     """
     # 1. Main Agent Trigger
-    anomalies = get_campaign_anomalies_logic(target_date) 
+    try:
+        anomalies = get_campaign_anomalies_logic(target_date)
+    except Exception as e:
+        print(f"Anomaly Detection Error: {e}")
+        return f"Error: anomaly detection failed: {e}"
     
     print(f"🔍 Scan found {len(anomalies)} anomaly campaigns for date: {target_date}")
     for a in anomalies:
@@ -864,43 +911,34 @@ def scan_campaigns_for_anomalies(target_date: str = None) -> str:
         report.append(f"{i}. **{a.get('campaign', 'Unknown')}** - {a.get('reason', 'Efficiency Issue')}")
     report.append("\n---\n")
     report.append("## 各系列详细诊断\n")
+
+    # 所有异常系列的维度贡献分解 (每个维度一次查询)
+    root_causes = {}
+    by_date = {}
+    for a in anomalies:
+        by_date.setdefault(a.get('date') or target_date, []).append(a.get('campaign'))
+    for date, names in by_date.items():
+        if not date:
+            continue
+        try:
+            root_causes.update(explain_campaign_changes(names, date))
+        except Exception as e:
+            print(f"Root cause analysis failed for {date}: {e}")
     for a in anomalies:
         campaign_name = a.get('campaign', 'Unknown')
         campaign_type = a.get('campaign_type', 'Unknown')
         
-        # 收集相关数据供 LLM 分析
+        # 维度根因贡献分析 (预计算, 替代原始维度行)
         related_data = {}
-        
-        # 搜索词数据
-        st_data = query_db("SELECT * FROM search_term WHERE campaign = ? ORDER BY CAST(cost AS REAL) DESC LIMIT 15", (campaign_name,))
-        if st_data:
-            related_data['search_term'] = st_data
-        
-        # 渠道数据 (PMax)
-        ch_data = query_db("SELECT * FROM channel WHERE campaigns LIKE ? ORDER BY CAST(cost AS REAL) DESC LIMIT 15", (f"%{campaign_name}%",))
-        if ch_data:
-            related_data['channel'] = ch_data
+        root_cause = root_causes.get(campaign_name)
+        if root_cause and root_cause.get('dimensions'):
+            related_data['root_cause'] = root_cause
         
         # 商品数据
         pr_data = query_db("SELECT * FROM product ORDER BY CAST(cost AS REAL) DESC LIMIT 15")
         if pr_data:
             related_data['product'] = pr_data
         
-        # 地域数据
-        geo_data = query_db("SELECT * FROM location_by_cities_all_campaign WHERE campaign = ? ORDER BY CAST(cost AS REAL) DESC LIMIT 15", (campaign_name,))
-        if geo_data:
-            related_data['geo'] = geo_data
-        
-        # 年龄数据
-        age_data = query_db("SELECT * FROM age WHERE campaign = ? ORDER BY CAST(cost AS REAL) DESC LIMIT 10", (campaign_name,))
-        if age_data:
-            related_data['age'] = age_data
-        
-        # 时段数据
-        schedule_data = query_db("SELECT * FROM ad_schedule WHERE campaign = ? ORDER BY CAST(cost AS REAL) DESC LIMIT 10", (campaign_name,))
-        if schedule_data:
-            related_data['ad_schedule'] = schedule_data
-        
         # 调试日志
         print(f"📊 Collected data for {campaign_name}:")
         for key, val in related_data.items():
@@ -922,7 +960,7 @@ def scan_campaigns_for_anomalies(target_date: str = None) -> str:
         **系列类型**: {campaign_type}
         **异常数据**: {json.dumps(a, ensure_ascii=False)}
         
-        ## 相关维度数据 (请基于以下数据做详细分析)
+        ## 相关维度数据 (root_cause 为预计算的 ROAS/CPA 变化贡献分解: contribution 之和 = 该维度总变化)
         
         {json.dumps(related_data, ensure_ascii=False, indent=2)[:12000]}
         
@@ -931,12 +969,12 @@ def scan_campaigns_for_anomalies(target_date: str = None) -> str:
         
         你必须输出详细的诊断报告，格式如下：
         
-        1. **效率概览**: 用具体数字说明ROAS/CPA的变化幅度
-        2. **搜索词分析**: 如果有search_term数据，列出消耗Top 5的词及其CTR/转化
-        3. **渠道分析**: 如果有channel数据，列出各渠道消耗占比
-        4. **人群画像**: 如果有age数据，列出年龄段分布
-        5. **时段分析**: 如果有schedule数据，列出高消耗时段
-        6. **根本原因**: 综合判断效率下降的根本原因
+        1. **效率概览**: 用具体数字说明ROAS/CPA的变化幅度 (基线窗口 vs 当前窗口)
+        2. **主要驱动因素**: 基于 root_cause.top_drivers，列出贡献最大的维度取值及其 impact_pct
+        3. **结构 vs 效率**: 说明每个驱动因素是花费占比迁移 (mix) 还是自身效率变化 (rate)
+        4. **分维度说明**: 搜索词 / 地域 / 年龄 / 性别 / 渠道 / 时段中有驱动因素的维度逐一说明
+        5. **根本原因**: 综合判断效率下降的根本原因
+        6. **补充**: 如有product数据，说明高消耗商品情况
         7. **行动建议**: 给出3-5条具体可执行的优化建议
         
         **重要**: 即使数据不完整，也要基于现有数据给出尽可能详细的分析。不要给出"无数据"的简单回复。
@@ -1188,18 +1226,47 @@ class AgentState(TypedDict):
 
 # --- Standalone Logic (Decoupled from AgentService) ---
 
+def guard_campaign_risks(campaign_names: List[str], target_date: str) -> Dict:
+    """ContextGuard risk assessment for all campaigns flagged on target_date (batched queries)"""
+    return ContextGuard.check_risk_batch(campaign_names, target_date)
+
+
+def get_ewma_anomalies_logic(entity_type: str, target_date: str = None) -> Dict:
+    """
+    EWMA / seasonal detector (anomaly_ewma): entities whose latest day is
+    >= 3 std off their exponentially weighted baseline, highest score first,
+    as {date, as_of, pending, anomalies}. The state is advanced by the
+    precompute jobs only; pending means it has not reached the date yet.
+    Campaigns get the same ContextGuard fields as the rule-based monitor.
+    Errors propagate so that callers do not cache or store a failed run.
+    """
+    result = anomaly_ewma.get_ewma_anomalies(entity_type, target_date)
+    anomalies = result['anomalies']
+    if entity_type == 'campaign' and anomalies:
+        risks = guard_campaign_risks([a['campaign'] for a in anomalies], anomalies[0]['date'])
+        for a in anomalies:
+            risk_info = risks[a['campaign']]
+            a["status"] = risk_status_label(risk_info['status'])
+            a["risk_level"] = risk_info['status']
+            a["guard_reasons"] = risk_info['reasons']
+    return result
+
+
 def get_campaign_anomalies_logic(target_date: str = None):
     """
     Identify anomalous campaigns for a specific date (defaults to latest in DB).
-    Risk Control: Returns empty if target_date falls within major promotion periods.
+    Risk Control: flagged campaigns are tagged by ContextGuard (promotion periods,
+    budget changes, cold start).
+
+    Detection criteria (evaluated for all campaigns at once, see anomaly_engine):
+    1. Efficiency Check (3 consecutive days):
+       - ROAS < 80% of 7-day avg
+       - OR CPA > 125% of 7-day avg
+    2. Growth Check:
+       - No conversion growth (Current 3 days vs same 3 days last week)
+
+    Errors propagate so that callers do not cache or store a failed run.
     """
-    # --- 0. Risk Control: Promotion Protection Defaults ---
-    # Format: (Start, End). Example: Black Friday / Cyber Monday.
-    PROMOTION_PERIODS = [
-        ('2025-11-20', '2025-12-05'), # BFCM
-        ('2026-06-01', '2026-06-20'), # 618 Sale
-    ]
-    
     conn = get_db_connection()
     try:
         # 1. Determine the target "Today"
@@ -1212,165 +1279,17 @@ def get_campaign_anomalies_logic(target_date: str = None):
                 return []
         
         # 2. Fetch raw data (Last 45 days relative to target_date)
-        query = """
-            SELECT date, campaign, roas, cpa, conversions, budget, campaign_type 
-            FROM campaign 
-            WHERE date <= ? AND date >= date(?, '-45 days')
-            ORDER BY campaign, date ASC
-        """
-        df = pd.read_sql_query(query, conn, params=(target_date, target_date))
-        
+        df = load_campaign_frame(conn, window_start(target_date), target_date)
         if df.empty:
             return []
 
-        # Clean and Convert
-        df['date'] = pd.to_datetime(df['date'])
-        target_dt = pd.to_datetime(target_date)
-        df['roas'] = pd.to_numeric(df['roas'], errors='coerce').fillna(0)
-        df['cpa'] = pd.to_numeric(df['cpa'], errors='coerce').fillna(0)
-        df['conversions'] = pd.to_numeric(df['conversions'], errors='coerce').fillna(0)
-
-        anomalies = []
-        
-        # Group by campaign
-        for campaign_name, group in df.groupby('campaign'):
-            group = group.sort_values('date')
-            if len(group) < 10: 
-                continue
-
-            # The analysis target is target_dt
-            last_date = target_dt
-            
-            # Check 3 days: T, T-1, T-2
-            check_dates = [last_date - pd.Timedelta(days=i) for i in range(3)] 
-            
-            # Check Condition A: Efficiency for EACH of the last 3 days
-            is_efficiency_bad = True
-            
-            for d in check_dates:
-                # Specific day row
-                day_row = group[group['date'] == d]
-                if day_row.empty:
-                    is_efficiency_bad = False; break
-                
-                current_roas = day_row['roas'].values[0]
-                current_cpa = day_row['cpa'].values[0]
-
-                # History: 7 days prior to 'd' -> [d-7, d-1]
-                start_hist = d - pd.Timedelta(days=7)
-                end_hist = d - pd.Timedelta(days=1)
-                
-                hist_rows = group[(group['date'] >= start_hist) & (group['date'] <= end_hist)]
-                if hist_rows.empty:
-                    is_efficiency_bad = False; break
-                    
-                avg_roas = hist_rows['roas'].mean()
-                avg_cpa = hist_rows['cpa'].mean()
-                
-                # Criteria
-                roas_bad = (avg_roas > 0) and (current_roas < avg_roas * 0.8)
-                cpa_bad = (avg_cpa > 0) and (current_cpa > avg_cpa * 1.25)
-                
-                if not (roas_bad or cpa_bad):
-                    is_efficiency_bad = False
-                    break
-            
-            if not is_efficiency_bad:
-                continue
-
-            # Check Condition B: No Growth
-            # Current Period: [T-2, T]
-            # Week-over-week Previous Period: [T-9, T-7]
-            current_start = last_date - pd.Timedelta(days=2)
-            prev_end = last_date - pd.Timedelta(days=7)
-            prev_start = prev_end - pd.Timedelta(days=2)
-            
-            current_conv = group[(group['date'] >= current_start) & (group['date'] <= last_date)]['conversions'].sum()
-            prev_conv = group[(group['date'] >= prev_start) & (group['date'] <= prev_end)]['conversions'].sum()
-            
-            growth = 0
-            if prev_conv > 0:
-                growth = (current_conv - prev_conv) / prev_conv
-            
-            is_growth_bad = False
-            if prev_conv > 0:
-                 if growth <= 0: is_growth_bad = True
-            else:
-                 if current_conv == 0: is_growth_bad = True
-            
-            if is_growth_bad:
-                # Calculate summary stats for display (3d vs prev 7d)
-                curr_3d_mask = (group['date'] >= current_start) & (group['date'] <= last_date)
-                prev_7d_mask = (group['date'] >= last_date - pd.Timedelta(days=9)) & (group['date'] <= last_date - pd.Timedelta(days=3))
-                
-                curr_roas = group[curr_3d_mask]['roas'].mean()
-                prev_roas = group[prev_7d_mask]['roas'].mean()
-                
-                curr_cpa = group[curr_3d_mask]['cpa'].mean()
-                prev_cpa = group[prev_7d_mask]['cpa'].mean()
-
-                # Determine specific efficiency reason
-                efficiency_details = []
-                if prev_roas > 0 and curr_roas < prev_roas * 0.8:
-                    drop_pct = (prev_roas - curr_roas) / prev_roas * 100
-                    efficiency_details.append(f"ROAS -{drop_pct:.0f}%")
-                if prev_cpa > 0 and curr_cpa > prev_cpa * 1.25:
-                    rise_pct = (curr_cpa - prev_cpa) / prev_cpa * 100
-                    efficiency_details.append(f"CPA +{rise_pct:.0f}%")
-                
-                reason_str = " & ".join(efficiency_details)
-                if not reason_str: reason_str = "Efficiency Alert"
-
-                # 4. Integrate Context Guard Risk Assessment
-                risk_info = ContextGuard.check_risk({"campaign": campaign_name}, last_date.strftime('%Y-%m-%d'))
-                
-                risk_label = "🔴 Critical"
-                if risk_info['status'] == "BLOCK": risk_label = "🛡️ Protected (Tag Only)"
-                elif risk_info['status'] == "MARK": risk_label = "⚠️ Warning (Observing)"
-
-                # 5. Get Campaign Type for Expert Routing
-                camp_type = group['campaign_type'].iloc[0] if 'campaign_type' in group.columns else 'Unknown'
-                
-                # Determine suggested experts based on campaign type
-                suggested_experts = []
-                if 'search' in str(camp_type).lower():
-                    suggested_experts = ['search_term', 'keyword', 'age', 'gender']
-                elif 'pmax' in str(camp_type).lower() or 'performance max' in str(camp_type).lower():
-                    suggested_experts = ['channel', 'product', 'location_by_cities_all_campaign']
-                else:
-                    suggested_experts = ['age', 'gender', 'location_by_cities_all_campaign']
-
-                anomalies.append({
-                    "id": str(campaign_name),
-                    "campaign": campaign_name,
-                    "campaign_type": str(camp_type),
-                    "date": last_date.strftime('%Y-%m-%d'),
-                    "growth_rate": growth,
-                    "current_conv": float(current_conv),
-                    "prev_conv": float(prev_conv),
-                    # Efficiency Metrics
-                    "curr_roas": float(curr_roas) if not pd.isna(curr_roas) else 0.0,
-                    "prev_roas": float(prev_roas) if not pd.isna(prev_roas) else 0.0,
-                    "curr_cpa": float(curr_cpa) if not pd.isna(curr_cpa) else 0.0,
-                    "prev_cpa": float(prev_cpa) if not pd.isna(prev_cpa) else 0.0,
-                    
-                    "status": risk_label,
-                    "risk_level": risk_info['status'],
-                    "guard_reasons": risk_info['reasons'],
-                    "suggested_experts": suggested_experts,
-                    "reason": f"{reason_str} & No Growth"
-                })
-        
-        return anomalies
-
-    except Exception as e:
-        print(f"Anomaly Detection Error: {e}")
-        return []
+        # 3. Evaluate all campaigns at once on the campaign × day matrix
+        return detect_campaign_anomalies(df, target_date, guard_campaign_risks)
     finally:
         conn.close()
 
 
-def get_product_anomalies_logic(target_date: str = None):
+def get_product_anomalies_logic(target_date: str = None, workers: int = None):
     """
     Identify anomalous products for a specific date (defaults to latest in DB).
     
@@ -1389,7 +1308,12 @@ def get_product_anomalies_logic(target_date: str = None):
        - OR CPC > 125% of 7-day avg
     2. Growth Check:
        - No click growth (Current 3 days vs Previous 7 days)
+
+    workers > 1 (default PRODUCT_ANOMALY_WORKERS) shards items by item_id hash
+    across a process pool; the result is identical to the serial mode.
+    Errors propagate so that callers do not cache or store a failed run.
     """
+    workers = workers or PRODUCT_ANOMALY_WORKERS
     conn = get_db_connection()
     try:
         # 1. Determine the target "Today"
@@ -1401,159 +1325,91 @@ def get_product_anomalies_logic(target_date: str = None):
             if not target_date:
                 return []
         
+        if workers > 1:
+            anomalies = detect_product_anomalies_sharded(target_date, workers, ads_db.DB_FILE)
+            print(f"Product Anomalies: Detected {len(anomalies)} total ({workers} shards)")
+            return anomalies
+
         # 2. Fetch raw data (Last 45 days relative to target_date)
-        query = """
-            SELECT date, title, item_id, cost, clicks, impr, ctr, avg_cpc
-            FROM product 
-            WHERE date <= ? AND date >= date(?, '-45 days')
-            ORDER BY item_id, date ASC
-        """
-        df = pd.read_sql_query(query, conn, params=(target_date, target_date))
-        
+        df = load_product_frame(conn, window_start(target_date), target_date)
         if df.empty:
             return []
 
-        # Clean and Convert
-        df['date'] = pd.to_datetime(df['date'])
-        target_dt = pd.to_datetime(target_date)
-        df['cost'] = pd.to_numeric(df['cost'].astype(str).str.replace('$', '').str.replace(',', ''), errors='coerce').fillna(0)
-        df['clicks'] = pd.to_numeric(df['clicks'], errors='coerce').fillna(0)
-        df['impr'] = pd.to_numeric(df['impr'], errors='coerce').fillna(0)
-        df['ctr'] = pd.to_numeric(df['ctr'].astype(str).str.replace('%', ''), errors='coerce').fillna(0)
-        df['avg_cpc'] = pd.to_numeric(df['avg_cpc'].astype(str).str.replace('$', '').str.replace(',', ''), errors='coerce').fillna(0)
-
-        anomalies = []
-        
-        # Group by product (item_id)
-        for item_id, group in df.groupby('item_id'):
-            group = group.sort_values('date')
-            if len(group) < 10:
-                continue
+        # 3. Evaluate all items at once on the item × day matrix
+        anomalies = detect_product_anomalies(df, target_date)
+        print(f"Product Anomalies: Detected {len(anomalies)} total")
+        return anomalies  # Return all anomalies (pagination handled by API)
+    finally:
+        conn.close()
 
-            title = group['title'].iloc[-1] if 'title' in group.columns else 'Unknown Product'
-            last_date = target_dt
-            
-            # Check 3 days: T, T-1, T-2
-            check_dates = [last_date - pd.Timedelta(days=i) for i in range(3)] 
-            
-            # Check Condition A: Efficiency for EACH of the last 3 days
-            # Using CTR instead of ROAS, CPC instead of CPA
-            is_efficiency_bad = True
-            
-            for d in check_dates:
-                # Specific day row
-                day_row = group[group['date'] == d]
-                if day_row.empty:
-                    is_efficiency_bad = False; break
-                
-                current_ctr = day_row['ctr'].values[0]
-                current_cpc = day_row['avg_cpc'].values[0]
 
-                # History: 7 days prior to 'd' -> [d-7, d-1]
-                start_hist = d - pd.Timedelta(days=7)
-                end_hist = d - pd.Timedelta(days=1)
-                
-                hist_rows = group[(group['date'] >= start_hist) & (group['date'] <= end_hist)]
-                if hist_rows.empty:
-                    is_efficiency_bad = False; break
-                    
-                avg_ctr = hist_rows['ctr'].mean()
-                avg_cpc = hist_rows['avg_cpc'].mean()
-                
-                # Criteria (same thresholds as Campaign: 80% / 125%)
-                ctr_bad = (avg_ctr > 0) and (current_ctr < avg_ctr * 0.8)
-                cpc_bad = (avg_cpc > 0) and (current_cpc > avg_cpc * 1.25)
-                
-                if not (ctr_bad or cpc_bad):
-                    is_efficiency_bad = False
-                    break
-            
-            if not is_efficiency_bad:
-                continue
 
-            # Check Condition B: No Growth (using clicks instead of conversions)
-            # Current Period: [T-2, T]
-            # Week-over-week Previous Period: [T-9, T-7]
-            current_start = last_date - pd.Timedelta(days=2)
-            prev_end = last_date - pd.Timedelta(days=7)
-            prev_start = prev_end - pd.Timedelta(days=2)
-            
-            current_clicks = group[(group['date'] >= current_start) & (group['date'] <= last_date)]['clicks'].sum()
-            prev_clicks = group[(group['date'] >= prev_start) & (group['date'] <= prev_end)]['clicks'].sum()
-            
-            growth = 0
-            if prev_clicks > 0:
-                growth = (current_clicks - prev_clicks) / prev_clicks
-            
-            is_growth_bad = False
-            if prev_clicks > 0:
-                 if growth <= 0: is_growth_bad = True
-            else:
-                 if current_clicks == 0: is_growth_bad = True
-            
-            if is_growth_bad:
-                # Calculate summary stats for display (3d vs prev 7d)
-                curr_3d_mask = (group['date'] >= current_start) & (group['date'] <= last_date)
-                prev_7d_mask = (group['date'] >= last_date - pd.Timedelta(days=9)) & (group['date'] <= last_date - pd.Timedelta(days=3))
-                
-                curr_cost = group[curr_3d_mask]['cost'].sum()
-                prev_cost = group[prev_7d_mask]['cost'].sum()
-                
-                curr_clicks_sum = group[curr_3d_mask]['clicks'].sum()
-                prev_clicks_sum = group[prev_7d_mask]['clicks'].sum()
-                
-                # Calculate average CTR/CPC for the periods to show trend
-                curr_avg_ctr = group[curr_3d_mask]['ctr'].mean()
-                prev_avg_ctr = group[prev_7d_mask]['ctr'].mean()
-                curr_avg_cpc = group[curr_3d_mask]['avg_cpc'].mean()
-                prev_avg_cpc = group[prev_7d_mask]['avg_cpc'].mean()
-
-                # Determine specific efficiency reason
-                efficiency_details = []
-
-                if prev_avg_ctr > 0 and curr_avg_ctr < prev_avg_ctr * 0.8:
-                    drop_pct = (prev_avg_ctr - curr_avg_ctr) / prev_avg_ctr * 100
-                    efficiency_details.append(f"CTR -{drop_pct:.0f}%")
-                if prev_avg_cpc > 0 and curr_avg_cpc > prev_avg_cpc * 1.25:
-                    rise_pct = (curr_avg_cpc - prev_avg_cpc) / prev_avg_cpc * 100
-                    efficiency_details.append(f"CPC +{rise_pct:.0f}%")
-                
-                reason_str = " & ".join(efficiency_details)
-                if not reason_str: reason_str = "Efficiency Alert"
-
-                anomalies.append({
-                    "id": str(item_id),
-                    "item_id": str(item_id),
-                    "title": str(title)[:50],
-                    "date": last_date.strftime('%Y-%m-%d'),
-                    "curr_cost": float(curr_cost),
-                    "prev_cost": float(prev_cost),
-                    "curr_clicks": float(curr_clicks_sum),
-                    "prev_clicks": float(prev_clicks_sum),
-                    "curr_ctr": float(curr_avg_ctr) if not pd.isna(curr_avg_ctr) else 0.0,
-                    "prev_ctr": float(prev_avg_ctr) if not pd.isna(prev_avg_ctr) else 0.0,
-                    # Using CTR/CPC instead of ROAS/CPA for frontend display
-                    "current_conv": float(current_clicks),  # clicks as proxy for conversions
-                    "prev_conv": float(prev_clicks),
-                    "curr_roas": float(curr_avg_ctr) if not pd.isna(curr_avg_ctr) else 0.0,  # CTR as proxy
-                    "prev_roas": float(prev_avg_ctr) if not pd.isna(prev_avg_ctr) else 0.0,
-                    "curr_cpa": float(curr_avg_cpc) if not pd.isna(curr_avg_cpc) else 0.0,  # CPC as proxy
-                    "prev_cpa": float(prev_avg_cpc) if not pd.isna(prev_avg_cpc) else 0.0,
-                    "reason": f"{reason_str} & No Growth"
-                })
-        
-        # Sort by cost (highest cost issues first)
-        anomalies.sort(key=lambda x: x['curr_cost'], reverse=True)
-        print(f"Product Anomalies: Detected {len(anomalies)} total")
-        return anomalies  # Return all anomalies (pagination handled by API)
 
-    except Exception as e:
-        print(f"Product Anomaly Detection Error: {e}")
-        return []
+MAX_HISTORY_DAYS = 366
+
+
+def get_campaign_anomalies_range_logic(start_date: str, end_date: str) -> Dict:
+    """{date: campaign anomalies} for every date in [start_date, end_date], from one load and one pass"""
+    conn = get_db_connection()
+    try:
+        df = load_campaign_frame(conn, window_start(start_date), end_date)
     finally:
         conn.close()
+    return detect_campaign_anomalies_range(df, start_date, end_date, guard_campaign_risks)
 
 
+def get_product_anomalies_range_logic(start_date: str, end_date: str) -> Dict:
+    """{date: product anomalies} for every date in [start_date, end_date], from one load and one pass"""
+    conn = get_db_connection()
+    try:
+        df = load_product_frame(conn, window_start(start_date), end_date)
+    finally:
+        conn.close()
+    return detect_product_anomalies_range(df, start_date, end_date)
+
+
+def get_anomaly_history_logic(start_date: str, end_date: str, entity_types=('campaign', 'product')) -> Dict:
+    """
+    Per-day campaign / product anomalies for every date in [start_date, end_date].
+    Rows are loaded once ([start - 45 days, end]) and all dates are evaluated in
+    a single sliding-window pass instead of one detection run per date.
+    """
+    start_dt = datetime.strptime(start_date, '%Y-%m-%d')
+    end_dt = datetime.strptime(end_date, '%Y-%m-%d')
+    if end_dt < start_dt:
+        return {"error": "end_date must be on or after start_date"}
+    if (end_dt - start_dt).days >= MAX_HISTORY_DAYS:
+        return {"error": f"Range too long (max {MAX_HISTORY_DAYS} days)"}
+
+    try:
+        by_type = {}
+        if 'campaign' in entity_types:
+            by_type['campaign'] = get_campaign_anomalies_range_logic(start_date, end_date)
+        if 'product' in entity_types:
+            by_type['product'] = get_product_anomalies_range_logic(start_date, end_date)
+    except Exception as e:
+        print(f"Anomaly History Error: {e}")
+        return {"error": str(e)}
+
+    days = []
+    d = start_dt
+    while d <= end_dt:
+        day = d.strftime('%Y-%m-%d')
+        entry = {"date": day}
+        for entity_type, results in by_type.items():
+            entry[entity_type] = results.get(day, [])
+            entry[f"{entity_type}_count"] = len(entry[entity_type])
+        days.append(entry)
+        d += pd.Timedelta(days=1)
+
+    return {"start_date": start_date, "end_date": end_date, "days": days}
+
+
+def _relative_change(curr, prev) -> float:
+    """(curr - prev) / prev, 0 when there is no baseline"""
+    curr = curr or 0.0
+    prev = prev or 0.0
+    return (curr - prev) / prev if prev > 0 else 0.0
 
 
 class AgentService:
@@ -1565,6 +1421,8 @@ class AgentService:
         self.llm_with_tools = self.llm.bind_tools(self.tools)
         
         self._init_prefs_db()
+        self.result_cache = ResultCache(RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_MAX_MB * 1024 * 1024)
+        self._warm_schema_catalog()
 
         workflow = StateGraph(AgentState)
         workflow.add_node("agent", self.call_model)
@@ -1586,9 +1444,19 @@ class AgentService:
                 PRIMARY KEY (table_name, item_identifier)
             )
         """)
+        init_data_versions(conn)
         conn.commit()
         conn.close()
 
+    def _warm_schema_catalog(self):
+        conn = get_db_connection()
+        try:
+            schema_catalog.get_catalog(conn)
+        except sqlite3.Error as e:
+            print(f"Schema catalog warm-up failed: {e}")
+        finally:
+            conn.close()
+
     def call_tools(self, state: AgentState):
         """
         Manual execution of tools to bypass ToolNode strictness.
@@ -1811,24 +1679,40 @@ class AgentService:
                 # yield f"\n✅ [{tool_name}] 完成\n"
 
     def get_tables(self):
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-        tables = [row[0] for row in cursor.fetchall()]
-        conn.close()
-        return tables
+        with read_pool.connection() as conn:
+            return schema_catalog.list_tables(conn)
+
+    # Column matched against user_preferences.item_identifier (default: campaign)
+    TABLE_PK_COLUMNS = {
+        'search_term': 'search_term',
+        'product': 'item_id',
+        'asset': 'ad_group',
+        'audience': 'audience_segment',
+        'channel': 'channels',
+    }
 
-    def get_table_data(self, table_name, start_date: str = None, end_date: str = None):
+    # Preferred column order (important columns first, the rest keep table order)
+    TABLE_COLUMN_ORDER = {
+        'campaign': ['date', 'campaign', 'campaign_status', 'roas', 'roas_before_7d_average', 'roas_compare', 'cpa', 'cpa_before_7d_average', 'cpa_compare', 'conversions', 'conv_value', 'cost', 'clicks', 'impressions', 'ctr', 'conversions_rate', 'budget', 'campaign_type', 'search_impr_share'],
+        'product': ['date', 'title', 'item_id', 'ctr', 'ctr_before_7d_average', 'ctr_compare', 'avg_cpc', 'cpc_before_7d_average', 'cpc_compare', 'cost', 'clicks', 'impr', 'price', 'status', 'issues', 'merchant_id'],
+        'search_term': ['date', 'search_term', 'conversions', 'cost', 'clicks', 'impressions', 'ctr', 'campaign', 'ad_group'],
+    }
+
+    def _order_columns(self, table_name: str, columns: list) -> list:
+        preferred = self.TABLE_COLUMN_ORDER.get(table_name)
+        if not preferred:
+            return columns
+        ordered = [c for c in preferred if c in columns]
+        return ordered + [c for c in columns if c not in ordered]
+
+    def get_table_data(self, table_name, start_date: str = None, end_date: str = None, fmt: str = None):
+        """fmt: None = {columns, data: [dict]}; 'rows' / 'columnar' = compact payloads (see columnar.py)"""
         conn = get_db_connection()
-        conn.row_factory = sqlite3.Row
+        if not fmt:
+            conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         try:
-            pk_col = 'campaign' 
-            if table_name == 'search_term': pk_col = 'search_term'
-            elif table_name == 'product': pk_col = 'item_id' 
-            elif table_name == 'asset': pk_col = 'ad_group' 
-            elif table_name == 'audience': pk_col = 'audience_segment'
-            elif table_name == 'channel': pk_col = 'channels'
+            pk_col = self.TABLE_PK_COLUMNS.get(table_name, 'campaign')
             
             where_clause = ""
             params = []
@@ -1857,32 +1741,19 @@ class AgentService:
             cursor.execute(query, params)
             rows = cursor.fetchall()
             
-            if not rows: return {"columns": [], "data": []}
+            if not rows:
+                return columnar.table_payload([], [], fmt) if fmt else {"columns": [], "data": []}
 
             columns = [description[0] for description in cursor.description]
             display_columns = [c for c in columns if c not in ['_pinned', '_order']]
             
-            # Define preferred column order (important columns first)
-            COLUMN_ORDER = {
-                'campaign': ['date', 'campaign', 'campaign_status', 'roas', 'roas_before_7d_average', 'roas_compare', 'cpa', 'cpa_before_7d_average', 'cpa_compare', 'conversions', 'conv_value', 'cost', 'clicks', 'impressions', 'ctr', 'conversions_rate', 'budget', 'campaign_type', 'search_impr_share'],
-                'product': ['date', 'title', 'item_id', 'ctr', 'ctr_before_7d_average', 'ctr_compare', 'avg_cpc', 'cpc_before_7d_average', 'cpc_compare', 'cost', 'clicks', 'impr', 'price', 'status', 'issues', 'merchant_id'],
-                'search_term': ['date', 'search_term', 'conversions', 'cost', 'clicks', 'impressions', 'ctr', 'campaign', 'ad_group'],
-            }
+            # Reorder columns if table has configured order (important columns first)
+            display_columns = self._order_columns(table_name, display_columns)
+            
+            if fmt and table_name != 'product':
+                return columnar.table_payload(display_columns, columnar.project(rows, columns, display_columns), fmt)
             
-            # Reorder columns if table has configured order
-            if table_name in COLUMN_ORDER:
-                preferred = COLUMN_ORDER[table_name]
-                # Create ordered list: preferred columns first (in order), then remaining columns
-                ordered = []
-                for col in preferred:
-                    if col in display_columns:
-                        ordered.append(col)
-                for col in display_columns:
-                    if col not in ordered:
-                        ordered.append(col)
-                display_columns = ordered
-            
-            data = [dict(row) for row in rows]
+            data = [dict(zip(columns, row)) for row in rows] if fmt else [dict(row) for row in rows]
             
             # Post-process product data to add comparison columns (like campaign has roas_compare, cpa_compare)
             if table_name == 'product' and data:
@@ -1938,15 +1809,403 @@ class AgentService:
                             updated_columns.extend(['cpc_before_7d_average', 'cpc_compare'])
                     display_columns = updated_columns
             
+            if fmt:
+                return columnar.records_payload(display_columns, data, fmt)
             return {"columns": display_columns, "data": data}
         except Exception as e:
             return {"error": str(e)}
         finally:
             conn.close()
 
+    def _table_select(self, conn, table_name: str, start_date: str, end_date: str, sort_by: str,
+                      descending: bool, columns: List[str], filters: List[str]) -> dict:
+        """
+        Validated pieces of a table read shared by the page and Arrow paths:
+        projection, pinned-first ORDER BY keys, preference join and WHERE conditions.
+        Raises ValueError for unknown tables / columns / filters.
+        """
+        table_cols = table_query.table_columns(conn, table_name)
+        sort_by = sort_by or ('date' if 'date' in table_cols else next(iter(table_cols)))
+        sort_expr = table_query.sort_expression(conn, table_name, sort_by, table_cols)
+
+        if columns:
+            unknown = [c for c in columns if c not in table_cols]
+            if unknown:
+                raise ValueError(f"Unknown columns: {', '.join(unknown)}")
+            selected = list(dict.fromkeys(columns))
+        else:
+            selected = list(table_cols)
+
+        keys = [(sort_expr, descending), ("t.rowid", descending)]
+        pk_col = self.TABLE_PK_COLUMNS.get(table_name, 'campaign')
+        if pk_col in table_cols:
+            join = f'LEFT JOIN user_preferences p ON p.table_name = ? AND p.item_identifier = t."{pk_col}"'
+            join_params = [table_name]
+            keys = [("COALESCE(p.is_pinned, 0)", True), ("COALESCE(p.display_order, 999999)", False)] + keys
+        else:
+            # Nothing to pin; integer literals in ORDER BY would be read as column positions
+            join, join_params = "", []
+
+        conditions, params = table_query.parse_filters(conn, table_name, filters, table_cols)
+        if start_date:
+            conditions.append("t.date >= ?")
+            params.append(start_date)
+        if end_date:
+            conditions.append("t.date <= ?")
+            params.append(end_date)
+
+        return {
+            "table_cols": table_cols,
+            "selected": selected,
+            "sort_by": sort_by,
+            "keys": keys,
+            "join": join,
+            "join_params": join_params,
+            "conditions": conditions,
+            "params": params,
+        }
+
+    def stream_table_arrow(self, table_name: str, start_date: str = None, end_date: str = None, sort_by: str = None,
+                           sort_dir: str = 'desc', columns: List[str] = None, filters: List[str] = None,
+                           limit: int = None):
+        """
+        Arrow IPC stream (generator of bytes) of a whole filtered table, same
+        parameters and row order as get_table_page. Raw table columns only
+        (no product compare columns). Returns {"error"} when the request is
+        invalid or pyarrow is missing.
+        """
+        if not arrow_stream.available():
+            return {"error": "Arrow output requires pyarrow (pip install pyarrow)"}
+        descending = (sort_dir or 'desc').lower() != 'asc'
+        conn = get_db_connection()
+        try:
+            q = self._table_select(conn, table_name, start_date, end_date, sort_by, descending, columns, filters)
+            declared = arrow_stream.promote_real_columns(conn, table_name, q['selected'], q['table_cols'])
+        except (ValueError, sqlite3.Error) as e:
+            return {"error": str(e)}
+        finally:
+            conn.close()
+
+        query = f"""
+            SELECT {", ".join(f't."{c}"' for c in q['selected'])}
+            FROM "{table_name}" t
+            {q['join']}
+            {"WHERE " + " AND ".join(q['conditions']) if q['conditions'] else ""}
+            ORDER BY {", ".join(f"{expr} {'DESC' if desc else 'ASC'}" for expr, desc in q['keys'])}
+            {"LIMIT ?" if limit else ""}
+        """
+        params = q['join_params'] + q['params'] + ([int(limit)] if limit else [])
+        return arrow_stream.stream_query(get_db_connection, query, params, q['selected'], declared)
+
+    def get_table_page(self, table_name: str, start_date: str = None, end_date: str = None, limit: int = 100,
+                       cursor: str = None, sort_by: str = None, sort_dir: str = 'desc', columns: List[str] = None,
+                       filters: List[str] = None, fmt: str = None):
+        """
+        One page of a table with sorting, projection and filters pushed into SQL.
+        Pinned rows (user_preferences) come first, then display_order, then
+        sort_by (default date desc). total counts every matching row.
+        fmt: 'rows' / 'columnar' for a compact payload (see columnar.py).
+        """
+        limit = max(1, min(int(limit or 100), table_query.MAX_PAGE_SIZE))
+        descending = (sort_dir or 'desc').lower() != 'asc'
+        conn = get_db_connection()
+        try:
+            q = self._table_select(conn, table_name, start_date, end_date, sort_by, descending, columns, filters)
+            selected, sort_by, keys = q['selected'], q['sort_by'], q['keys']
+            conditions, params, join, join_params = q['conditions'], q['params'], q['join'], q['join_params']
+
+            total = conn.execute(f'SELECT COUNT(*) FROM "{table_name}" t'
+                                 + (" WHERE " + " AND ".join(conditions) if conditions else ""), params).fetchone()[0]
+
+            page_conditions, page_params = list(conditions), list(params)
+            if cursor:
+                keyset, keyset_params = table_query.keyset_condition(keys, decode_cursor(cursor))
+                page_conditions.append(keyset)
+                page_params += keyset_params
+
+            select_cols = ", ".join(f't."{c}"' for c in selected)
+            query = f"""
+                SELECT {select_cols}, {", ".join(expr for expr, _ in keys)}
+                FROM "{table_name}" t
+                {join}
+                {"WHERE " + " AND ".join(page_conditions) if page_conditions else ""}
+                ORDER BY {", ".join(f"{expr} {'DESC' if desc else 'ASC'}" for expr, desc in keys)}
+                LIMIT ?
+            """
+            rows = conn.execute(query, join_params + page_params + [limit + 1]).fetchall()
+
+            n = len(selected)
+            next_cursor = encode_cursor(list(rows[limit - 1][n:])) if len(rows) > limit else None
+            rows = rows[:limit]
+            display_columns = self._order_columns(table_name, selected)
+            page_info = {
+                "next_cursor": next_cursor,
+                "total": total,
+                "sort_by": sort_by,
+                "sort_dir": 'desc' if descending else 'asc',
+            }
+
+            if fmt and table_name != 'product':
+                return columnar.table_payload(display_columns, columnar.project([row[:n] for row in rows], selected, display_columns),
+                                              fmt, **page_info)
+
+            data = [dict(zip(selected, row[:n])) for row in rows]
+            if table_name == 'product' and data:
+                display_columns = self._add_product_compare(conn, data, [row[-1] for row in rows],
+                                                            display_columns, start_date, end_date)
+            if fmt:
+                return columnar.records_payload(display_columns, data, fmt, **page_info)
+            return {"columns": display_columns, "data": data, **page_info}
+        except (ValueError, sqlite3.Error) as e:
+            return {"error": str(e)}
+        finally:
+            conn.close()
+
+    def get_table_version(self, table_name: str) -> int:
+        """Data version of a table (the since_version for its next delta sync)"""
+        return get_data_versions().get(table_name, 0)
+
+    def get_table_changes(self, table_name: str, since_version: int):
+        """Rows changed by imports after since_version (see change_log.py); reset=true means reload the table"""
+        conn = get_db_connection()
+        try:
+            if not schema_catalog.table_exists(conn, table_name):
+                return {"error": f"Unknown table '{table_name}'"}
+            return change_log.get_changes(conn, table_name, int(since_version))
+        except (ValueError, sqlite3.Error) as e:
+            return {"error": str(e)}
+        finally:
+            conn.close()
+
+    def _add_product_compare(self, conn, data: list, rowids: list, display_columns: list,
+                             start_date: str = None, end_date: str = None) -> list:
+        """
+        Page-only version of the product compare columns of get_table_data:
+        mean of the item's previous 7 rows (date order) within the date range,
+        computed with a window function over the page's items only.
+        """
+        clean = {c: table_query.numeric_expr(c, 'x') for c in ('ctr', 'avg_cpc') if c in data[0]}
+        if not clean:
+            return display_columns
+        date_filter, params = "", []
+        if start_date:
+            date_filter += " AND x.date >= ?"
+            params.append(start_date)
+        if end_date:
+            date_filter += " AND x.date <= ?"
+            params.append(end_date)
+        window = "OVER (PARTITION BY x.item_id ORDER BY x.date, x.rowid ROWS BETWEEN 7 PRECEDING AND 1 PRECEDING)"
+        exprs = ", ".join(f"COALESCE({e}, 0), COALESCE(AVG(COALESCE({e}, 0)) {window}, 0)" for e in clean.values())
+        placeholders = ",".join("?" * len(rowids))
+        query = f"""
+            SELECT x.rowid, {exprs}
+            FROM product x
+            WHERE x.item_id IN (SELECT item_id FROM product WHERE rowid IN ({placeholders})){date_filter}
+        """
+        stats = {row[0]: row[1:] for row in conn.execute(query, list(rowids) + params)}
+        names = {'ctr': ('ctr_before_7d_average', 'ctr_compare'), 'avg_cpc': ('cpc_before_7d_average', 'cpc_compare')}
+        for row, rowid in zip(data, rowids):
+            values = stats.get(rowid)
+            if values is None:
+                continue
+            for i, col in enumerate(clean):
+                current, average = values[2 * i], values[2 * i + 1]
+                row[col] = current
+                row[names[col][0]] = round(average * 100) / 100
+                row[names[col][1]] = round((current - average) * 100) / 100
+
+        updated_columns = []
+        for col in display_columns:
+            updated_columns.append(col)
+            if col in clean:
+                updated_columns.extend(names[col])
+        return updated_columns
+
+    PRODUCT_SUMMARY_COLUMNS = ['item_id', 'title', 'first_date', 'last_date', 'days', 'cost', 'clicks', 'impr',
+                               'ctr', 'avg_cpc', 'cost_trend', 'clicks_trend', 'ctr_trend']
+
+    def _product_date_bounds(self, conn, start_date: str, end_date: str) -> tuple:
+        if start_date and end_date:
+            return start_date, end_date
+        lo, hi = conn.execute("SELECT MIN(date), MAX(date) FROM product").fetchone()
+        return start_date or lo, end_date or hi
+
+    def _compute_product_summary(self, start_date: str, end_date: str) -> list:
+        """
+        One row per item_id over the range, aggregated in SQL. CTR / CPC are
+        weighted (sum clicks / sum impr, sum cost / sum clicks). *_trend is the
+        second half of the range minus the first half (split at the midpoint date).
+        """
+        conn = get_db_connection()
+        try:
+            start_date, end_date = self._product_date_bounds(conn, start_date, end_date)
+            if not start_date or not end_date:
+                return []
+            d0, d1 = datetime.strptime(start_date, '%Y-%m-%d'), datetime.strptime(end_date, '%Y-%m-%d')
+            midpoint = (d0 + (d1 - d0) / 2).strftime('%Y-%m-%d')
+
+            declared = table_query.table_columns(conn, 'product')
+            cost, clicks, impr = (table_query.value_expr(c, declared.get(c)) for c in ('cost', 'clicks', 'impr'))
+            query = f"""
+                SELECT t.item_id,
+                       SUBSTR(MAX(t.date || '|' || COALESCE(t.title, '')), 12),
+                       MIN(t.date), MAX(t.date), COUNT(DISTINCT t.date),
+                       TOTAL({cost}), TOTAL({clicks}), TOTAL({impr}),
+                       TOTAL(CASE WHEN t.date > ? THEN {cost} END),
+                       TOTAL(CASE WHEN t.date > ? THEN {clicks} END),
+                       TOTAL(CASE WHEN t.date > ? THEN {impr} END)
+                FROM product t
+                WHERE t.date >= ? AND t.date <= ? AND t.item_id IS NOT NULL
+                GROUP BY t.item_id
+            """
+            rows = conn.execute(query, [midpoint, midpoint, midpoint, start_date, end_date]).fetchall()
+        finally:
+            conn.close()
+
+        def ctr(c, i):
+            return c / i * 100 if i else 0.0
+
+        summary = []
+        for item_id, title, first, last, days, cost, clicks, impr, cost2, clicks2, impr2 in rows:
+            cost1, clicks1, impr1 = cost - cost2, clicks - clicks2, impr - impr2
+            summary.append({
+                "item_id": item_id,
+                "title": title,
+                "first_date": first,
+                "last_date": last,
+                "days": days,
+                "cost": round(cost, 2),
+                "clicks": int(clicks),
+                "impr": int(impr),
+                "ctr": round(ctr(clicks, impr), 2),
+                "avg_cpc": round(cost / clicks, 2) if clicks else 0.0,
+                "cost_trend": round(cost2 - cost1, 2),
+                "clicks_trend": int(clicks2 - clicks1),
+                "ctr_trend": round(ctr(clicks2, impr2) - ctr(clicks1, impr1), 2),
+            })
+        return summary
+
+    def get_product_summary(self, start_date: str = None, end_date: str = None, limit: int = 100,
+                            cursor: str = None, sort_by: str = 'cost', sort_dir: str = 'desc',
+                            search: str = None, fmt: str = None):
+        """
+        Product table as one row per item (see _compute_product_summary), cached
+        per data version and cursor-paginated. Pinned items come first, then
+        display_order, then sort_by. search matches title or item_id.
+        """
+        sort_by = sort_by or 'cost'
+        if sort_by not in self.PRODUCT_SUMMARY_COLUMNS:
+            return {"error": f"Unsupported sort_by '{sort_by}'. Use one of: {', '.join(self.PRODUCT_SUMMARY_COLUMNS)}"}
+        limit = max(1, min(int(limit or 100), table_query.MAX_PAGE_SIZE))
+        descending = (sort_dir or 'desc').lower() != 'asc'
+        try:
+            summary = self._cached('tables/product/summary', (start_date, end_date), ['product'],
+                                   lambda: self._compute_product_summary(start_date, end_date))
+            prefs = {row['item_identifier']: (0 if row['is_pinned'] is None else row['is_pinned'],
+                                              999999 if row['display_order'] is None else row['display_order'])
+                     for row in query_db("SELECT item_identifier, is_pinned, display_order FROM user_preferences "
+                                         "WHERE table_name = 'product'")}
+        except (ValueError, sqlite3.Error) as e:
+            return {"error": str(e)}
+
+        if search:
+            needle = search.lower()
+            summary = [r for r in summary if needle in str(r['title']).lower() or needle in str(r['item_id']).lower()]
+
+        def sort_key(row):
+            pinned, order = prefs.get(row['item_id'], (0, 999999))
+            value = row[sort_by] if row[sort_by] is not None else ''
+            # page_sorted reverses the whole key for desc, so flip the pin keys to keep pinned rows first
+            return (pinned, -order, value) if descending else (-pinned, order, value)
+
+        try:
+            items, next_cursor = page_sorted(summary, sort_key, 'item_id', limit, cursor=cursor, descending=descending)
+        except (ValueError, TypeError) as e:
+            return {"error": str(e)}
+
+        page_info = {
+            "next_cursor": next_cursor,
+            "total": len(summary),
+            "sort_by": sort_by,
+            "sort_dir": 'desc' if descending else 'asc',
+        }
+        if fmt:
+            return columnar.records_payload(self.PRODUCT_SUMMARY_COLUMNS, items, fmt, **page_info)
+        return {"columns": self.PRODUCT_SUMMARY_COLUMNS, "data": items, **page_info}
+
+    def get_product_daily(self, item_id: str, start_date: str = None, end_date: str = None, fmt: str = None):
+        """Drill-down for the product summary: one item's daily rows with the compare columns"""
+        conn = get_db_connection()
+        try:
+            table_cols = table_query.table_columns(conn, 'product')
+            selected = list(table_cols)
+            conditions, params = ["t.item_id = ?"], [item_id]
+            if start_date:
+                conditions.append("t.date >= ?")
+                params.append(start_date)
+            if end_date:
+                conditions.append("t.date <= ?")
+                params.append(end_date)
+            rows = conn.execute(f"""
+                SELECT {", ".join(f't."{c}"' for c in selected)}, t.rowid
+                FROM product t
+                WHERE {" AND ".join(conditions)}
+                ORDER BY t.date DESC, t.rowid DESC
+            """, params).fetchall()
+
+            display_columns = self._order_columns('product', selected)
+            data = [dict(zip(selected, row[:-1])) for row in rows]
+            if data:
+                display_columns = self._add_product_compare(conn, data, [row[-1] for row in rows],
+                                                            display_columns, start_date, end_date)
+            if fmt:
+                return columnar.records_payload(display_columns, data, fmt, item_id=item_id)
+            return {"item_id": item_id, "columns": display_columns, "data": data}
+        except (ValueError, sqlite3.Error) as e:
+            return {"error": str(e)}
+        finally:
+            conn.close()
+
+    def _cached(self, endpoint: str, params: tuple, tables: list, compute):
+        """
+        Result cache keyed on (endpoint, params, data version of `tables`).
+        Exceptions and {"error": ...} results are returned but never cached.
+        """
+        return self.result_cache.get_or_compute(self._cache_key(endpoint, params, tables), compute,
+                                                cacheable=lambda v: not (isinstance(v, dict) and 'error' in v))
+
+    def _cache_key(self, endpoint: str, params: tuple, tables: list):
+        versions = get_data_versions()
+        return (endpoint, params, tuple(versions.get(t, 0) for t in tables))
+
+    def get_cache_stats(self):
+        return self.result_cache.stats()
+
     def get_campaign_anomalies(self, target_date: str = None):
-        """Wrapper for standalone logic"""
-        return get_campaign_anomalies_logic(target_date)
+        """Cached per data version; misses are served from the precomputed anomaly_results table"""
+        try:
+            return self._cached('anomalies/campaign', (target_date,), ['campaign'],
+                                lambda: self._stored_anomalies('campaign', target_date, get_campaign_anomalies_logic))
+        except Exception as e:
+            print(f"Anomaly Detection Error: {e}")
+            return []
+
+    def get_ewma_anomalies(self, entity_type: str, target_date: str = None):
+        """Statistical (EWMA / day-of-week) anomalies, cached per data version of the table and the EWMA state"""
+        table = anomaly_ewma.ENTITY_CONFIG[entity_type]['table']
+        try:
+            return self._cached(f'anomalies/{entity_type}/ewma', (target_date,), [table, 'anomaly_ewma_state'],
+                                lambda: get_ewma_anomalies_logic(entity_type, target_date))
+        except Exception as e:
+            print(f"EWMA Anomaly Detection Error ({entity_type}): {e}")
+            return {"error": str(e)}
+
+    def _stored_anomalies(self, entity_type: str, target_date: str, detector):
+        try:
+            return anomaly_store.get_anomaly_results(entity_type, target_date, detector)
+        except Exception as e:
+            print(f"Anomaly store error ({entity_type}): {e}")
+            return detector(target_date)
 
     def get_campaign_analyzable_date_range(self):
         """
@@ -1982,8 +2241,127 @@ class AgentService:
 
 
     def get_product_anomalies(self, target_date: str = None):
-        """Wrapper for product anomaly detection"""
-        return get_product_anomalies_logic(target_date)
+        """Cached per data version; misses are served from the precomputed anomaly_results table"""
+        try:
+            return self._cached('anomalies/product', (target_date,), ['product'],
+                                lambda: self._stored_anomalies('product', target_date, get_product_anomalies_logic))
+        except Exception as e:
+            print(f"Product Anomaly Detection Error: {e}")
+            return []
+
+    def stream_product_anomalies(self, target_date: str = None):
+        """
+        NDJSON lines for /api/anomalies/product?stream=true: anomalies are
+        emitted shard by shard while detection runs (highest-cost items first),
+        then one {"type": "summary"} record. A cached result is streamed directly.
+        """
+        started = time.time()
+        total, shards, source = 0, 0, "detection"
+        try:
+            found, cached = self.result_cache.get(self._cache_key('anomalies/product', (target_date,), ['product']))
+            if found:
+                source = "cache"
+                shards = 1
+                for anomaly in cached:
+                    yield json.dumps(anomaly, ensure_ascii=False) + "\n"
+                total = len(cached)
+            else:
+                conn = get_db_connection()
+                try:
+                    if not target_date:
+                        row = conn.execute("SELECT MAX(date) FROM product").fetchone()
+                        target_date = row[0] if row else None
+                    if target_date:
+                        for _, anomalies in iter_product_anomaly_shards(conn, target_date):
+                            shards += 1
+                            total += len(anomalies)
+                            yield "".join(json.dumps(a, ensure_ascii=False) + "\n" for a in anomalies)
+                finally:
+                    conn.close()
+        except Exception as e:
+            print(f"Product anomaly stream error: {e}")
+            yield json.dumps({"type": "error", "error": str(e)}, ensure_ascii=False) + "\n"
+
+        yield json.dumps({
+            "type": "summary",
+            "target_date": target_date,
+            "total": total,
+            "shards": shards,
+            "source": source,
+            "elapsed_ms": round((time.time() - started) * 1000, 1),
+        }, ensure_ascii=False) + "\n"
+
+    PRODUCT_ANOMALY_SORTS = {
+        'cost': lambda a: a.get('curr_cost') or 0.0,
+        'ctr_change': lambda a: _relative_change(a.get('curr_ctr'), a.get('prev_ctr')),
+        'cpc_change': lambda a: _relative_change(a.get('curr_cpa'), a.get('prev_cpa')),
+        'clicks': lambda a: a.get('curr_clicks') or 0.0,
+    }
+
+    def get_product_anomalies_page(self, target_date: str = None, limit: int = 100, cursor: str = None,
+                                   sort_by: str = 'cost', sort_dir: str = 'desc', title: str = None,
+                                   min_cost: float = None, reason: str = None):
+        """
+        Server-side filtered, sorted, cursor-paginated product anomalies.
+        Totals cover every matching row; only the requested page is returned.
+        """
+        sort_by = sort_by or 'cost'
+        if sort_by not in self.PRODUCT_ANOMALY_SORTS:
+            return {"error": f"Unsupported sort_by '{sort_by}'. Use one of: {', '.join(self.PRODUCT_ANOMALY_SORTS)}"}
+        limit = max(1, min(int(limit or 100), 1000))
+
+        anomalies = self.get_product_anomalies(target_date)
+        if title:
+            needle = title.lower()
+            anomalies = [a for a in anomalies if needle in str(a.get('title', '')).lower()]
+        if min_cost is not None:
+            anomalies = [a for a in anomalies if (a.get('curr_cost') or 0) >= min_cost]
+        if reason:
+            wanted = reason.lower()
+            anomalies = [a for a in anomalies if wanted in str(a.get('reason', '')).lower()]
+
+        try:
+            items, next_cursor = page_sorted(anomalies, self.PRODUCT_ANOMALY_SORTS[sort_by], 'id', limit,
+                                             cursor=cursor, descending=(sort_dir or 'desc').lower() != 'asc')
+        except (ValueError, TypeError) as e:
+            return {"error": str(e)}
+
+        reason_counts = {}
+        for a in anomalies:
+            for part in str(a.get('reason', '')).split(' & '):
+                if not part or part == 'No Growth':
+                    continue
+                kind = part.rsplit(' ', 1)[0] if part.endswith('%') else part  # "CTR -23%" -> "CTR"
+                reason_counts[kind] = reason_counts.get(kind, 0) + 1
+
+        return {
+            "items": items,
+            "next_cursor": next_cursor,
+            "total": len(anomalies),
+            "totals": {
+                "curr_cost": round(sum(a.get('curr_cost') or 0 for a in anomalies), 2),
+                "prev_cost": round(sum(a.get('prev_cost') or 0 for a in anomalies), 2),
+                "curr_clicks": sum(a.get('curr_clicks') or 0 for a in anomalies),
+                "prev_clicks": sum(a.get('prev_clicks') or 0 for a in anomalies),
+                "reasons": reason_counts,
+            },
+            "sort_by": sort_by,
+            "sort_dir": 'asc' if (sort_dir or '').lower() == 'asc' else 'desc',
+        }
+
+    def get_anomaly_history(self, start_date: str, end_date: str, entity_type: str = 'all', counts_only: bool = False):
+        """Anomalies per day over a date range (one pass), cached per data version"""
+        entity_types = ('campaign', 'product') if entity_type in (None, 'all') else (entity_type,)
+        if any(t not in ('campaign', 'product') for t in entity_types):
+            return {"error": f"Unknown entity_type '{entity_type}'"}
+        try:
+            history = self._cached('anomalies/history', (start_date, end_date, entity_types), list(entity_types),
+                                   lambda: get_anomaly_history_logic(start_date, end_date, entity_types))
+        except ValueError as e:
+            return {"error": str(e)}
+        if counts_only and 'days' in history:
+            return {**history, "days": [{k: v for k, v in day.items() if k not in entity_types} for day in history['days']]}
+        return history
 
     def get_product_analyzable_date_range(self):
         """
@@ -2020,26 +2398,156 @@ class AgentService:
             conn.close()
 
 
+    def backtest_anomaly_thresholds(self, entity_type: str = 'campaign', grid: Dict = None,
+                                    start_date: str = None, end_date: str = None, top: int = 20):
+        """Evaluate a grid of rule thresholds over every historical date (see anomaly_backtest)"""
+        if entity_type not in anomaly_backtest.ENTITY_CONFIG:
+            return {"error": f"Unknown entity_type: {entity_type}"}
+        try:
+            return self._cached('anomalies/backtest', (entity_type, json.dumps(grid, sort_keys=True), start_date, end_date, top),
+                                [anomaly_backtest.ENTITY_CONFIG[entity_type]['table']],
+                                lambda: anomaly_backtest.backtest_thresholds(entity_type, grid, start_date, end_date, top))
+        except Exception as e:
+            print(f"Backtest error: {e}")
+            return {"error": str(e)}
+
+    def get_campaign_root_cause(self, campaign_name: str, target_date: str = None):
+        """ROAS / CPA change of a campaign split into per-dimension-value contributions (see anomaly_rootcause)"""
+        try:
+            if not target_date:
+                rows = query_db("SELECT MAX(date) AS max_date FROM campaign")
+                target_date = rows[0]['max_date'] if rows else None
+            if not target_date:
+                return {"error": "No campaign data"}
+            tables = ['campaign'] + [d['table'] for d in ROOT_CAUSE_DIMENSIONS.values()]
+            return self._cached('campaigns/root-cause', (campaign_name, target_date), tables,
+                                lambda: explain_campaign_changes([campaign_name], target_date)[campaign_name])
+        except Exception as e:
+            print(f"Root cause error: {e}")
+            return {"error": str(e)}
+
+    def _kpi_rollup(self):
+        conn = get_db_connection()
+        try:
+            return kpi_summary.build_rollup(conn)
+        finally:
+            conn.close()
+
+    def get_kpi_summary(self, start_date: str = None, end_date: str = None):
+        """Account / campaign_type KPIs for a range vs the previous period (rollup cached per data version)"""
+        try:
+            rollup = self._cached('kpi/rollup', (), ['campaign'], self._kpi_rollup)
+            return kpi_summary.summarize(rollup, start_date, end_date)
+        except (ValueError, sqlite3.Error) as e:
+            return {"error": str(e)}
+
+    def precompute_anomalies(self, force: bool = False):
+        """
+        Batch job: store campaign and product anomalies for every analyzable date.
+        Dates whose underlying rows did not change since the last run are skipped.
+        The EWMA detector state is advanced to the latest day as well.
+        """
+        summary = {}
+        for entity_type, date_range, detector in (
+            ('campaign', self.get_campaign_analyzable_date_range(), get_campaign_anomalies_range_logic),
+            ('product', self.get_product_analyzable_date_range(), get_product_anomalies_range_logic),
+        ):
+            if not date_range.get('min_date') or not date_range.get('max_date'):
+                summary[entity_type] = {"entity_type": entity_type, "dates": 0, "recomputed": 0}
+                continue
+            try:
+                summary[entity_type] = anomaly_store.refresh_anomaly_results(
+                    entity_type, date_range['min_date'], date_range['max_date'], detector, force=force
+                )
+            except Exception as e:
+                print(f"Anomaly precompute error ({entity_type}): {e}")
+                summary[entity_type] = {"entity_type": entity_type, "error": str(e)}
+            try:
+                info = anomaly_ewma.advance_ewma_state(entity_type, date_range['max_date'])
+                summary[f"{entity_type}_ewma"] = {"date": info['as_of'], "days": info['days']}
+            except Exception as e:
+                print(f"EWMA state error ({entity_type}): {e}")
+                summary[f"{entity_type}_ewma"] = {"date": date_range['max_date'], "error": str(e)}
+        # No reader keys on anomaly_results' version: notify without bumping the data version
+        publish_data_event('anomalies', ['anomaly_results'], {"job": "precompute", "summary": summary}, bump=False)
+        return summary
+
+    def advance_anomaly_state(self, new_date: str = None, rebuild: bool = False):
+        """
+        Nightly incremental detection: advance the rolling per-campaign / per-item
+        state to `new_date` (default: latest imported day) and emit that day's anomalies.
+        """
+        summary = {}
+        for entity_type, date_range in (
+            ('campaign', self.get_campaign_analyzable_date_range()),
+            ('product', self.get_product_analyzable_date_range()),
+        ):
+            target = new_date or date_range.get('max_date')
+            if not target:
+                summary[entity_type] = {"date": None, "anomalies": 0}
+                continue
+            try:
+                anomalies = anomaly_state.advance_anomaly_state(entity_type, target, guard_campaign_risks, rebuild=rebuild)
+                summary[entity_type] = {"date": target, "anomalies": len(anomalies)}
+            except Exception as e:
+                print(f"Anomaly state error ({entity_type}): {e}")
+                summary[entity_type] = {"date": target, "error": str(e)}
+            try:
+                info = anomaly_ewma.advance_ewma_state(entity_type, target, rebuild=rebuild)
+                summary[f"{entity_type}_ewma"] = {"date": info['as_of'], "days": info['days']}
+            except Exception as e:
+                print(f"EWMA state error ({entity_type}): {e}")
+                summary[f"{entity_type}_ewma"] = {"date": target, "error": str(e)}
+        publish_data_event('anomalies', ['anomaly_state', 'anomaly_ewma_state'], {"job": "incremental", "summary": summary},
+                           bump=False)
+        return summary
+
+    PREFERENCE_UPSERT = """
+        INSERT INTO user_preferences (table_name, item_identifier, is_pinned, display_order)
+        VALUES (?1, ?2, COALESCE(?3, 0), COALESCE(?4, 0))
+        ON CONFLICT(table_name, item_identifier) DO UPDATE SET
+            is_pinned = COALESCE(?3, is_pinned),
+            display_order = COALESCE(?4, display_order)
+    """
+
     def update_preference(self, table_name: str, item_identifier: str, is_pinned: int = None, display_order: int = None):
+        return self.update_preferences_batch(table_name, items=[{
+            "item_identifier": item_identifier, "is_pinned": is_pinned, "display_order": display_order
+        }])
+
+    def update_preferences_batch(self, table_name: str, order: List[str] = None, pinned: List[str] = None,
+                                 items: List[Dict] = None):
+        """
+        Apply many preference changes for one table in a single transaction.
+        order: full display order (display_order = position in the list).
+        pinned: full pin set (every other item of the table is unpinned).
+        items: [{item_identifier, is_pinned, display_order}], None fields are left as they are;
+        applied last, so they override order / pinned for the same item.
+        """
+        changes = {}
+        for position, item_id in enumerate(order or []):
+            changes.setdefault(item_id, [None, None])[1] = position
+        for item_id in pinned or []:
+            changes.setdefault(item_id, [None, None])[0] = 1
+        for item in items or []:
+            change = changes.setdefault(item["item_identifier"], [None, None])
+            if item.get("is_pinned") is not None:
+                change[0] = item["is_pinned"]
+            if item.get("display_order") is not None:
+                change[1] = item["display_order"]
+
         conn = get_db_connection()
-        cursor = conn.cursor()
         try:
-            cursor.execute("SELECT * FROM user_preferences WHERE table_name=? AND item_identifier=?", (table_name, item_identifier))
-            exists = cursor.fetchone()
-            
-            if exists:
-                if is_pinned is not None:
-                    cursor.execute("UPDATE user_preferences SET is_pinned=? WHERE table_name=? AND item_identifier=?", (is_pinned, table_name, item_identifier))
-                if display_order is not None:
-                    cursor.execute("UPDATE user_preferences SET display_order=? WHERE table_name=? AND item_identifier=?", (display_order, table_name, item_identifier))
-            else:
-                pinned = is_pinned if is_pinned is not None else 0
-                order = display_order if display_order is not None else 0
-                cursor.execute("INSERT INTO user_preferences (table_name, item_identifier, is_pinned, display_order) VALUES (?, ?, ?, ?)", (table_name, item_identifier, pinned, order))
-            
-            conn.commit()
-            return {"status": "success"}
+            if pinned is not None:
+                conn.execute("UPDATE user_preferences SET is_pinned = 0 WHERE table_name = ? AND is_pinned != 0",
+                             (table_name,))
+            conn.executemany(self.PREFERENCE_UPSERT,
+                             [(table_name, item_id, p, o) for item_id, (p, o) in changes.items()])
+            # Pins change row order: invalidate ETags of table reads (commits the transaction)
+            bump_data_version(['user_preferences'], conn)
+            return {"status": "success", "updated": len(changes)}
         except Exception as e:
+            conn.rollback()
             return {"error": str(e)}
         finally:
             conn.close()
@@ -2049,78 +2557,93 @@ class AgentService:
         cursor = conn.cursor()
         try:
             cursor.execute("DELETE FROM user_preferences WHERE table_name=?", (table_name,))
-            conn.commit()
+            bump_data_version(['user_preferences'], conn)
             return {"status": "success"}
         except Exception as e:
             return {"error": str(e)}
         finally:
             conn.close()
 
-    def get_campaign_details(self, campaign_name: str, start_date: str = None, end_date: str = None):
-        """Get all related data for a specific campaign from all tables"""
-        tables = [
-            'search_term', 'channel', 'asset', 
-            'audience', 'age', 'gender', 
-            'location_by_cities_all_campaign', 'ad_schedule'
-        ]
-        
-        result = {}
-        conn = get_db_connection()
-        conn.row_factory = sqlite3.Row
+    def _campaign_detail_table(self, conn, table: str, campaign_name: str, start_date: str = None,
+                               end_date: str = None, fmt: str = None, limit: int = None, offset: int = 0) -> dict:
+        """One table of get_campaign_details; with limit also returns total / offset / limit"""
         cursor = conn.cursor()
-        
+        where_conditions = []
+        params = []
+
+        campaign_col = 'campaigns' if table == 'channel' else 'campaign'
+        where_conditions.append(f"{campaign_col} = ?")
+        params.append(campaign_name)
+
+        if start_date:
+            where_conditions.append("date >= ?")
+            params.append(start_date)
+        if end_date:
+            where_conditions.append("date <= ?")
+            params.append(end_date)
+
+        where_clause = " WHERE " + " AND ".join(where_conditions)
+        query = f"SELECT * FROM {table}{where_clause}"
+
+        # Check for sort column
+        if 'cost' in schema_catalog.table_columns(conn, table):
+            query += " ORDER BY date DESC, CAST(cost AS REAL) DESC"
+        else:
+            query += " ORDER BY date DESC"
+
+        page_info = {}
+        if limit is not None:
+            total = cursor.execute(f"SELECT COUNT(*) FROM {table}{where_clause}", tuple(params)).fetchone()[0]
+            query += ", rowid DESC LIMIT ? OFFSET ?"
+            params += [limit, offset]
+            page_info = {"total": total, "offset": offset, "limit": limit}
+
+        cursor.execute(query, tuple(params))
+        rows = cursor.fetchall()
+        columns = [description[0] for description in cursor.description] if rows else []
+
+        if fmt:
+            return columnar.table_payload(columns, rows, fmt, **page_info)
+        return {"columns": columns, "data": [dict(zip(columns, row)) for row in rows], **page_info}
+
+    def get_campaign_detail_table(self, campaign_name: str, table: str, start_date: str = None, end_date: str = None,
+                                  limit: int = 100, offset: int = 0, fmt: str = None):
+        """One related table of a campaign, paged with limit / offset (loaded lazily by the detail view)"""
+        if table not in CAMPAIGN_DETAIL_TABLES:
+            return {"error": f"Unknown detail table '{table}'. Use one of: {', '.join(CAMPAIGN_DETAIL_TABLES)}"}
+        limit = max(1, min(int(limit or 100), table_query.MAX_PAGE_SIZE))
+        offset = max(0, int(offset or 0))
         try:
-            for table in tables:
-                try:
-                    where_conditions = []
-                    params = []
-
-                    # 1. Campaign Filter (Skip for product)
-                    if table != 'product':
-                        campaign_col = 'campaign'
-                        if table == 'channel':
-                            campaign_col = 'campaigns'
-                        where_conditions.append(f"{campaign_col} = ?")
-                        params.append(campaign_name)
-                    
-                    # 2. Date Filter
-                    if start_date:
-                        where_conditions.append("date >= ?")
-                        params.append(start_date)
-                    if end_date:
-                        where_conditions.append("date <= ?")
-                        params.append(end_date)
-                    
-                    where_clause = " WHERE " + " AND ".join(where_conditions) if where_conditions else ""
-                    
-                    query = f"SELECT * FROM {table}{where_clause}"
-                    
-                    # Check for sort column
-                    check_query = f"PRAGMA table_info({table})"
-                    cursor.execute(check_query)
-                    cols = [info[1] for info in cursor.fetchall()]
-                    
-                    if 'cost' in cols:
-                        query += " ORDER BY date DESC, CAST(cost AS REAL) DESC"
-                    else:
-                        query += " ORDER BY date DESC"
-                    
-                    cursor.execute(query, tuple(params))
-                    
-                    rows = cursor.fetchall()
-                    
-                    if rows:
-                        columns = [description[0] for description in cursor.description]
-                        data = [dict(row) for row in rows]
-                        result[table] = {"columns": columns, "data": data}
-                    else:
-                        result[table] = {"columns": [], "data": []}
-                except Exception as e:
-                    result[table] = {"error": str(e), "columns": [], "data": []}
-            
-            return result
-        finally:
-            conn.close()
+            with read_pool.connection() as conn:
+                return self._campaign_detail_table(conn, table, campaign_name, start_date, end_date, fmt, limit, offset)
+        except Exception as e:
+            return {"error": str(e), "columns": [], "data": []}
+
+    def get_campaign_details(self, campaign_name: str, start_date: str = None, end_date: str = None, fmt: str = None,
+                             tables: List[str] = None, limit: int = None, offset: int = 0):
+        """
+        Related data for a campaign from every detail table (or only `tables`),
+        keyed by table name (fmt: see get_table_data). The tables are read
+        concurrently, each on its own pooled connection; limit / offset page
+        every table the same way.
+        """
+        tables = tables or CAMPAIGN_DETAIL_TABLES
+        unknown = [t for t in tables if t not in CAMPAIGN_DETAIL_TABLES]
+        if unknown:
+            return {"error": f"Unknown detail tables: {', '.join(unknown)}"}
+        if limit is not None:
+            limit = max(1, min(int(limit), table_query.MAX_PAGE_SIZE))
+            offset = max(0, int(offset or 0))
+
+        def fetch(table):
+            try:
+                with read_pool.connection() as conn:
+                    return self._campaign_detail_table(conn, table, campaign_name, start_date, end_date,
+                                                       fmt, limit, offset)
+            except Exception as e:
+                return {"error": str(e), "columns": [], "data": []}
+
+        return dict(zip(tables, detail_executor.map(fetch, tables)))
 
     def get_campaign_anomaly_details(self, campaign_name: str, start_date: str = None, end_date: str = None):
         """
@@ -2410,151 +2933,169 @@ class AgentService:
             
             # 3. Audience - 只返回高消耗零转化受众 (仅异常行)
             # =========================================================================
-            try:
-                query = f"""
-                    SELECT * FROM audience 
-                    WHERE campaign = ? {date_filter}
-                    AND CAST(cost AS REAL) > 1 AND CAST(conversions AS REAL) = 0
-                    ORDER BY CAST(cost AS REAL) DESC
-                    LIMIT 30
-                """
-                cursor.execute(query, (campaign_name, *date_params))
-                rows = cursor.fetchall()
-                if rows:
-                    columns = [d[0] for d in cursor.description]
-                    result['audience'] = {
-                        "columns": columns, 
-                        "data": [dict(r) for r in rows], 
-                        "rule": "Cost>$1 且 Conv=0",
-                        "anomaly_count": len(rows)
-                    }
-                else:
-                    result['audience'] = {"columns": [], "data": [], "rule": "无异常", "anomaly_count": 0}
-            except:
+            if not schema_catalog.table_exists(conn, 'audience'):
                 result['audience'] = {"columns": [], "data": [], "rule": "表不存在", "anomaly_count": 0}
+            else:
+                try:
+                    query = f"""
+                        SELECT * FROM audience 
+                        WHERE campaign = ? {date_filter}
+                        AND CAST(cost AS REAL) > 1 AND CAST(conversions AS REAL) = 0
+                        ORDER BY CAST(cost AS REAL) DESC
+                        LIMIT 30
+                    """
+                    cursor.execute(query, (campaign_name, *date_params))
+                    rows = cursor.fetchall()
+                    if rows:
+                        columns = [d[0] for d in cursor.description]
+                        result['audience'] = {
+                            "columns": columns, 
+                            "data": [dict(r) for r in rows], 
+                            "rule": "Cost>$1 且 Conv=0",
+                            "anomaly_count": len(rows)
+                        }
+                    else:
+                        result['audience'] = {"columns": [], "data": [], "rule": "无异常", "anomaly_count": 0}
+                except Exception as e:
+                    result['audience'] = {"columns": [], "data": [], "rule": f"查询错误: {str(e)}", "anomaly_count": 0}
             
             # 4. Location - 只返回预算黑洞 (仅异常行)
             # =========================================================================
-            try:
-                query = f"""
-                    SELECT * FROM location_by_cities_all_campaign 
-                    WHERE campaign = ? {date_filter}
-                    AND CAST(cost AS REAL) > 1 AND CAST(conversions AS REAL) = 0
-                    ORDER BY CAST(cost AS REAL) DESC
-                    LIMIT 30
-                """
-                cursor.execute(query, (campaign_name, *date_params))
-                rows = cursor.fetchall()
-                if rows:
-                    columns = [d[0] for d in cursor.description]
-                    result['location_by_cities_all_campaign'] = {
-                        "columns": columns, 
-                        "data": [dict(r) for r in rows], 
-                        "rule": "预算黑洞",
-                        "anomaly_count": len(rows)
-                    }
-                else:
-                    result['location_by_cities_all_campaign'] = {"columns": [], "data": [], "rule": "无异常", "anomaly_count": 0}
-            except:
+            if not schema_catalog.table_exists(conn, 'location_by_cities_all_campaign'):
                 result['location_by_cities_all_campaign'] = {"columns": [], "data": [], "rule": "表不存在", "anomaly_count": 0}
+            else:
+                try:
+                    query = f"""
+                        SELECT * FROM location_by_cities_all_campaign 
+                        WHERE campaign = ? {date_filter}
+                        AND CAST(cost AS REAL) > 1 AND CAST(conversions AS REAL) = 0
+                        ORDER BY CAST(cost AS REAL) DESC
+                        LIMIT 30
+                    """
+                    cursor.execute(query, (campaign_name, *date_params))
+                    rows = cursor.fetchall()
+                    if rows:
+                        columns = [d[0] for d in cursor.description]
+                        result['location_by_cities_all_campaign'] = {
+                            "columns": columns, 
+                            "data": [dict(r) for r in rows], 
+                            "rule": "预算黑洞",
+                            "anomaly_count": len(rows)
+                        }
+                    else:
+                        result['location_by_cities_all_campaign'] = {"columns": [], "data": [], "rule": "无异常", "anomaly_count": 0}
+                except Exception as e:
+                    result['location_by_cities_all_campaign'] = {"columns": [], "data": [], "rule": f"查询错误: {str(e)}", "anomaly_count": 0}
             
             # 5. Age - 只返回低效年龄段 (仅异常行)
             # =========================================================================
-            try:
-                query = f"""
-                    SELECT * FROM age 
-                    WHERE campaign = ? {date_filter}
-                    AND CAST(cost AS REAL) > 1 AND CAST(conversions AS REAL) = 0
-                    ORDER BY CAST(cost AS REAL) DESC
-                """
-                cursor.execute(query, (campaign_name, *date_params))
-                rows = cursor.fetchall()
-                if rows:
-                    columns = [d[0] for d in cursor.description]
-                    result['age'] = {
-                        "columns": columns, 
-                        "data": [dict(r) for r in rows], 
-                        "rule": "Cost>$1 且 Conv=0",
-                        "anomaly_count": len(rows)
-                    }
-                else:
-                    result['age'] = {"columns": [], "data": [], "rule": "无异常", "anomaly_count": 0}
-            except:
+            if not schema_catalog.table_exists(conn, 'age'):
                 result['age'] = {"columns": [], "data": [], "rule": "表不存在", "anomaly_count": 0}
+            else:
+                try:
+                    query = f"""
+                        SELECT * FROM age 
+                        WHERE campaign = ? {date_filter}
+                        AND CAST(cost AS REAL) > 1 AND CAST(conversions AS REAL) = 0
+                        ORDER BY CAST(cost AS REAL) DESC
+                    """
+                    cursor.execute(query, (campaign_name, *date_params))
+                    rows = cursor.fetchall()
+                    if rows:
+                        columns = [d[0] for d in cursor.description]
+                        result['age'] = {
+                            "columns": columns, 
+                            "data": [dict(r) for r in rows], 
+                            "rule": "Cost>$1 且 Conv=0",
+                            "anomaly_count": len(rows)
+                        }
+                    else:
+                        result['age'] = {"columns": [], "data": [], "rule": "无异常", "anomaly_count": 0}
+                except Exception as e:
+                    result['age'] = {"columns": [], "data": [], "rule": f"查询错误: {str(e)}", "anomaly_count": 0}
             
             # 6. Gender - 只返回低效性别 (仅异常行)
             # =========================================================================
-            try:
-                query = f"""
-                    SELECT * FROM gender 
-                    WHERE campaign = ? {date_filter}
-                    AND CAST(cost AS REAL) > 1 AND CAST(conversions AS REAL) = 0
-                    ORDER BY CAST(cost AS REAL) DESC
-                """
-                cursor.execute(query, (campaign_name, *date_params))
-                rows = cursor.fetchall()
-                if rows:
-                    columns = [d[0] for d in cursor.description]
-                    result['gender'] = {
-                        "columns": columns, 
-                        "data": [dict(r) for r in rows], 
-                        "rule": "Cost>$1 且 Conv=0",
-                        "anomaly_count": len(rows)
-                    }
-                else:
-                    result['gender'] = {"columns": [], "data": [], "rule": "无异常", "anomaly_count": 0}
-            except:
+            if not schema_catalog.table_exists(conn, 'gender'):
                 result['gender'] = {"columns": [], "data": [], "rule": "表不存在", "anomaly_count": 0}
+            else:
+                try:
+                    query = f"""
+                        SELECT * FROM gender 
+                        WHERE campaign = ? {date_filter}
+                        AND CAST(cost AS REAL) > 1 AND CAST(conversions AS REAL) = 0
+                        ORDER BY CAST(cost AS REAL) DESC
+                    """
+                    cursor.execute(query, (campaign_name, *date_params))
+                    rows = cursor.fetchall()
+                    if rows:
+                        columns = [d[0] for d in cursor.description]
+                        result['gender'] = {
+                            "columns": columns, 
+                            "data": [dict(r) for r in rows], 
+                            "rule": "Cost>$1 且 Conv=0",
+                            "anomaly_count": len(rows)
+                        }
+                    else:
+                        result['gender'] = {"columns": [], "data": [], "rule": "无异常", "anomaly_count": 0}
+                except Exception as e:
+                    result['gender'] = {"columns": [], "data": [], "rule": f"查询错误: {str(e)}", "anomaly_count": 0}
             
             # 7. Ad Schedule - 只返回低效时段 (仅异常行)
             # =========================================================================
-            try:
-                query = f"""
-                    SELECT * FROM ad_schedule 
-                    WHERE campaign = ? {date_filter}
-                    AND CAST(cost AS REAL) > 1 AND CAST(conversions AS REAL) = 0
-                    ORDER BY CAST(cost AS REAL) DESC
-                    LIMIT 30
-                """
-                cursor.execute(query, (campaign_name, *date_params))
-                rows = cursor.fetchall()
-                if rows:
-                    columns = [d[0] for d in cursor.description]
-                    result['ad_schedule'] = {
-                        "columns": columns, 
-                        "data": [dict(r) for r in rows], 
-                        "rule": "低效时段",
-                        "anomaly_count": len(rows)
-                    }
-                else:
-                    result['ad_schedule'] = {"columns": [], "data": [], "rule": "无异常", "anomaly_count": 0}
-            except:
+            if not schema_catalog.table_exists(conn, 'ad_schedule'):
                 result['ad_schedule'] = {"columns": [], "data": [], "rule": "表不存在", "anomaly_count": 0}
+            else:
+                try:
+                    query = f"""
+                        SELECT * FROM ad_schedule 
+                        WHERE campaign = ? {date_filter}
+                        AND CAST(cost AS REAL) > 1 AND CAST(conversions AS REAL) = 0
+                        ORDER BY CAST(cost AS REAL) DESC
+                        LIMIT 30
+                    """
+                    cursor.execute(query, (campaign_name, *date_params))
+                    rows = cursor.fetchall()
+                    if rows:
+                        columns = [d[0] for d in cursor.description]
+                        result['ad_schedule'] = {
+                            "columns": columns, 
+                            "data": [dict(r) for r in rows], 
+                            "rule": "低效时段",
+                            "anomaly_count": len(rows)
+                        }
+                    else:
+                        result['ad_schedule'] = {"columns": [], "data": [], "rule": "无异常", "anomaly_count": 0}
+                except Exception as e:
+                    result['ad_schedule'] = {"columns": [], "data": [], "rule": f"查询错误: {str(e)}", "anomaly_count": 0}
             
             # 8. Asset - 只返回低效素材 (仅异常行)
             # =========================================================================
-            try:
-                query = f"""
-                    SELECT * FROM asset 
-                    WHERE campaign = ? {date_filter}
-                    AND CAST(cost AS REAL) > 1 AND CAST(conversions AS REAL) = 0
-                    ORDER BY CAST(cost AS REAL) DESC
-                    LIMIT 30
-                """
-                cursor.execute(query, (campaign_name, *date_params))
-                rows = cursor.fetchall()
-                if rows:
-                    columns = [d[0] for d in cursor.description]
-                    result['asset'] = {
-                        "columns": columns, 
-                        "data": [dict(r) for r in rows], 
-                        "rule": "低效素材",
-                        "anomaly_count": len(rows)
-                    }
-                else:
-                    result['asset'] = {"columns": [], "data": [], "rule": "无异常", "anomaly_count": 0}
-            except:
+            if not schema_catalog.table_exists(conn, 'asset'):
                 result['asset'] = {"columns": [], "data": [], "rule": "表不存在", "anomaly_count": 0}
+            else:
+                try:
+                    query = f"""
+                        SELECT * FROM asset 
+                        WHERE campaign = ? {date_filter}
+                        AND CAST(cost AS REAL) > 1 AND CAST(conversions AS REAL) = 0
+                        ORDER BY CAST(cost AS REAL) DESC
+                        LIMIT 30
+                    """
+                    cursor.execute(query, (campaign_name, *date_params))
+                    rows = cursor.fetchall()
+                    if rows:
+                        columns = [d[0] for d in cursor.description]
+                        result['asset'] = {
+                            "columns": columns, 
+                            "data": [dict(r) for r in rows], 
+                            "rule": "低效素材",
+                            "anomaly_count": len(rows)
+                        }
+                    else:
+                        result['asset'] = {"columns": [], "data": [], "rule": "无异常", "anomaly_count": 0}
+                except Exception as e:
+                    result['asset'] = {"columns": [], "data": [], "rule": f"查询错误: {str(e)}", "anomaly_count": 0}
             
             return result
         finally:
@@ -2602,6 +3143,7 @@ class AgentService:
                 """, (table_name, rule_prompt))
             
             conn.commit()
+            publish_data_event('rules', ['agent_custom_rules'], {"table_name": table_name}, bump=False)
             return {"status": "success", "message": "Custom rule saved"}
         except Exception as e:
             return {"status": "error", "message": str(e)}
@@ -2817,6 +3359,7 @@ class AgentService:
                     page.get('meta_title', ''),
                     page.get('meta_description', '')
                 ))
+            bump_data_version(['seo_pages'], conn, commit=False)
             
             conn.commit()
             conn.close()
@@ -0,0 +1,179 @@
+"""
+Threshold backtesting.
+
+Evaluates a grid of rule settings (down / up ratios, consecutive check days,
+baseline window) over every historical date in one sweep: the history is
+pivoted into a single DayMatrix and each setting is compiled with
+anomaly_rules and evaluated for all entities × all dates at once. Window sums
+are memoised, so settings sharing a window (e.g. only the ratios differ) reuse
+the same arrays.
+
+ContextGuard is not applied: the counts describe when the rules fire.
+"""
+import copy
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from anomaly_engine import (
+    DayMatrix, build_day_matrix, load_campaign_frame, load_product_frame,
+    CAMPAIGN_METRICS, PRODUCT_METRICS, LOOKBACK_DAYS,
+)
+from anomaly_rules import compile_rules, CAMPAIGN_RULES, PRODUCT_RULES
+from ads_db import get_db_connection
+
+MAX_GRID_SIZE = 256
+
+ENTITY_CONFIG = {
+    'campaign': {'key': 'campaign', 'table': 'campaign', 'spec': CAMPAIGN_RULES, 'metrics': CAMPAIGN_METRICS, 'loader': load_campaign_frame},
+    'product': {'key': 'item_id', 'table': 'product', 'spec': PRODUCT_RULES, 'metrics': PRODUCT_METRICS, 'loader': load_product_frame},
+}
+
+
+class _MemoDayMatrix(DayMatrix):
+    """DayMatrix whose window reductions are computed once per (metric, window, days)."""
+
+    def __init__(self, mat: DayMatrix):
+        super().__init__(mat.entities, mat.start, mat.counts, mat.sums, mat.first, mat.labels)
+        self._memo = {}
+
+    def _cached(self, name, args, t_idx, compute):
+        t_idx = np.atleast_1d(np.asarray(t_idx))
+        key = (name, args, t_idx.tobytes())
+        if key not in self._memo:
+            self._memo[key] = compute(t_idx)
+        return self._memo[key]
+
+    def window_sum(self, metric, t_idx, lo, hi):
+        return self._cached('sum', (metric, lo, hi), t_idx, lambda t: DayMatrix.window_sum(self, metric, t, lo, hi))
+
+    def window_count(self, t_idx, lo, hi):
+        return self._cached('count', (lo, hi), t_idx, lambda t: DayMatrix.window_count(self, t, lo, hi))
+
+    def rows_in_range(self, t_idx, lo, hi):
+        return self._cached('rows', (lo, hi), t_idx, lambda t: DayMatrix.rows_in_range(self, t, lo, hi))
+
+    def first_values(self, metric, t_idx):
+        return self._cached('first', (metric,), t_idx, lambda t: DayMatrix.first_values(self, metric, t))
+
+    def clear(self):
+        self._memo.clear()
+
+
+def _setting_spec(base: dict, setting: dict) -> dict:
+    spec = copy.deepcopy(base)
+    efficiency = spec['efficiency']
+    for cond in efficiency['any']:
+        if cond['direction'] == 'down' and setting.get('ratio_down') is not None:
+            cond['ratio'] = setting['ratio_down']
+        if cond['direction'] == 'up' and setting.get('ratio_up') is not None:
+            cond['ratio'] = setting['ratio_up']
+    if setting.get('consecutive_days') is not None:
+        efficiency['consecutive_days'] = setting['consecutive_days']
+    if setting.get('baseline_days') is not None:
+        efficiency['baseline_days'] = setting['baseline_days']
+    return spec
+
+
+def _current_setting(spec: dict) -> dict:
+    conds = spec['efficiency']['any']
+    return {
+        'ratio_down': next((c['ratio'] for c in conds if c['direction'] == 'down'), None),
+        'ratio_up': next((c['ratio'] for c in conds if c['direction'] == 'up'), None),
+        'consecutive_days': spec['efficiency']['consecutive_days'],
+        'baseline_days': spec['efficiency']['baseline_days'],
+    }
+
+
+def expand_grid(grid: dict, base_spec: dict) -> list:
+    """{param: [values]} -> list of settings; missing params keep the current value."""
+    current = _current_setting(base_spec)
+    axes = {k: list(grid.get(k) or [v]) for k, v in current.items()}
+    settings = [dict(zip(axes, combo)) for combo in itertools.product(*axes.values())]
+    if len(settings) > MAX_GRID_SIZE:
+        raise ValueError(f"Grid too large ({len(settings)} settings, max {MAX_GRID_SIZE})")
+    return settings
+
+
+def backtest_thresholds(entity_type: str = 'campaign', grid: dict = None, start_date: str = None,
+                        end_date: str = None, top: int = 20) -> dict:
+    """
+    Alert counts of every grid setting for every date in [start_date, end_date]
+    (default: full history), their overlap with the current setting and the
+    hit rates (alerts / analyzable days) of the `top` most-flagged entities.
+    """
+    config = ENTITY_CONFIG[entity_type]
+    base_spec = config['spec']
+    settings = expand_grid(grid or {}, base_spec)
+
+    conn = get_db_connection()
+    try:
+        first_date, last_date = conn.execute(f"SELECT MIN(date), MAX(date) FROM {config['table']}").fetchone()
+        if not first_date:
+            return {"entity_type": entity_type, "dates": 0, "settings": []}
+        start_dt = pd.Timestamp(start_date or first_date)
+        end_dt = pd.Timestamp(end_date or last_date)
+        load_start = start_dt - pd.Timedelta(days=LOOKBACK_DAYS)
+        df = config['loader'](conn, load_start.strftime('%Y-%m-%d'), end_dt.strftime('%Y-%m-%d'))
+    finally:
+        conn.close()
+
+    mat = _MemoDayMatrix(build_day_matrix(df, config['key'], config['metrics'], load_start, end_dt))
+    t_idx = np.arange(mat.day_index(start_dt), mat.day_index(end_dt) + 1)
+    n_dates = len(t_idx)
+    if len(mat.entities) == 0 or n_dates <= 0:
+        return {"entity_type": entity_type, "dates": max(n_dates, 0), "settings": []}
+
+    current_flags = compile_rules(base_spec).evaluate(mat, t_idx, LOOKBACK_DAYS)[0]
+    current_total = int(current_flags.sum())
+    results = [None] * len(settings)
+    # Settings sharing windows run back to back; the memo is dropped when the windows change
+    order = sorted(range(len(settings)), key=lambda i: (settings[i]['consecutive_days'], settings[i]['baseline_days']))
+    windows = None
+    for i in order:
+        setting = settings[i]
+        if windows != (setting['consecutive_days'], setting['baseline_days']):
+            windows = (setting['consecutive_days'], setting['baseline_days'])
+            mat.clear()
+        rules = compile_rules(_setting_spec(base_spec, setting))
+        flags = rules.evaluate(mat, t_idx, LOOKBACK_DAYS)[0]
+        # Analyzable = enough rows in the lookback window (the rule's first condition)
+        eligible = mat.rows_in_range(t_idx, -LOOKBACK_DAYS, 0) >= rules.min_rows
+        hits = flags.sum(axis=1)
+        days = eligible.sum(axis=1)
+        both = int((flags & current_flags).sum())
+        total = int(flags.sum())
+        union = total + current_total - both
+
+        ranked = np.argsort(-hits, kind='stable')[:top]
+        results[i] = {
+            "setting": setting,
+            "is_current": setting == _current_setting(base_spec),
+            "alerts": total,
+            "alerts_per_day": round(total / n_dates, 3),
+            "alert_days": int(flags.any(axis=0).sum()),
+            "entities_flagged": int((hits > 0).sum()),
+            "overlap": {
+                "both": both,
+                "only_setting": total - both,
+                "only_current": current_total - both,
+                "jaccard": round(both / union, 4) if union else 1.0,
+            },
+            "daily_alerts": [int(c) for c in flags.sum(axis=0)],
+            "top_entities": [
+                {"id": str(mat.entities[e]), "hits": int(hits[e]), "days": int(days[e]),
+                 "hit_rate": round(float(hits[e] / days[e]), 4) if days[e] else 0.0}
+                for e in ranked if hits[e] > 0
+            ],
+        }
+
+    return {
+        "entity_type": entity_type,
+        "start_date": start_dt.strftime('%Y-%m-%d'),
+        "end_date": end_dt.strftime('%Y-%m-%d'),
+        "dates": n_dates,
+        "entities": len(mat.entities),
+        "current_alerts": current_total,
+        "settings": results,
+    }
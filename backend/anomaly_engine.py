@@ -0,0 +1,500 @@
+"""
+Vectorized anomaly detection engine.
+
+The rule-based monitors used to loop over every campaign / item group and
+re-filter that group's DataFrame once per check day. Here the raw rows are
+pivoted once into dense (entity × day) NumPy matrices and the 3-day efficiency
+rule plus the no-growth rule are evaluated for all entities in a few array
+passes.
+
+Semantics intentionally mirror the original per-group loops:
+- "current" value of a day = first row of that (entity, day) cell
+- window averages = sum of rows / number of rows (days without rows are skipped)
+- an entity needs >= min_rows rows inside the loaded window to be analyzed
+
+The rules themselves (thresholds, windows, metrics) are declared in
+anomaly_rules.py and compiled once at import.
+"""
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from anomaly_rules import compile_rules, CAMPAIGN_RULES, PRODUCT_RULES
+
+# --- Window constants (the rule thresholds live in anomaly_rules.py) ---
+LOOKBACK_DAYS = 45          # SQL window: date >= date(T, '-45 days')
+
+CAMPAIGN = compile_rules(CAMPAIGN_RULES)
+PRODUCT = compile_rules(PRODUCT_RULES)
+
+
+class DayMatrix:
+    """
+    Dense per-entity daily aggregates.
+
+    counts[e, d]         number of raw rows for entity e on day d
+    sums[metric][e, d]   sum of the metric over those rows
+    first[metric][e, d]  value of the first row (0 when the cell is empty)
+    labels[name][e, d]   optional text column (first or last row of the cell)
+    Day index 0 corresponds to `start`.
+    """
+
+    def __init__(self, entities, start, counts, sums, first, labels=None):
+        self.entities = entities
+        self.start = start
+        self.counts = counts
+        self.sums = sums
+        self.first = first
+        self.labels = labels or {}
+
+    @property
+    def n_days(self):
+        return self.counts.shape[1]
+
+    def day_index(self, date) -> int:
+        return int((pd.Timestamp(date) - self.start).days)
+
+    def date_at(self, idx: int) -> str:
+        return (self.start + pd.Timedelta(days=int(idx))).strftime('%Y-%m-%d')
+
+    def window_sum(self, metric: str, t_idx, lo: int, hi: int):
+        """Sum of `metric` over days [t+lo, t+hi] for every entity and every t in t_idx."""
+        return _window_reduce(self.sums[metric], t_idx, lo, hi)
+
+    def window_count(self, t_idx, lo: int, hi: int):
+        return _window_reduce(self.counts, t_idx, lo, hi)
+
+    def window_mean(self, metric: str, t_idx, lo: int, hi: int):
+        """Row-weighted mean over the window; NaN where the window has no rows."""
+        total = self.window_sum(metric, t_idx, lo, hi)
+        n = self.window_count(t_idx, lo, hi)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(n > 0, total / np.maximum(n, 1), np.nan)
+
+    def first_values(self, metric: str, t_idx):
+        """First-row value of `metric` on each day in t_idx (0 where the cell is empty)."""
+        return _take(self.first[metric], t_idx)
+
+    def window_label(self, name: str, e: int, t: int, lo: int, hi: int, pick: str, default=None):
+        """Label of the first / last non-empty day of entity e in [t+lo, t+hi]."""
+        a = max(0, t + lo)
+        days = np.flatnonzero(self.counts[e, a:t + hi + 1] > 0)
+        if len(days) == 0 or name not in self.labels:
+            return default
+        d = a + (days[0] if pick == 'first' else days[-1])
+        return self.labels[name][e, d]
+
+    def rows_in_range(self, t_idx, lo: int, hi: int):
+        """Row counts over a (possibly long) window using integer prefix sums."""
+        cs = np.concatenate([np.zeros((self.counts.shape[0], 1), dtype=np.int64),
+                             np.cumsum(self.counts, axis=1, dtype=np.int64)], axis=1)
+        t_idx = np.atleast_1d(np.asarray(t_idx))
+        a = np.clip(t_idx + lo, 0, self.n_days)
+        b = np.clip(t_idx + hi + 1, 0, self.n_days)
+        return cs[:, b] - cs[:, a]
+
+
+def _window_reduce(mat, t_idx, lo: int, hi: int):
+    """
+    Add columns t+lo .. t+hi in ascending day order.
+    Summing column by column (instead of cumsum differences) keeps the float
+    results identical to pandas' sequential sum over the same rows.
+    """
+    t_idx = np.atleast_1d(np.asarray(t_idx))
+    n_days = mat.shape[1]
+    acc = np.zeros((mat.shape[0], len(t_idx)), dtype=mat.dtype)
+    for k in range(lo, hi + 1):
+        cols = t_idx + k
+        valid = (cols >= 0) & (cols < n_days)
+        if valid.all():
+            acc = acc + mat[:, cols]
+        elif valid.any():
+            acc[:, valid] = acc[:, valid] + mat[:, cols[valid]]
+    return acc
+
+
+def build_day_matrix(df: pd.DataFrame, key_col: str, metrics: list, start, end, labels: dict = None) -> DayMatrix:
+    """
+    Pivot raw rows (one per entity/date, duplicates allowed) into a DayMatrix.
+    `df['date']` must already be datetime64. Entities are sorted like
+    DataFrame.groupby(key_col) so output order matches the old loop.
+    labels: {column: 'first' | 'last'} text columns to keep per cell.
+    """
+    start = pd.Timestamp(start)
+    n_days = int((pd.Timestamp(end) - start).days) + 1
+
+    codes, entities = pd.factorize(df[key_col], sort=True)
+    day = (df['date'] - start).dt.days.to_numpy()
+    valid = (codes >= 0) & (day >= 0) & (day < n_days)
+    codes = codes[valid]
+    day = day[valid]
+
+    n_ent = len(entities)
+    size = n_ent * n_days
+    flat = codes.astype(np.int64) * n_days + day
+
+    counts = np.bincount(flat, minlength=size).reshape(n_ent, n_days)
+    # First occurrence of each cell, in the frame's existing (entity, date) order
+    cells, first_pos = np.unique(flat, return_index=True)
+
+    sums, first = {}, {}
+    for m in metrics:
+        values = df[m].to_numpy(dtype=np.float64)[valid]
+        sums[m] = np.bincount(flat, weights=values, minlength=size).reshape(n_ent, n_days)
+        f = np.zeros(size, dtype=np.float64)
+        f[cells] = values[first_pos]
+        first[m] = f.reshape(n_ent, n_days)
+
+    label_mats = {}
+    if labels:
+        # Last occurrence of each cell = first occurrence in the reversed order
+        _, rev_pos = np.unique(flat[::-1], return_index=True)
+        last_pos = len(flat) - 1 - rev_pos
+        for col, pick in labels.items():
+            if col not in df.columns:
+                continue
+            values = df[col].to_numpy(dtype=object)[valid]
+            lm = np.empty(size, dtype=object)
+            lm[cells] = values[first_pos if pick == 'first' else last_pos]
+            label_mats[col] = lm.reshape(n_ent, n_days)
+
+    return DayMatrix(entities, start, counts, sums, first, label_mats)
+
+
+def _take(mat, cols):
+    cols = np.atleast_1d(np.asarray(cols))
+    out = np.zeros((mat.shape[0], len(cols)), dtype=mat.dtype)
+    valid = (cols >= 0) & (cols < mat.shape[1])
+    out[:, valid] = mat[:, cols[valid]]
+    return out
+
+
+def _nan_to_zero(v) -> float:
+    return 0.0 if pd.isna(v) else float(v)
+
+
+# =============================================================================
+# Loading
+# =============================================================================
+
+# Rule metrics plus the ones only shown in the output
+CAMPAIGN_METRICS = list(dict.fromkeys(['roas', 'cpa', 'conversions'] + CAMPAIGN.metrics))
+PRODUCT_METRICS = list(dict.fromkeys(['ctr', 'avg_cpc', 'clicks', 'cost'] + PRODUCT.metrics))
+
+
+def load_campaign_frame(conn, start_date: str, end_date: str) -> pd.DataFrame:
+    """Campaign rows in [start_date, end_date], cleaned for detection."""
+    query = """
+        SELECT date, campaign, roas, cpa, conversions, budget, campaign_type
+        FROM campaign
+        WHERE date <= ? AND date >= ?
+        ORDER BY campaign, date ASC
+    """
+    df = pd.read_sql_query(query, conn, params=(end_date, start_date))
+    df['date'] = pd.to_datetime(df['date'])
+    df['roas'] = pd.to_numeric(df['roas'], errors='coerce').fillna(0)
+    df['cpa'] = pd.to_numeric(df['cpa'], errors='coerce').fillna(0)
+    df['conversions'] = pd.to_numeric(df['conversions'], errors='coerce').fillna(0)
+    return df
+
+
+def item_shard(item_id, n_shards: int) -> int:
+    """Stable shard of an item_id (same value in every process, unlike hash())."""
+    return zlib.crc32(str(item_id).encode('utf-8')) % n_shards
+
+
+def load_product_frame(conn, start_date: str, end_date: str, item_ids: list = None) -> pd.DataFrame:
+    """
+    Product rows in [start_date, end_date], with '$' / '%' / ',' stripped from metrics.
+    item_ids keeps only the listed items (staged in a temp table, no variable limit).
+    """
+    query = """
+        SELECT date, title, item_id, cost, clicks, impr, ctr, avg_cpc
+        FROM product
+        WHERE date <= ? AND date >= ?{shard_filter}
+        ORDER BY item_id, date ASC
+    """
+    params = [end_date, start_date]
+    shard_filter = ""
+    if item_ids is not None:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS _anomaly_items (item_id PRIMARY KEY)")
+        conn.execute("DELETE FROM _anomaly_items")
+        conn.executemany("INSERT OR IGNORE INTO _anomaly_items (item_id) VALUES (?)", [(i,) for i in item_ids])
+        shard_filter += " AND item_id IN (SELECT item_id FROM temp._anomaly_items)"
+    df = pd.read_sql_query(query.format(shard_filter=shard_filter), conn, params=params)
+    df['date'] = pd.to_datetime(df['date'])
+    df['cost'] = pd.to_numeric(df['cost'].astype(str).str.replace('$', '').str.replace(',', ''), errors='coerce').fillna(0)
+    df['clicks'] = pd.to_numeric(df['clicks'], errors='coerce').fillna(0)
+    df['impr'] = pd.to_numeric(df['impr'], errors='coerce').fillna(0)
+    df['ctr'] = pd.to_numeric(df['ctr'].astype(str).str.replace('%', ''), errors='coerce').fillna(0)
+    df['avg_cpc'] = pd.to_numeric(df['avg_cpc'].astype(str).str.replace('$', '').str.replace(',', ''), errors='coerce').fillna(0)
+    return df
+
+
+def window_start(target_date) -> str:
+    return (pd.Timestamp(target_date) - pd.Timedelta(days=LOOKBACK_DAYS)).strftime('%Y-%m-%d')
+
+
+# =============================================================================
+# Evaluation (any number of target days in one pass)
+# =============================================================================
+
+def scan_matrix(mat: DayMatrix, t_idx, rules):
+    """
+    Apply the compiled rules (row count, consecutive-day efficiency, no growth)
+    at every day index in t_idx. Returns (flags, current, previous, growth),
+    all shaped (entities × targets).
+    """
+    return rules.evaluate(mat, t_idx, LOOKBACK_DAYS)
+
+
+def _display_stats(mat: DayMatrix, t_idx, metric: str, how: str, rules):
+    """(current check days, previous rules.summary_prev window) stat, shaped (entities × targets)."""
+    reduce = mat.window_mean if how == 'mean' else mat.window_sum
+    curr = reduce(metric, t_idx, -(rules.check_days - 1), 0)
+    prev = reduce(metric, t_idx, *rules.summary_prev)
+    return curr, prev
+
+
+def _reason_stats(mat: DayMatrix, t_idx, rules) -> tuple:
+    """Display-window means of every rule metric: ({metric: curr}, {metric: prev})."""
+    curr, prev = {}, {}
+    for cond in rules.conditions:
+        if cond.metric not in curr:
+            curr[cond.metric], prev[cond.metric] = _display_stats(mat, t_idx, cond.metric, 'mean', rules)
+    return curr, prev
+
+
+def suggested_experts_for(camp_type) -> list:
+    camp_type = str(camp_type).lower()
+    if 'search' in camp_type:
+        return ['search_term', 'keyword', 'age', 'gender']
+    if 'pmax' in camp_type or 'performance max' in camp_type:
+        return ['channel', 'product', 'location_by_cities_all_campaign']
+    return ['age', 'gender', 'location_by_cities_all_campaign']
+
+
+def risk_status_label(status: str) -> str:
+    """Display status for a ContextGuard result."""
+    if status == "BLOCK":
+        return "🛡️ Protected (Tag Only)"
+    if status == "MARK":
+        return "⚠️ Warning (Observing)"
+    return "🔴 Critical"
+
+
+def campaign_records(mat: DayMatrix, t_idx, campaign_type_for, risk_batch_fn, rules=CAMPAIGN) -> dict:
+    """
+    Campaign anomaly dicts for every day index in t_idx: {date: [anomaly, ...]}.
+    campaign_type_for(entity_index, t) -> campaign_type of the first row in T's window.
+    risk_batch_fn(campaigns, date) -> {campaign: ContextGuard-style {"status", "reasons"}},
+    called once per day with all of that day's flagged campaigns.
+    rules: compiled AnomalyRules (anomaly_rules.CAMPAIGN_RULES by default).
+    """
+    t_idx = np.atleast_1d(np.asarray(t_idx))
+    flags, current, previous, growth = scan_matrix(mat, t_idx, rules)
+    results = {mat.date_at(t): [] for t in t_idx}
+    if not flags.any():
+        return results
+    curr_roas, prev_roas = _display_stats(mat, t_idx, 'roas', 'mean', rules)
+    curr_cpa, prev_cpa = _display_stats(mat, t_idx, 'cpa', 'mean', rules)
+    reason_curr, reason_prev = _reason_stats(mat, t_idx, rules)
+
+    for j, t in enumerate(t_idx):
+        date_str = mat.date_at(t)
+        hits = np.flatnonzero(flags[:, j])
+        if len(hits) == 0:
+            continue
+        # Context Guard risk assessment (one batched lookup per day)
+        risks = risk_batch_fn([mat.entities[e] for e in hits], date_str)
+        for e in hits:
+            campaign_name = mat.entities[e]
+            details = rules.reasons({m: v[e, j] for m, v in reason_curr.items()},
+                                    {m: v[e, j] for m, v in reason_prev.items()})
+            reason_str = " & ".join(details) or "Efficiency Alert"
+
+            risk_info = risks[campaign_name]
+            risk_label = risk_status_label(risk_info['status'])
+
+            camp_type = campaign_type_for(e, t)
+            results[date_str].append({
+                "id": str(campaign_name),
+                "campaign": campaign_name,
+                "campaign_type": str(camp_type),
+                "date": date_str,
+                "growth_rate": float(growth[e, j]),
+                "current_conv": float(current[e, j]),
+                "prev_conv": float(previous[e, j]),
+                # Efficiency Metrics
+                "curr_roas": _nan_to_zero(curr_roas[e, j]),
+                "prev_roas": _nan_to_zero(prev_roas[e, j]),
+                "curr_cpa": _nan_to_zero(curr_cpa[e, j]),
+                "prev_cpa": _nan_to_zero(prev_cpa[e, j]),
+
+                "status": risk_label,
+                "risk_level": risk_info['status'],
+                "guard_reasons": risk_info['reasons'],
+                "suggested_experts": suggested_experts_for(camp_type),
+                "reason": f"{reason_str} & No Growth"
+            })
+    return results
+
+
+def product_records(mat: DayMatrix, t_idx, title_for, rules=PRODUCT) -> dict:
+    """
+    Product anomaly dicts for every day index in t_idx: {date: [anomaly, ...]},
+    each day sorted by curr_cost (highest first).
+    title_for(entity_index, t) -> latest title in T's window.
+    rules: compiled AnomalyRules (anomaly_rules.PRODUCT_RULES by default).
+    """
+    t_idx = np.atleast_1d(np.asarray(t_idx))
+    flags, current, previous, _ = scan_matrix(mat, t_idx, rules)
+    results = {mat.date_at(t): [] for t in t_idx}
+    if not flags.any():
+        return results
+    curr_cost, prev_cost = _display_stats(mat, t_idx, 'cost', 'sum', rules)
+    curr_clicks, prev_clicks = _display_stats(mat, t_idx, 'clicks', 'sum', rules)
+    curr_ctr, prev_ctr = _display_stats(mat, t_idx, 'ctr', 'mean', rules)
+    curr_cpc, prev_cpc = _display_stats(mat, t_idx, 'avg_cpc', 'mean', rules)
+    reason_curr, reason_prev = _reason_stats(mat, t_idx, rules)
+
+    for j, t in enumerate(t_idx):
+        date_str = mat.date_at(t)
+        anomalies = results[date_str]
+        for e in np.flatnonzero(flags[:, j]):
+            item_id = mat.entities[e]
+            details = rules.reasons({m: v[e, j] for m, v in reason_curr.items()},
+                                    {m: v[e, j] for m, v in reason_prev.items()})
+            reason_str = " & ".join(details) or "Efficiency Alert"
+
+            anomalies.append({
+                "id": str(item_id),
+                "item_id": str(item_id),
+                "title": str(title_for(e, t))[:50],
+                "date": date_str,
+                "curr_cost": float(curr_cost[e, j]),
+                "prev_cost": float(prev_cost[e, j]),
+                "curr_clicks": float(curr_clicks[e, j]),
+                "prev_clicks": float(prev_clicks[e, j]),
+                "curr_ctr": _nan_to_zero(curr_ctr[e, j]),
+                "prev_ctr": _nan_to_zero(prev_ctr[e, j]),
+                # Using CTR/CPC instead of ROAS/CPA for frontend display
+                "current_conv": float(current[e, j]),  # clicks as proxy for conversions
+                "prev_conv": float(previous[e, j]),
+                "curr_roas": _nan_to_zero(curr_ctr[e, j]),  # CTR as proxy
+                "prev_roas": _nan_to_zero(prev_ctr[e, j]),
+                "curr_cpa": _nan_to_zero(curr_cpc[e, j]),  # CPC as proxy
+                "prev_cpa": _nan_to_zero(prev_cpc[e, j]),
+                "reason": f"{reason_str} & No Growth"
+            })
+        # Sort by cost (highest cost issues first)
+        anomalies.sort(key=lambda x: x['curr_cost'], reverse=True)
+    return results
+
+
+def last_labels(df: pd.DataFrame, key_col: str, label_col: str) -> dict:
+    """{entity: label of its latest row} (like group[label_col].iloc[-1])."""
+    if label_col not in df.columns or df.empty:
+        return {}
+    last = df.sort_values([key_col, 'date'], kind='stable').drop_duplicates(key_col, keep='last')
+    return dict(zip(last[key_col], last[label_col]))
+
+
+def _target_range(start_date, end_date):
+    start_dt = pd.Timestamp(start_date)
+    end_dt = pd.Timestamp(end_date)
+    return start_dt, end_dt, start_dt - pd.Timedelta(days=LOOKBACK_DAYS)
+
+
+def detect_campaign_anomalies_range(df: pd.DataFrame, start_date: str, end_date: str, risk_batch_fn) -> dict:
+    """
+    Campaign rules for every date in [start_date, end_date] in a single
+    sliding-window pass. `df` must cover [start_date - 45 days, end_date].
+    """
+    start_dt, end_dt, load_start = _target_range(start_date, end_date)
+    mat = build_day_matrix(df, 'campaign', CAMPAIGN_METRICS, load_start, end_dt,
+                           labels={'campaign_type': 'first'})
+    t_idx = np.arange(mat.day_index(start_dt), mat.day_index(end_dt) + 1)
+    if len(mat.entities) == 0:
+        return {mat.date_at(t): [] for t in t_idx}
+    type_for = lambda e, t: mat.window_label('campaign_type', e, t, -LOOKBACK_DAYS, 0, 'first', 'Unknown')
+    return campaign_records(mat, t_idx, type_for, risk_batch_fn)
+
+
+def detect_product_anomalies_range(df: pd.DataFrame, start_date: str, end_date: str) -> dict:
+    """
+    Product rules for every date in [start_date, end_date] in a single
+    sliding-window pass. `df` must cover [start_date - 45 days, end_date].
+    """
+    start_dt, end_dt, load_start = _target_range(start_date, end_date)
+    mat = build_day_matrix(df, 'item_id', PRODUCT_METRICS, load_start, end_dt,
+                           labels={'title': 'last'})
+    t_idx = np.arange(mat.day_index(start_dt), mat.day_index(end_dt) + 1)
+    if len(mat.entities) == 0:
+        return {mat.date_at(t): [] for t in t_idx}
+    title_for = lambda e, t: mat.window_label('title', e, t, -LOOKBACK_DAYS, 0, 'last', 'Unknown Product')
+    return product_records(mat, t_idx, title_for)
+
+
+def detect_campaign_anomalies(df: pd.DataFrame, target_date: str, risk_batch_fn) -> list:
+    """Campaign rules (ROAS/CPA efficiency + conversion growth) at target_date for every campaign in df."""
+    return detect_campaign_anomalies_range(df, target_date, target_date, risk_batch_fn)[pd.Timestamp(target_date).strftime('%Y-%m-%d')]
+
+
+def detect_product_anomalies(df: pd.DataFrame, target_date: str) -> list:
+    """Product rules (CTR/CPC efficiency + click growth) at target_date for every item in df."""
+    return detect_product_anomalies_range(df, target_date, target_date)[pd.Timestamp(target_date).strftime('%Y-%m-%d')]
+
+
+def rank_product_candidates(conn, target_date: str) -> list:
+    """
+    item_ids that can be flagged at target_date - the efficiency rule needs a
+    row on each of the consecutive check days - ordered by their cost over
+    those days (= curr_cost), highest first.
+    """
+    rows = conn.execute("""
+        SELECT item_id, SUM(CAST(REPLACE(REPLACE(cost, '$', ''), ',', '') AS REAL)) AS check_cost
+        FROM product
+        WHERE date <= ? AND date >= date(?, ?)
+        GROUP BY item_id
+        HAVING COUNT(DISTINCT date) = ?
+        ORDER BY check_cost DESC, item_id
+    """, (target_date, target_date, f'-{PRODUCT.check_days - 1} days', PRODUCT.check_days)).fetchall()
+    return [r[0] for r in rows]
+
+
+def iter_product_anomaly_shards(conn, target_date: str, first_shard: int = 200, growth: int = 4):
+    """
+    Progressive product detection: candidates are evaluated in shards of
+    increasing size (first_shard, x growth, ...), highest-cost items first, and
+    each shard's anomalies (sorted by curr_cost) are yielded as soon as they are
+    ready. Together the shards yield exactly the anomalies of
+    detect_product_anomalies; the order is by shard, then curr_cost.
+    Yields (n_items_evaluated, anomalies).
+    """
+    target_date = pd.Timestamp(target_date).strftime('%Y-%m-%d')
+    candidates = rank_product_candidates(conn, target_date)
+    pos, size = 0, first_shard
+    while pos < len(candidates):
+        shard = candidates[pos:pos + size]
+        pos += len(shard)
+        size *= growth
+        df = load_product_frame(conn, window_start(target_date), target_date, item_ids=shard)
+        yield len(shard), detect_product_anomalies(df, target_date) if not df.empty else []
+
+
+def merge_product_shards(parts: list) -> list:
+    """
+    Merge per-shard product anomaly lists into the serial order: curr_cost
+    descending, ties in groupby(item_id) order. parts = [(raw_item_ids, anomalies), ...]
+    where raw_item_ids[i] is the original item_id value of anomalies[i].
+    """
+    raw_ids = [item for ids, _ in parts for item in ids]
+    anomalies = [a for _, records in parts for a in records]
+    if not anomalies:
+        return []
+    rank, _ = pd.factorize(pd.Series(raw_ids), sort=True)
+    cost = np.array([a['curr_cost'] for a in anomalies], dtype=np.float64)
+    order = np.lexsort((rank, -cost))
+    return [anomalies[i] for i in order]
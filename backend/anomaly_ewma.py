@@ -0,0 +1,338 @@
+"""
+EWMA / seasonal statistical anomaly detector.
+
+A second detector next to the rule engine. For every campaign / item and
+every rule metric it keeps, in anomaly_ewma_state:
+
+- an exponentially weighted mean and variance of the de-seasonalised value
+- 7 multiplicative day-of-week factors
+- the number of observed days
+
+Each new day is scored against the state of the day before (z = residual /
+EWMA std) and then folded into it, so advancing costs O(1) per entity and
+never reloads the 45-day window. An entity is flagged when one of the rule
+metrics moves in its "bad" direction (direction from anomaly_rules) by at
+least Z_THRESHOLD standard deviations after WARMUP_DAYS observations. The std
+has a floor relative to the mean, which keeps low-volume entities with a few
+identical days from producing huge z-scores.
+
+Flagged rows are stored per day in anomaly_ewma_scores. The state is only
+advanced by the precompute / incremental jobs (advance_ewma_state); readers
+(get_ewma_anomalies) never write and report `pending` when the state has not
+reached the requested day yet. Each advance writes back only the entities it
+scored and drops entities not seen for PRUNE_AFTER_DAYS.
+"""
+import sqlite3
+import json
+
+import numpy as np
+import pandas as pd
+
+from anomaly_engine import CAMPAIGN, PRODUCT, load_campaign_frame, load_product_frame
+from ads_db import get_db_connection
+from data_version import bump_data_version, get_data_version
+
+EWMA_ALPHA = 0.1            # weight of the newest day in mean / variance
+SEASON_GAMMA = 0.05         # weight of the newest day in its day-of-week factor
+SEASON_RANGE = (0.2, 5.0)   # clip for the day-of-week factors
+Z_THRESHOLD = 3.0           # flag when a metric is >= 3 std off in its bad direction
+WARMUP_DAYS = 14            # observations needed before an entity can be flagged
+MIN_REL_SD = 0.1            # std floor: 10% of the EWMA mean
+REPLAY_CHUNK_DAYS = 31      # days loaded at once when (re)building the state
+PRUNE_AFTER_DAYS = 90       # entities without a row for this long are dropped (restart their warm-up)
+
+# Per metric: mean, variance, 7 day-of-week factors, observed days
+MEAN, VAR, SEASON, OBS = 0, 1, 2, 9
+FIELDS = 10
+
+ENTITY_CONFIG = {
+    'campaign': {'key': 'campaign', 'table': 'campaign', 'rules': CAMPAIGN, 'loader': load_campaign_frame, 'label': None},
+    'product': {'key': 'item_id', 'table': 'product', 'rules': PRODUCT, 'loader': load_product_frame, 'label': 'title'},
+}
+
+
+def init_ewma_tables(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS anomaly_ewma_state (
+            entity_type TEXT NOT NULL,
+            entity_key TEXT NOT NULL,
+            state BLOB NOT NULL,
+            last_date TEXT NOT NULL DEFAULT '',
+            PRIMARY KEY (entity_type, entity_key)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS anomaly_ewma_meta (
+            entity_type TEXT PRIMARY KEY,
+            as_of_date TEXT NOT NULL,
+            data_version INTEGER NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS anomaly_ewma_scores (
+            entity_type TEXT NOT NULL,
+            target_date TEXT NOT NULL,
+            entity_id TEXT NOT NULL,
+            score REAL NOT NULL,
+            payload TEXT NOT NULL,
+            PRIMARY KEY (entity_type, target_date, entity_id)
+        )
+    """)
+    if 'last_date' not in [r[1] for r in conn.execute("PRAGMA table_info(anomaly_ewma_state)")]:
+        # States saved before the column: treat every entity as seen on the state's as_of day
+        conn.execute("ALTER TABLE anomaly_ewma_state ADD COLUMN last_date TEXT NOT NULL DEFAULT ''")
+        conn.execute("""
+            UPDATE anomaly_ewma_state SET last_date = COALESCE(
+                (SELECT as_of_date FROM anomaly_ewma_meta m WHERE m.entity_type = anomaly_ewma_state.entity_type), '')
+        """)
+    conn.commit()
+
+
+def _daily_values(df: pd.DataFrame, config: dict) -> pd.DataFrame:
+    """One row per (entity, day): mean of the rate metrics, sum of the volume metric."""
+    rules = config['rules']
+    agg = {m: 'mean' for m in rules.metrics}
+    agg[rules.growth_metric] = 'sum'
+    if config['label']:
+        agg[config['label']] = 'last'
+    return df.groupby([config['key'], 'date'], sort=False).agg(agg).reset_index().sort_values('date', kind='stable')
+
+
+class EwmaState:
+    """
+    In-memory (entities × metrics × FIELDS) state with a key -> row index, the
+    last day each entity had a row and the rows stepped since loading.
+    """
+
+    def __init__(self, n_metrics: int, keys: list = None, data: np.ndarray = None, last_dates: list = None):
+        self.n_metrics = n_metrics
+        self.keys = list(keys or [])
+        self.index = {k: i for i, k in enumerate(self.keys)}
+        self.data = data if data is not None else np.zeros((0, n_metrics, FIELDS))
+        self.last_dates = list(last_dates) if last_dates is not None else [''] * len(self.keys)
+        self.touched = set()
+
+    def rows_for(self, keys) -> np.ndarray:
+        """Row positions of `keys`, appending fresh state for unseen entities."""
+        new = [k for k in dict.fromkeys(keys) if k not in self.index]
+        if new:
+            fresh = np.zeros((len(new), self.n_metrics, FIELDS))
+            fresh[:, :, SEASON:SEASON + 7] = 1.0
+            for k in new:
+                self.index[k] = len(self.keys)
+                self.keys.append(k)
+                self.last_dates.append('')
+            self.data = np.concatenate([self.data, fresh])
+        return np.fromiter((self.index[k] for k in keys), dtype=np.int64, count=len(keys))
+
+    def step(self, rows: np.ndarray, values: np.ndarray, dow: int, day: str = ''):
+        """
+        Score one day (values: rows × metrics) against the current state, then
+        fold it in. Returns (z, expected, observations before the update).
+        """
+        for r in rows.tolist():
+            self.last_dates[r] = day
+            self.touched.add(r)
+        st = self.data[rows]
+        mean, var, obs = st[:, :, MEAN], st[:, :, VAR], st[:, :, OBS]
+        season = st[:, :, SEASON + dow]
+        first = obs == 0
+
+        y = values / season
+        resid = y - mean
+        sd = np.sqrt(var + (MIN_REL_SD * np.abs(mean)) ** 2 + 1e-12)
+        z = np.where(first, 0.0, resid / sd)
+        expected = mean * season
+
+        new_mean = np.where(first, y, mean + EWMA_ALPHA * resid)
+        new_var = np.where(first, 0.0, (1 - EWMA_ALPHA) * (var + EWMA_ALPHA * resid ** 2))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            factor = (1 - SEASON_GAMMA) * season + SEASON_GAMMA * values / new_mean
+        new_season = np.where(~first & (new_mean > 0), np.clip(factor, *SEASON_RANGE), season)
+
+        st[:, :, MEAN] = new_mean
+        st[:, :, VAR] = new_var
+        st[:, :, SEASON + dow] = new_season
+        st[:, :, OBS] = obs + 1
+        self.data[rows] = st
+        return z, expected, obs[:, 0]
+
+
+def _load_state(conn, entity_type: str, n_metrics: int) -> EwmaState:
+    rows = conn.execute(
+        "SELECT entity_key, state, last_date FROM anomaly_ewma_state WHERE entity_type = ?", (entity_type,)
+    ).fetchall()
+    if not rows or len(rows[0][1]) != n_metrics * FIELDS * 8:
+        return EwmaState(n_metrics)
+    keys = [json.loads(r[0]) for r in rows]
+    data = np.stack([np.frombuffer(r[1], dtype=np.float64).reshape(n_metrics, FIELDS) for r in rows])
+    return EwmaState(n_metrics, keys, data.copy(), [r[2] for r in rows])
+
+
+def _save_state(conn, entity_type: str, state: EwmaState, as_of: str, version: int, rebuilt: bool):
+    """Write back the stepped entities (all of them after a rebuild) and drop entities idle since the cutoff."""
+    if rebuilt:
+        conn.execute("DELETE FROM anomaly_ewma_state WHERE entity_type = ?", (entity_type,))
+    conn.executemany(
+        "INSERT OR REPLACE INTO anomaly_ewma_state (entity_type, entity_key, state, last_date) VALUES (?, ?, ?, ?)",
+        [(entity_type, json.dumps(state.keys[i], ensure_ascii=False), state.data[i].astype(np.float64).tobytes(),
+          state.last_dates[i]) for i in sorted(state.touched)]
+    )
+    cutoff = (pd.Timestamp(as_of) - pd.Timedelta(days=PRUNE_AFTER_DAYS)).strftime('%Y-%m-%d')
+    conn.execute("DELETE FROM anomaly_ewma_state WHERE entity_type = ? AND last_date < ?", (entity_type, cutoff))
+    conn.execute(
+        "INSERT OR REPLACE INTO anomaly_ewma_meta (entity_type, as_of_date, data_version) VALUES (?, ?, ?)",
+        (entity_type, as_of, version)
+    )
+    conn.commit()
+
+
+def _score_records(entity_type: str, config: dict, day: str, keys: list, labels, values, z, expected, obs) -> list:
+    """Flagged entities of one day as anomaly dicts, highest score first."""
+    rules = config['rules']
+    metrics = rules.metrics
+    bad = np.full(len(keys), -np.inf)
+    cond_z = []
+    for cond in rules.conditions:
+        k = metrics.index(cond.metric)
+        zk = -z[:, k] if cond.direction == 'down' else z[:, k]
+        cond_z.append((cond, k, zk))
+        bad = np.maximum(bad, zk)
+    flagged = np.flatnonzero((obs >= WARMUP_DAYS) & (bad >= Z_THRESHOLD))
+
+    id_key = config['key']
+    records = []
+    for i in flagged:
+        reasons = [f"{cond.label} z={z[i, k]:+.1f} (expected {expected[i, k]:.2f}, actual {values[i, k]:.2f})"
+                   for cond, k, zk in cond_z if zk[i] >= Z_THRESHOLD]
+        record = {
+            "id": str(keys[i]),
+            id_key: keys[i] if entity_type == 'campaign' else str(keys[i]),
+            "date": day,
+            "detector": "ewma",
+            "score": round(float(bad[i]), 3),
+            "z_scores": {m: round(float(z[i, k]), 3) for k, m in enumerate(metrics)},
+            "expected": {m: round(float(expected[i, k]), 4) for k, m in enumerate(metrics)},
+            "actual": {m: round(float(values[i, k]), 4) for k, m in enumerate(metrics)},
+            "observations": int(obs[i]),
+            "reason": " & ".join(reasons),
+        }
+        if labels is not None:
+            record["title"] = str(labels[i])[:50]
+        records.append(record)
+    records.sort(key=lambda r: r['score'], reverse=True)
+    return records
+
+
+def _store_scores(conn, entity_type: str, day: str, records: list):
+    conn.execute("DELETE FROM anomaly_ewma_scores WHERE entity_type = ? AND target_date = ?", (entity_type, day))
+    conn.executemany(
+        "INSERT OR REPLACE INTO anomaly_ewma_scores (entity_type, target_date, entity_id, score, payload) VALUES (?, ?, ?, ?, ?)",
+        [(entity_type, day, r['id'], r['score'], json.dumps(r, ensure_ascii=False)) for r in records]
+    )
+
+
+def _replay(conn, entity_type: str, state: EwmaState, start_date: str, end_date: str) -> int:
+    """Feed every day in [start_date, end_date] through the state; returns the number of days seen."""
+    config = ENTITY_CONFIG[entity_type]
+    metrics = config['rules'].metrics
+    days = 0
+    chunk_start = pd.Timestamp(start_date)
+    end = pd.Timestamp(end_date)
+    while chunk_start <= end:
+        chunk_end = min(end, chunk_start + pd.Timedelta(days=REPLAY_CHUNK_DAYS - 1))
+        df = config['loader'](conn, chunk_start.strftime('%Y-%m-%d'), chunk_end.strftime('%Y-%m-%d'))
+        if not df.empty:
+            daily = _daily_values(df, config)
+            for date, group in daily.groupby('date', sort=True):
+                raw_keys = group[config['key']].tolist()
+                keys = [k.item() if hasattr(k, 'item') else k for k in raw_keys]
+                values = group[metrics].to_numpy(dtype=np.float64)
+                day = date.strftime('%Y-%m-%d')
+                z, expected, obs = state.step(state.rows_for(keys), values, date.dayofweek, day)
+                labels = group[config['label']].to_numpy() if config['label'] else None
+                _store_scores(conn, entity_type, day, _score_records(entity_type, config, day, keys, labels, values, z, expected, obs))
+                days += 1
+        chunk_start = chunk_end + pd.Timedelta(days=1)
+    return days
+
+
+def advance_ewma_state(entity_type: str, new_date: str = None, rebuild: bool = False) -> dict:
+    """
+    Advance the EWMA state of `entity_type` to `new_date` (default: latest
+    imported day), scoring every day after the stored as_of_date.
+
+    The state is rebuilt from the first day of data when it does not exist,
+    when `rebuild` is set, or when the source table changed (new data
+    version) without adding days after as_of_date, e.g. a re-import of old days.
+    Bumps the `anomaly_ewma_state` data version when scores changed, which
+    re-keys the cached / ETagged ewma responses.
+    """
+    config = ENTITY_CONFIG[entity_type]
+    n_metrics = len(config['rules'].metrics)
+    conn = get_db_connection()
+    try:
+        init_ewma_tables(conn)
+        version = get_data_version(config['table'], conn)
+        first_date, max_date = conn.execute(f"SELECT MIN(date), MAX(date) FROM {config['table']}").fetchone()
+        new_date = new_date or max_date
+        if not new_date:
+            return {"entity_type": entity_type, "as_of": None, "days": 0}
+
+        meta = conn.execute(
+            "SELECT as_of_date, data_version FROM anomaly_ewma_meta WHERE entity_type = ?", (entity_type,)
+        ).fetchone()
+        if meta and not rebuild:
+            as_of, stored_version = meta
+            if new_date <= as_of:
+                if stored_version == version:
+                    return {"entity_type": entity_type, "as_of": as_of, "days": 0}
+                rebuild = True
+        if rebuild or not meta:
+            conn.execute("DELETE FROM anomaly_ewma_scores WHERE entity_type = ?", (entity_type,))
+            state = EwmaState(n_metrics)
+            start = first_date
+        else:
+            state = _load_state(conn, entity_type, n_metrics)
+            start = (pd.Timestamp(meta[0]) + pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+
+        rebuilt = rebuild or not meta
+        days = _replay(conn, entity_type, state, start, new_date) if start else 0
+        _save_state(conn, entity_type, state, new_date, version, rebuilt)
+        if days or rebuilt:
+            bump_data_version(['anomaly_ewma_state'], conn)
+        return {"entity_type": entity_type, "as_of": new_date, "days": days}
+    finally:
+        conn.close()
+
+
+def get_ewma_anomalies(entity_type: str, target_date: str = None) -> dict:
+    """
+    Stored flagged entities for target_date (default: latest day). Read-only:
+    pending is true (with no anomalies) when the state has not been advanced to
+    target_date yet, or was advanced before the source table last changed.
+    """
+    table = ENTITY_CONFIG[entity_type]['table']
+    conn = get_db_connection()
+    try:
+        if not target_date:
+            row = conn.execute(f"SELECT MAX(date) FROM {table}").fetchone()
+            target_date = row[0] if row else None
+        try:
+            meta = conn.execute(
+                "SELECT as_of_date, data_version FROM anomaly_ewma_meta WHERE entity_type = ?", (entity_type,)
+            ).fetchone()
+        except sqlite3.OperationalError:
+            meta = None  # no job has run yet
+        as_of = meta[0] if meta else None
+        pending = not meta or not target_date or target_date > as_of or meta[1] != get_data_version(table, conn)
+        anomalies = []
+        if not pending:
+            rows = conn.execute(
+                "SELECT payload FROM anomaly_ewma_scores WHERE entity_type = ? AND target_date = ? ORDER BY score DESC, entity_id",
+                (entity_type, target_date)
+            ).fetchall()
+            anomalies = [json.loads(r[0]) for r in rows]
+        return {"date": target_date, "as_of": as_of, "pending": pending, "anomalies": anomalies}
+    finally:
+        conn.close()
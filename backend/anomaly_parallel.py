@@ -0,0 +1,89 @@
+"""
+Sharded product anomaly detection.
+
+Items are split by a stable hash of item_id (anomaly_engine.item_shard) in the
+parent, which reads the distinct item_ids of the 45-day window once and hands
+each worker its own id list. Every shard runs in a process of one long-lived
+pool (created on first use, resized when the worker count changes): the worker
+opens its own connection, loads only its items' rows and evaluates the rules.
+Product rules never look across items, so the merged shard lists are exactly
+the serial result once re-sorted by curr_cost (anomaly_engine.merge_product_shards).
+"""
+import atexit
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import ads_db
+from anomaly_engine import (
+    load_product_frame, window_start, detect_product_anomalies, merge_product_shards, item_shard,
+)
+
+_pool_lock = threading.Lock()
+_pool = {"executor": None, "workers": 0}
+
+
+def get_pool(workers: int) -> ProcessPoolExecutor:
+    """The shared worker pool, (re)created when missing or sized differently."""
+    with _pool_lock:
+        if _pool["executor"] is None or _pool["workers"] != workers:
+            if _pool["executor"] is not None:
+                _pool["executor"].shutdown(wait=False)
+            _pool["executor"] = ProcessPoolExecutor(max_workers=workers)
+            _pool["workers"] = workers
+        return _pool["executor"]
+
+
+def shutdown_pool():
+    with _pool_lock:
+        if _pool["executor"] is not None:
+            _pool["executor"].shutdown(wait=True)
+        _pool["executor"], _pool["workers"] = None, 0
+
+
+atexit.register(shutdown_pool)
+
+
+def shard_item_ids(conn, target_date: str, n_shards: int) -> list:
+    """Distinct item_ids of the detection window, split into n_shards lists by item_shard."""
+    shards = [[] for _ in range(n_shards)]
+    for (item_id,) in conn.execute("SELECT DISTINCT item_id FROM product WHERE date <= ? AND date >= ?",
+                                   (target_date, window_start(target_date))):
+        shards[item_shard(item_id, n_shards)].append(item_id)
+    return shards
+
+
+def _product_shard(db_file: str, target_date: str, item_ids: list):
+    """Worker: (raw item_ids, anomalies) for one shard's items."""
+    conn = sqlite3.connect(db_file, timeout=30)
+    try:
+        df = load_product_frame(conn, window_start(target_date), target_date, item_ids=item_ids)
+        if df.empty:
+            return [], []
+        anomalies = detect_product_anomalies(df, target_date)
+        raw_ids = {str(item): item for item in df['item_id'].unique()}
+        return [raw_ids[a['item_id']] for a in anomalies], anomalies
+    finally:
+        conn.close()
+
+
+def detect_product_anomalies_sharded(target_date: str, workers: int, db_file: str = None) -> list:
+    """Product anomalies at target_date using `workers` pool processes (one shard each)."""
+    db_file = db_file or ads_db.DB_FILE
+    conn = sqlite3.connect(db_file, timeout=30)
+    try:
+        shards = [ids for ids in shard_item_ids(conn, target_date, workers) if ids]
+    finally:
+        conn.close()
+    executor = get_pool(workers)
+    try:
+        futures = [executor.submit(_product_shard, db_file, target_date, ids) for ids in shards]
+        parts = [f.result() for f in futures]
+    except BrokenProcessPool:
+        # A worker died: drop the pool so the next call starts a fresh one
+        with _pool_lock:
+            if _pool["executor"] is executor:
+                _pool["executor"], _pool["workers"] = None, 0
+        raise
+    return merge_product_shards(parts)
@@ -0,0 +1,280 @@
+"""
+Root-cause contribution analysis for flagged campaigns.
+
+For every dimension table (search term, geo, age, gender, channel, schedule)
+the change of a cost-weighted ratio Y = numerator / cost between the baseline
+window and the current window is split exactly into per-segment terms:
+
+    Y = sum_i s_i * y_i          s_i = segment cost share, y_i = segment ratio
+    mix_i  = (s1_i - s0_i) * (y0_i - Y0)     spend moved towards / away from the segment
+    rate_i = s1_i * (y1_i - y0_i)            the segment's own ratio changed
+    sum_i (mix_i + rate_i) = Y1 - Y0
+
+ROAS uses numerator = conversion value. CPA = 1 / (conversions / cost), so the
+conversions-per-cost contributions are rescaled by -1 / (Y0 * Y1), which keeps
+them summing exactly to CPA1 - CPA0 (zero-conversion segments included).
+
+Segments missing in a window fall back to the campaign ratio (no mix effect for
+new segments). All flagged campaigns are loaded with one grouped query per
+dimension and decomposed together with array operations.
+"""
+
+import numpy as np
+import pandas as pd
+
+from anomaly_engine import CAMPAIGN
+import schema_catalog
+from ads_db import get_db_connection
+
+# Column candidates per dimension (the exported tables do not share one schema)
+DIMENSIONS = {
+    'search_term': {'table': 'search_term', 'campaign': ['campaign'], 'key': ['search_term']},
+    'geo': {'table': 'location_by_cities_all_campaign', 'campaign': ['campaign'], 'key': ['location', 'city', 'cities', 'location_name']},
+    'age': {'table': 'age', 'campaign': ['campaign'], 'key': ['age', 'age_range']},
+    'gender': {'table': 'gender', 'campaign': ['campaign'], 'key': ['gender']},
+    'channel': {'table': 'channel', 'campaign': ['campaigns', 'campaign'], 'key': ['channels', 'channel']},
+    'schedule': {'table': 'ad_schedule', 'campaign': ['campaign'], 'key': ['day_and_time', 'day_of_week', 'hour_of_day', 'hour']},
+}
+VALUE_COLUMNS = ['conv_value', 'results_value', 'conversion_value']
+
+TOP_DRIVERS = 5
+TOP_PER_DIMENSION = 3
+# Direction in which each metric deteriorates
+ADVERSE = {"roas": -1, "cpa": 1}
+
+
+def analysis_windows(target_date: str, rules=CAMPAIGN) -> dict:
+    """Current = the rule's check days ending at T, baseline = the baseline days before them."""
+    t = pd.Timestamp(target_date)
+    cur_start = t - pd.Timedelta(days=rules.check_days - 1)
+    base_start = cur_start - pd.Timedelta(days=rules.baseline_days)
+    fmt = lambda d: d.strftime('%Y-%m-%d')
+    return {
+        "baseline": [fmt(base_start), fmt(cur_start - pd.Timedelta(days=1))],
+        "current": [fmt(cur_start), fmt(t)],
+    }
+
+
+def resolve_dimension(conn, dim: str):
+    """Actual column names of a dimension table, or None if the table / columns are missing."""
+    config = DIMENSIONS[dim]
+    cols = list(schema_catalog.table_columns(conn, config['table']))
+    if not cols or 'date' not in cols or 'cost' not in cols:
+        return None
+    pick = lambda candidates: next((c for c in candidates if c in cols), None)
+    campaign_col, key_col = pick(config['campaign']), pick(config['key'])
+    if not campaign_col or not key_col:
+        return None
+    return {
+        'table': config['table'],
+        'campaign': campaign_col,
+        'key': key_col,
+        'value': pick(VALUE_COLUMNS),
+        'conversions': 'conversions' if 'conversions' in cols else None,
+    }
+
+
+def _numeric(col) -> str:
+    if not col:
+        return "0"
+    return f"CAST(REPLACE(REPLACE(REPLACE({col}, '$', ''), ',', ''), '%', '') AS REAL)"
+
+
+def load_dimension_windows(conn, columns: dict, windows: dict) -> pd.DataFrame:
+    """
+    Per (campaign, segment, window) sums of cost / conversions / value for the
+    campaigns staged in temp._rootcause_campaigns. window: 0 = baseline, 1 = current.
+    """
+    query = f"""
+        SELECT {columns['campaign']} AS campaign,
+               COALESCE(CAST({columns['key']} AS TEXT), '(not set)') AS segment,
+               CASE WHEN date >= ? THEN 1 ELSE 0 END AS window,
+               SUM({_numeric('cost')}) AS cost,
+               SUM({_numeric(columns['conversions'])}) AS conversions,
+               SUM({_numeric(columns['value'])}) AS value
+        FROM {columns['table']}
+        WHERE date >= ? AND date <= ?
+          AND {columns['campaign']} IN (SELECT campaign FROM temp._rootcause_campaigns)
+        GROUP BY 1, 2, 3
+    """
+    params = (windows['current'][0], windows['baseline'][0], windows['current'][1])
+    return pd.read_sql_query(query, conn, params=params).fillna(0)
+
+
+def _decompose_ratio(num0, cost0, num1, cost1, camp):
+    """
+    Mix / rate terms of Y = num / cost for every segment row; camp holds the
+    campaign code of each row. Returns (mix, rate, Y0, Y1, s0, s1) with Y0 / Y1
+    broadcast to rows (NaN where a window has no cost).
+    """
+    n_camp = camp.max() + 1
+    C0 = np.bincount(camp, cost0, n_camp)[camp]
+    C1 = np.bincount(camp, cost1, n_camp)[camp]
+    N0 = np.bincount(camp, num0, n_camp)[camp]
+    N1 = np.bincount(camp, num1, n_camp)[camp]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        Y0 = np.where(C0 > 0, N0 / C0, np.nan)
+        Y1 = np.where(C1 > 0, N1 / C1, np.nan)
+        s0 = np.where(C0 > 0, cost0 / C0, 0.0)
+        s1 = np.where(C1 > 0, cost1 / C1, 0.0)
+        y0 = np.where(cost0 > 0, num0 / cost0, Y0)
+        y1 = np.where(cost1 > 0, num1 / cost1, y0)
+    mix = (s1 - s0) * (y0 - Y0)
+    rate = s1 * (y1 - y0)
+    return mix, rate, Y0, Y1, s0, s1
+
+
+def decompose_dimension(frame: pd.DataFrame) -> pd.DataFrame:
+    """
+    One row per (campaign, segment) with the ROAS and CPA contributions
+    (roas_mix / roas_rate / cpa_mix / cpa_rate) and the campaign-level
+    baseline / current values of the dimension.
+    """
+    pair = frame.groupby(['campaign', 'segment'], sort=False).ngroup().to_numpy()
+    n_pairs = pair.max() + 1
+    keys = frame.drop_duplicates(['campaign', 'segment'])[['campaign', 'segment']]
+    camp = pd.factorize(keys['campaign'])[0]
+    current = frame['window'].to_numpy() == 1
+    sums = {}
+    for col in ('cost', 'conversions', 'value'):
+        values = frame[col].to_numpy(float)
+        sums[col] = (np.bincount(pair[~current], values[~current], n_pairs),
+                     np.bincount(pair[current], values[current], n_pairs))
+    (cost0, cost1), (conv0, conv1), (val0, val1) = sums['cost'], sums['conversions'], sums['value']
+
+    roas_mix, roas_rate, R0, R1, s0, s1 = _decompose_ratio(val0, cost0, val1, cost1, camp)
+    cvr_mix, cvr_rate, Q0, Q1, _, _ = _decompose_ratio(conv0, cost0, conv1, cost1, camp)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cpa_scale = np.where((Q0 > 0) & (Q1 > 0), -1.0 / (Q0 * Q1), np.nan)
+        out = pd.DataFrame({
+            'campaign': keys['campaign'].to_numpy(), 'segment': keys['segment'].to_numpy(),
+            'roas_base': R0, 'roas_curr': R1,
+            'roas_mix': roas_mix, 'roas_rate': roas_rate,
+            'seg_roas_base': np.where(cost0 > 0, val0 / cost0, np.nan),
+            'seg_roas_curr': np.where(cost1 > 0, val1 / cost1, np.nan),
+            'cpa_base': np.where(Q0 > 0, 1.0 / Q0, np.nan),
+            'cpa_curr': np.where(Q1 > 0, 1.0 / Q1, np.nan),
+            'cpa_mix': cvr_mix * cpa_scale, 'cpa_rate': cvr_rate * cpa_scale,
+            'seg_cpa_base': np.where(conv0 > 0, cost0 / conv0, np.nan),
+            'seg_cpa_curr': np.where(conv1 > 0, cost1 / conv1, np.nan),
+            'share_base': s0, 'share_curr': s1,
+            'cost_base': cost0, 'cost_curr': cost1,
+        })
+    return out
+
+
+def _round(v, digits=4):
+    return None if v is None or pd.isna(v) else round(float(v), digits)
+
+
+def driver_rows(decomposed: pd.DataFrame, metric: str, top: int) -> pd.DataFrame:
+    """
+    Segments that pushed `metric` in its adverse direction (ROAS down, CPA up)
+    while the campaign-level value deteriorated, `top` per campaign, largest
+    impact (contribution / baseline value) first.
+    """
+    sign = ADVERSE[metric]
+    mix, rate = decomposed[f'{metric}_mix'].to_numpy(), decomposed[f'{metric}_rate'].to_numpy()
+    base = decomposed[f'{metric}_base'].to_numpy()
+    delta = decomposed[f'{metric}_curr'].to_numpy() - base
+    contribution = mix + rate
+    with np.errstate(invalid='ignore', divide='ignore'):
+        impact = contribution / base * 100
+        explained = contribution / delta * 100
+    hits = np.flatnonzero((delta * sign > 0) & (contribution * sign > 0))
+    camp = pd.factorize(decomposed['campaign'])[0]
+    hits = hits[np.lexsort((-sign * impact[hits], camp[hits]))]
+    # Rank inside each campaign's run of the sorted hits
+    starts = np.flatnonzero(np.r_[True, np.diff(camp[hits]) != 0])
+    rank = np.arange(len(hits)) - np.repeat(starts, np.diff(np.r_[starts, len(hits)]))
+    idx = hits[rank < top]
+    return pd.DataFrame({
+        'campaign': decomposed['campaign'].to_numpy()[idx],
+        'segment': decomposed['segment'].to_numpy()[idx],
+        'metric': metric,
+        'contribution': contribution[idx],
+        'impact_pct': impact[idx],
+        'explained_pct': explained[idx],
+        'mix': mix[idx],
+        'rate': rate[idx],
+        'share_base': decomposed['share_base'].to_numpy()[idx],
+        'share_curr': decomposed['share_curr'].to_numpy()[idx],
+        'seg_base': decomposed[f'seg_{metric}_base'].to_numpy()[idx],
+        'seg_curr': decomposed[f'seg_{metric}_curr'].to_numpy()[idx],
+    })
+
+
+def _driver_dict(row: dict, dim: str) -> dict:
+    metric = row['metric']
+    return {
+        "dimension": dim,
+        "segment": row['segment'],
+        "metric": metric,
+        "contribution": _round(row['contribution']),
+        "impact_pct": _round(row['impact_pct'], 1),
+        "explained_pct": _round(row['explained_pct'], 1),
+        "mix": _round(row['mix']),
+        "rate": _round(row['rate']),
+        "cost_share_baseline": _round(row['share_base']),
+        "cost_share_current": _round(row['share_curr']),
+        f"{metric}_baseline": _round(row['seg_base']),
+        f"{metric}_current": _round(row['seg_curr']),
+    }
+
+
+def _change(row: dict, metric: str) -> dict:
+    base, curr = row[f'{metric}_base'], row[f'{metric}_curr']
+    return {"baseline": _round(base), "current": _round(curr),
+            "change": _round(curr - base) if not (pd.isna(base) or pd.isna(curr)) else None}
+
+
+def explain_campaign_changes(campaigns: list, target_date: str, top: int = TOP_DRIVERS) -> dict:
+    """
+    {campaign: {"windows", "top_drivers": [...],
+                "dimensions": {dim: {"roas", "cpa", "cost_baseline", "cost_current", "drivers"}}}}
+    for the given campaigns at target_date.
+    top_drivers ranks the adverse drivers of all dimensions by impact_pct
+    (share of the campaign's baseline ROAS / CPA that the segment moved).
+    """
+    campaigns = list(dict.fromkeys(c for c in campaigns if c))
+    windows = analysis_windows(target_date)
+    results = {c: {"windows": windows, "top_drivers": [], "dimensions": {}} for c in campaigns}
+    if not campaigns:
+        return results
+
+    conn = get_db_connection()
+    try:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS _rootcause_campaigns (campaign PRIMARY KEY)")
+        conn.execute("DELETE FROM _rootcause_campaigns")
+        conn.executemany("INSERT OR IGNORE INTO _rootcause_campaigns (campaign) VALUES (?)", [(c,) for c in campaigns])
+        frames = {}
+        for dim in DIMENSIONS:
+            columns = resolve_dimension(conn, dim)
+            if columns:
+                frames[dim] = (columns, load_dimension_windows(conn, columns, windows))
+    finally:
+        conn.close()
+
+    for dim, (columns, frame) in frames.items():
+        if frame.empty:
+            continue
+        decomposed = decompose_dimension(frame)
+        metrics = ['roas', 'cpa'] if columns['value'] else ['cpa']
+        totals = decomposed.groupby('campaign', sort=False)[['cost_base', 'cost_curr']].sum()
+        for row in decomposed.drop_duplicates('campaign').to_dict('records'):
+            if row['campaign'] in results:
+                results[row['campaign']]["dimensions"][dim] = {
+                    **{m: _change(row, m) for m in metrics},
+                    "cost_baseline": _round(totals.at[row['campaign'], 'cost_base'], 2),
+                    "cost_current": _round(totals.at[row['campaign'], 'cost_curr'], 2),
+                    "drivers": {m: [] for m in metrics},
+                }
+        for m in metrics:
+            for row in driver_rows(decomposed, m, TOP_PER_DIMENSION).to_dict('records'):
+                if row['campaign'] in results:
+                    results[row['campaign']]["dimensions"][dim]["drivers"][m].append(_driver_dict(row, dim))
+
+    for result in results.values():
+        drivers = [d for dim in result["dimensions"].values() for ds in dim["drivers"].values() for d in ds]
+        result["top_drivers"] = sorted(drivers, key=lambda d: -abs(d["impact_pct"] or 0))[:top]
+    return results
@@ -0,0 +1,156 @@
+"""
+Declarative anomaly rules.
+
+A rule spec describes when an entity is flagged at target day T:
+
+- min_rows:    rows needed inside the loaded 45-day window
+- efficiency:  on each of the last `consecutive_days` days, at least one
+               condition in `any` holds against the mean of the previous
+               `baseline_days` days. A condition is
+               {metric, direction: 'down' | 'up', ratio, label}:
+               'down' = value < baseline * ratio, 'up' = value > baseline * ratio
+- growth:      sum of `metric` over the last `window_days` days has not grown
+               compared with the same days `lag_days` earlier
+
+compile_rules() turns a spec into an AnomalyRules object whose evaluate()
+computes the flags for every entity and target day of a DayMatrix with array
+expressions only, sharing each baseline window between conditions. To add a
+rule, add a condition to the spec; anomaly_store.ENGINE_VERSION includes
+spec_hash() of the specs, so stored results are recomputed automatically.
+"""
+import hashlib
+import json
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+CAMPAIGN_RULES = {
+    "min_rows": 10,
+    "efficiency": {
+        "consecutive_days": 3,
+        "baseline_days": 7,
+        "any": [
+            {"metric": "roas", "direction": "down", "ratio": 0.8, "label": "ROAS"},
+            {"metric": "cpa", "direction": "up", "ratio": 1.25, "label": "CPA"},
+        ],
+    },
+    "growth": {"metric": "conversions", "window_days": 3, "lag_days": 7},
+}
+
+# Product table has no conversions / ROAS: CTR, CPC and clicks stand in for them
+PRODUCT_RULES = {
+    "min_rows": 10,
+    "efficiency": {
+        "consecutive_days": 3,
+        "baseline_days": 7,
+        "any": [
+            {"metric": "ctr", "direction": "down", "ratio": 0.8, "label": "CTR"},
+            {"metric": "avg_cpc", "direction": "up", "ratio": 1.25, "label": "CPC"},
+        ],
+    },
+    "growth": {"metric": "clicks", "window_days": 3, "lag_days": 7},
+}
+
+def spec_hash(*specs) -> str:
+    """Stable short hash of rule specs (key order and formatting do not matter)."""
+    raw = json.dumps(specs, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:12]
+
+
+Condition = namedtuple('Condition', ['metric', 'direction', 'ratio', 'label', 'test'])
+
+
+def _compile_condition(cond: dict) -> Condition:
+    metric = cond.get('metric')
+    direction = cond.get('direction')
+    ratio = float(cond.get('ratio', 0))
+    if not metric:
+        raise ValueError(f"Rule condition without metric: {cond}")
+    if ratio <= 0:
+        raise ValueError(f"Rule ratio must be positive: {cond}")
+    if direction == 'down':
+        test = lambda cur, base: (base > 0) & (cur < base * ratio)
+    elif direction == 'up':
+        test = lambda cur, base: (base > 0) & (cur > base * ratio)
+    else:
+        raise ValueError(f"Rule direction must be 'down' or 'up': {cond}")
+    return Condition(metric, direction, ratio, cond.get('label', metric.upper()), test)
+
+
+class AnomalyRules:
+    """A compiled rule spec (see module docstring)."""
+
+    def __init__(self, spec: dict):
+        efficiency = spec['efficiency']
+        growth = spec['growth']
+        self.min_rows = int(spec.get('min_rows', 0))
+        self.check_days = int(efficiency['consecutive_days'])
+        self.baseline_days = int(efficiency['baseline_days'])
+        self.conditions = [_compile_condition(c) for c in efficiency['any']]
+        self.growth_metric = growth['metric']
+        self.growth_window = int(growth.get('window_days', self.check_days))
+        self.growth_lag = int(growth['lag_days'])
+        if self.check_days < 1 or self.baseline_days < 1 or self.growth_window < 1 or not self.conditions:
+            raise ValueError(f"Invalid rule spec: {spec}")
+
+    @property
+    def metrics(self) -> list:
+        """Metrics read by the rules, in first-use order."""
+        names = [c.metric for c in self.conditions] + [self.growth_metric]
+        return list(dict.fromkeys(names))
+
+    @property
+    def history_days(self) -> int:
+        """Days before T (exclusive of T) that the rules look at."""
+        return max(self.check_days - 1 + self.baseline_days, self.growth_lag + self.growth_window - 1)
+
+    @property
+    def summary_prev(self) -> tuple:
+        """Display baseline window (day offsets from T): the baseline_days before the check days."""
+        return -(self.check_days - 1 + self.baseline_days), -self.check_days
+
+    def evaluate(self, mat, t_idx, lookback_days: int):
+        """
+        Flags for every entity and every day index in t_idx in one pass.
+        Returns (flags, current, previous, growth), all shaped (entities × targets).
+        """
+        t_idx = np.atleast_1d(np.asarray(t_idx))
+        flags = mat.rows_in_range(t_idx, -lookback_days, 0) >= self.min_rows
+
+        for offset in range(self.check_days):
+            d_idx = t_idx - offset
+            has_day = mat.window_count(d_idx, 0, 0) > 0
+            base_n = mat.window_count(d_idx, -self.baseline_days, -1)
+            baselines = {}
+            bad = np.zeros(flags.shape, dtype=bool)
+            for cond in self.conditions:
+                if cond.metric not in baselines:
+                    baselines[cond.metric] = mat.window_sum(cond.metric, d_idx, -self.baseline_days, -1) / np.maximum(base_n, 1)
+                bad |= cond.test(mat.first_values(cond.metric, d_idx), baselines[cond.metric])
+            flags &= has_day & (base_n > 0) & bad
+
+        current = mat.window_sum(self.growth_metric, t_idx, -(self.growth_window - 1), 0)
+        previous = mat.window_sum(self.growth_metric, t_idx,
+                                  -(self.growth_lag + self.growth_window - 1), -self.growth_lag)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            growth = np.where(previous > 0, (current - previous) / np.where(previous > 0, previous, 1), 0.0)
+        flags &= np.where(previous > 0, growth <= 0, current == 0)
+        return flags, current, previous, growth
+
+    def reasons(self, curr: dict, prev: dict) -> list:
+        """Reason fragments ('CTR -23%') from display-window means {metric: value}."""
+        details = []
+        for cond in self.conditions:
+            c, p = curr[cond.metric], prev[cond.metric]
+            if pd.isna(p) or pd.isna(c) or p <= 0:
+                continue
+            if cond.direction == 'down' and c < p * cond.ratio:
+                details.append(f"{cond.label} -{(p - c) / p * 100:.0f}%")
+            elif cond.direction == 'up' and c > p * cond.ratio:
+                details.append(f"{cond.label} +{(c - p) / p * 100:.0f}%")
+        return details
+
+
+def compile_rules(spec: dict) -> AnomalyRules:
+    return AnomalyRules(spec)
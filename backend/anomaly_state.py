@@ -0,0 +1,280 @@
+"""
+Incremental anomaly state.
+
+When a new day is imported, detection only needs to be evaluated for
+T = that day, but the batch path reloads 45 days of rows every time. This
+module keeps a persisted rolling state per campaign / item and advances it
+with just the new day's rows:
+
+- counts:  rows per day for the last LOOKBACK_DAYS + 1 days (the ">= 10 rows" check)
+- cells:   first-row value and daily sum of each metric for the last
+           METRIC_DAYS days - enough for the rule baselines, the growth
+           window and the display windows
+- label:   campaign_type per day (campaign) / latest title (product)
+
+Advancing costs O(entities) per new day regardless of the window length, and
+the day's anomalies are emitted straight from the state. Only rows whose
+stored bytes changed are written back; entities that dropped out of the window
+are deleted by key. The state date lives in anomaly_state_meta, so an
+unchanged row stays valid when the date moves.
+
+anomaly_state_meta also records the source table's data version the state was
+built from. When the table moved since then, the change log (change_log.py)
+tells whether any row dated on or before the state date changed (a back-dated
+correction in a whole-table import); if so the state is rebuilt from the
+window instead of only appending the new days.
+"""
+import json
+
+import numpy as np
+import pandas as pd
+
+from anomaly_engine import (
+    DayMatrix, build_day_matrix, campaign_records, product_records,
+    load_campaign_frame, load_product_frame, last_labels,
+    CAMPAIGN_METRICS, PRODUCT_METRICS, LOOKBACK_DAYS, CAMPAIGN, PRODUCT,
+)
+from ads_db import get_db_connection
+from data_version import get_data_version
+import anomaly_store
+import change_log
+
+STATE_DAYS = LOOKBACK_DAYS + 1
+# T plus the furthest day read by the rules or the display windows
+METRIC_DAYS = max(CAMPAIGN.history_days, PRODUCT.history_days,
+                  -CAMPAIGN.summary_prev[0], -PRODUCT.summary_prev[0]) + 1
+
+ENTITY_CONFIG = {
+    'campaign': {'key': 'campaign', 'metrics': CAMPAIGN_METRICS, 'loader': load_campaign_frame},
+    'product': {'key': 'item_id', 'metrics': PRODUCT_METRICS, 'loader': load_product_frame},
+}
+
+
+def init_anomaly_state(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS anomaly_state (
+            entity_type TEXT NOT NULL,
+            entity_key TEXT NOT NULL,
+            as_of_date TEXT NOT NULL,
+            label TEXT,
+            counts BLOB NOT NULL,
+            cells BLOB NOT NULL,
+            PRIMARY KEY (entity_type, entity_key)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS anomaly_state_meta (
+            entity_type TEXT PRIMARY KEY,
+            as_of_date TEXT NOT NULL,
+            data_version INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    if 'data_version' not in [r[1] for r in conn.execute("PRAGMA table_info(anomaly_state_meta)")]:
+        conn.execute("ALTER TABLE anomaly_state_meta ADD COLUMN data_version INTEGER NOT NULL DEFAULT 0")
+    conn.commit()
+
+
+def _labels_from_frame(entity_type: str, df: pd.DataFrame, mat: DayMatrix) -> dict:
+    """Initial labels: per-day campaign_type ring (campaign) or latest title (product)."""
+    if entity_type == 'product':
+        return last_labels(df, 'item_id', 'title')
+    labels = {}
+    if df.empty:
+        return labels
+    day = (df['date'] - mat.start).dt.days
+    firsts = df.assign(_day=day).drop_duplicates(['campaign', '_day'], keep='first')
+    for campaign, group in firsts.groupby('campaign', sort=False):
+        ring = [None] * mat.n_days
+        for d, camp_type in zip(group['_day'], group['campaign_type']):
+            if 0 <= d < mat.n_days:
+                ring[d] = camp_type
+        labels[campaign] = ring
+    return labels
+
+
+def _load_state(conn, entity_type: str, metrics: list):
+    """
+    (as_of, mat, labels, stored, version); stored maps every persisted entity_key to its
+    (label, counts, cells) column values so _save_state can write only the difference.
+    as_of / mat / labels are None when the state has to be rebuilt; version is the
+    source table's data version the state was built from.
+    """
+    rows = conn.execute(
+        "SELECT entity_key, label, counts, cells FROM anomaly_state WHERE entity_type = ? ORDER BY entity_key",
+        (entity_type,)
+    ).fetchall()
+    stored = {r[0]: tuple(r[1:]) for r in rows}
+    meta = conn.execute("SELECT as_of_date, data_version FROM anomaly_state_meta WHERE entity_type = ?",
+                        (entity_type,)).fetchone()
+    if not rows or meta is None:
+        return None, None, None, stored, 0
+
+    as_of = meta[0]
+    entities = [json.loads(r[0]) for r in rows]
+    n_metrics = len(metrics)
+    if any(len(r[3]) != 2 * n_metrics * METRIC_DAYS * 8 for r in rows):
+        # Stored with a different rule spec / metric layout: rebuild
+        return None, None, None, stored, meta[1]
+    counts = np.zeros((len(rows), STATE_DAYS), dtype=np.int64)
+    sums = {m: np.zeros((len(rows), STATE_DAYS)) for m in metrics}
+    first = {m: np.zeros((len(rows), STATE_DAYS)) for m in metrics}
+    labels = {}
+    for i, (key, label, count_blob, cell_blob) in enumerate(rows):
+        counts[i] = np.frombuffer(count_blob, dtype=np.int64)
+        cells = np.frombuffer(cell_blob, dtype=np.float64).reshape(2 * n_metrics, METRIC_DAYS)
+        for j, m in enumerate(metrics):
+            first[m][i, -METRIC_DAYS:] = cells[j]
+            sums[m][i, -METRIC_DAYS:] = cells[n_metrics + j]
+        labels[entities[i]] = json.loads(label) if label else None
+
+    start = pd.Timestamp(as_of) - pd.Timedelta(days=STATE_DAYS - 1)
+    index = pd.Index(entities)
+    order = np.argsort(index.to_numpy(), kind='stable')
+    mat = DayMatrix(index[order], start, counts[order],
+                    {m: v[order] for m, v in sums.items()}, {m: v[order] for m, v in first.items()})
+    return as_of, mat, labels, stored, meta[1]
+
+
+def _backdated(conn, table_name: str, since_version: int, as_of: str) -> bool:
+    """True when rows dated on or before as_of changed after since_version (or the change log cannot tell)"""
+    changes = change_log.get_changes(conn, table_name, since_version)
+    keys = changes['key_columns']
+    if changes['reset'] or 'date' not in keys:
+        return True
+    date_pos = keys.index('date')
+    dates = [row['date'] for row in changes['inserted'] + changes['updated']] + \
+            [key[date_pos] for key in changes['deleted']]
+    return any(str(d)[:10] <= as_of for d in dates if d is not None)
+
+
+def _save_state(conn, entity_type: str, mat: DayMatrix, labels: dict, metrics: list, stored: dict,
+                version: int):
+    """Upsert the entities whose stored values changed and delete the ones that left the window"""
+    as_of = mat.date_at(mat.n_days - 1)
+    # Entities without a single row in the window can never be flagged again until they reappear
+    alive = np.flatnonzero(mat.counts.sum(axis=1) > 0)
+    changed, keep = [], set()
+    for i in alive:
+        entity = mat.entities[i]
+        cells = np.concatenate([mat.first[m][i, -METRIC_DAYS:] for m in metrics] +
+                               [mat.sums[m][i, -METRIC_DAYS:] for m in metrics])
+        key = entity.item() if hasattr(entity, 'item') else entity
+        entity_key = json.dumps(key, ensure_ascii=False)
+        values = (json.dumps(labels.get(entity), ensure_ascii=False, default=str),
+                  mat.counts[i].astype(np.int64).tobytes(), cells.astype(np.float64).tobytes())
+        keep.add(entity_key)
+        if stored.get(entity_key) != values:
+            changed.append((entity_type, entity_key, as_of, *values))
+    dead = [(entity_type, k) for k in stored if k not in keep]
+
+    conn.executemany("DELETE FROM anomaly_state WHERE entity_type = ? AND entity_key = ?", dead)
+    conn.executemany("""
+        INSERT INTO anomaly_state (entity_type, entity_key, as_of_date, label, counts, cells) VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(entity_type, entity_key) DO UPDATE SET
+            as_of_date = excluded.as_of_date, label = excluded.label, counts = excluded.counts, cells = excluded.cells
+    """, changed)
+    conn.execute("""
+        INSERT INTO anomaly_state_meta (entity_type, as_of_date, data_version) VALUES (?, ?, ?)
+        ON CONFLICT(entity_type) DO UPDATE SET as_of_date = excluded.as_of_date, data_version = excluded.data_version
+    """, (entity_type, as_of, version))
+    conn.commit()
+
+
+def _roll(old: DayMatrix, recent: DayMatrix, metrics: list) -> DayMatrix:
+    """Shift `old` forward so it ends on `recent`'s last day and merge `recent`'s columns in."""
+    end = recent.start + pd.Timedelta(days=recent.n_days - 1)
+    start = end - pd.Timedelta(days=STATE_DAYS - 1)
+    entities = old.entities.union(recent.entities) if len(recent.entities) else old.entities
+    old_pos = entities.get_indexer(old.entities)
+    new_pos = entities.get_indexer(recent.entities)
+
+    shift = int((start - old.start).days)
+    new_off = int((recent.start - start).days)
+    keep = max(0, STATE_DAYS - shift)
+
+    def merge(old_mat, new_mat, dtype):
+        out = np.zeros((len(entities), STATE_DAYS), dtype=dtype)
+        if keep:
+            out[old_pos, :keep] = old_mat[:, shift:shift + keep]
+        out[np.ix_(new_pos, np.arange(new_off, STATE_DAYS))] = new_mat
+        return out
+
+    counts = merge(old.counts, recent.counts, np.int64)
+    sums = {m: merge(old.sums[m], recent.sums[m], np.float64) for m in metrics}
+    first = {m: merge(old.first[m], recent.first[m], np.float64) for m in metrics}
+    return DayMatrix(entities, start, counts, sums, first)
+
+
+def _roll_labels(entity_type: str, labels: dict, df: pd.DataFrame, shift: int, end) -> dict:
+    if entity_type == 'product':
+        labels.update(last_labels(df, 'item_id', 'title'))
+        return labels
+    rolled = {k: (ring[shift:] + [None] * shift) if ring else [None] * STATE_DAYS for k, ring in labels.items()}
+    if not df.empty:
+        firsts = df.drop_duplicates(['campaign', 'date'], keep='first')
+        for campaign, d, camp_type in zip(firsts['campaign'], firsts['date'], firsts['campaign_type']):
+            ring = rolled.setdefault(campaign, [None] * STATE_DAYS)
+            ring[STATE_DAYS - 1 - int((end - d).days)] = camp_type
+    return rolled
+
+
+def _campaign_types(mat: DayMatrix, labels: dict) -> dict:
+    """campaign_type of the first row in the window (like group['campaign_type'].iloc[0])."""
+    first_day = np.argmax(mat.counts > 0, axis=1)
+    types = {}
+    for i, campaign in enumerate(mat.entities):
+        ring = labels.get(campaign) or []
+        types[campaign] = ring[first_day[i]] if first_day[i] < len(ring) else 'Unknown'
+    return types
+
+
+def advance_anomaly_state(entity_type: str, new_date: str, risk_batch_fn=None, rebuild: bool = False) -> list:
+    """
+    Advance the persisted state of `entity_type` to `new_date` and return that
+    day's anomalies (also written to anomaly_results).
+
+    Only rows after the stored as_of_date are read. The state is rebuilt from a
+    full 45-day window when it does not exist yet, when `new_date` is not after
+    the stored date, when an import changed rows dated on or before it
+    (backfill / corrections, see _backdated) or when `rebuild` is set.
+    """
+    config = ENTITY_CONFIG[entity_type]
+    metrics = config['metrics']
+    conn = get_db_connection()
+    try:
+        init_anomaly_state(conn)
+        anomaly_store.init_anomaly_store(conn)
+        new_dt = pd.Timestamp(new_date)
+        table_name = anomaly_store.SOURCES[entity_type]['table']
+        version = get_data_version(table_name, conn)
+
+        as_of, mat, labels, stored, state_version = _load_state(conn, entity_type, metrics)
+        if rebuild or (as_of and state_version != version and _backdated(conn, table_name, state_version, as_of)):
+            as_of = None
+        gap = (new_dt - pd.Timestamp(as_of)).days if as_of else 0
+        if as_of is None or gap <= 0 or gap >= STATE_DAYS:
+            start = new_dt - pd.Timedelta(days=STATE_DAYS - 1)
+            df = config['loader'](conn, start.strftime('%Y-%m-%d'), new_date)
+            mat = build_day_matrix(df, config['key'], metrics, start, new_dt)
+            labels = _labels_from_frame(entity_type, df, mat)
+        else:
+            recent_start = pd.Timestamp(as_of) + pd.Timedelta(days=1)
+            df = config['loader'](conn, recent_start.strftime('%Y-%m-%d'), new_date)
+            recent = build_day_matrix(df, config['key'], metrics, recent_start, new_dt)
+            mat = _roll(mat, recent, metrics)
+            labels = _roll_labels(entity_type, labels, df, gap, new_dt)
+
+        t = mat.n_days - 1
+        if len(mat.entities) == 0:
+            anomalies = []
+        elif entity_type == 'campaign':
+            types = _campaign_types(mat, labels)
+            anomalies = campaign_records(mat, t, lambda e, _: types.get(mat.entities[e], 'Unknown'), risk_batch_fn)[mat.date_at(t)]
+        else:
+            anomalies = product_records(mat, t, lambda e, _: labels.get(mat.entities[e], 'Unknown Product'))[mat.date_at(t)]
+
+        _save_state(conn, entity_type, mat, labels, metrics, stored, version)
+        anomaly_store.store_results(conn, entity_type, new_date, anomalies, version)
+        return anomalies
+    finally:
+        conn.close()
@@ -0,0 +1,266 @@
+"""
+Precomputed anomaly results.
+
+The Anomaly / Product monitors let users scrub through dates, and each change
+used to rerun the full detection for that target_date. Results are now kept in
+`anomaly_results` (one row per entity per date) and only recomputed when the
+source rows a date depends on have changed.
+
+Freshness is tracked per date in `anomaly_result_dates`:
+- data_version:      table version (see data_version.py) at the last check
+- engine_version:    ENGINE_VERSION the rows were computed with
+- source_signature:  content hash of the source rows the date depends on
+If the table version (non-zero) and engine version are unchanged the stored
+rows are served directly; otherwise the date's signature is recomputed and
+only a real change triggers a new detection run.
+"""
+import json
+import hashlib
+from datetime import datetime, timedelta
+
+from ads_db import get_db_connection
+from data_version import get_data_version
+from anomaly_rules import spec_hash, CAMPAIGN_RULES, PRODUCT_RULES
+from anomaly_engine import LOOKBACK_DAYS
+
+# Stored dates are recomputed whenever ENGINE_VERSION changes. Rule spec and
+# window changes are picked up by the hash; bump ENGINE_REVISION only for
+# changes to the detection code itself.
+ENGINE_REVISION = 1
+ENGINE_VERSION = f"{ENGINE_REVISION}-{spec_hash(CAMPAIGN_RULES, PRODUCT_RULES, LOOKBACK_DAYS)}"
+# Longest date run handed to one range detection (bounds the loaded frame)
+REFRESH_RUN_DAYS = 92
+
+# Source rows of each detector. A date's fingerprint is the sha1 of every
+# listed column of its rows in rowid order (the detectors read the first row
+# of a cell, so order matters too).
+# window_days=None means the result depends on all history <= T
+# (campaign cold-start / learning-phase checks look back to the first day).
+SOURCES = {
+    'campaign': {
+        'table': 'campaign',
+        'window_days': None,
+        'columns': ['campaign', 'campaign_type', 'roas', 'cpa', 'conversions', 'cost', 'budget'],
+    },
+    'product': {
+        'table': 'product',
+        'window_days': 45,
+        'columns': ['item_id', 'title', 'cost', 'clicks', 'impr', 'ctr', 'avg_cpc'],
+    },
+}
+
+
+def init_anomaly_store(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS anomaly_results (
+            entity_type TEXT NOT NULL,
+            target_date TEXT NOT NULL,
+            entity_id TEXT NOT NULL,
+            rank INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            PRIMARY KEY (entity_type, target_date, entity_id)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS anomaly_result_dates (
+            entity_type TEXT NOT NULL,
+            target_date TEXT NOT NULL,
+            source_signature TEXT NOT NULL,
+            data_version INTEGER NOT NULL DEFAULT 0,
+            engine_version TEXT NOT NULL DEFAULT '',
+            anomaly_count INTEGER NOT NULL DEFAULT 0,
+            computed_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (entity_type, target_date)
+        )
+    """)
+    columns = [r[1] for r in conn.execute("PRAGMA table_info(anomaly_result_dates)")]
+    if 'engine_version' not in columns:
+        # Stores created before the column: '' never matches, so old rows are re-checked
+        conn.execute("ALTER TABLE anomaly_result_dates ADD COLUMN engine_version TEXT NOT NULL DEFAULT ''")
+    conn.commit()
+
+
+def date_signatures(conn, entity_type: str, start_date: str, end_date: str) -> dict:
+    """
+    {date: signature} for every calendar date in [start_date, end_date].
+    One GROUP BY query covers the whole range.
+    """
+    source = SOURCES[entity_type]
+    window = source['window_days']
+    start_dt = datetime.strptime(start_date, '%Y-%m-%d')
+    end_dt = datetime.strptime(end_date, '%Y-%m-%d')
+
+    params = [end_date]
+    start_filter = ""
+    if window is not None:
+        start_filter = "AND date >= ?"
+        params.append((start_dt - timedelta(days=window)).strftime('%Y-%m-%d'))
+    # quote() keeps NULL, numbers and text apart; the ordered subquery feeds
+    # group_concat the rows of each date in rowid order
+    row_value = " || ',' || ".join(f'quote("{c}")' for c in source['columns'])
+    sql = f"""
+        SELECT date, group_concat(row_value, char(10))
+        FROM (SELECT date, {row_value} AS row_value FROM "{source['table']}"
+              WHERE date <= ? {start_filter} ORDER BY date, rowid)
+        GROUP BY date
+    """
+    day_sigs = {row[0]: hashlib.sha1(row[1].encode('utf-8')).hexdigest() for row in conn.execute(sql, params)}
+
+    result = {}
+    if window is None:
+        # Chain hash: signature(T) covers every day <= T
+        chain = hashlib.sha1(ENGINE_VERSION.encode())
+        for day in sorted(d for d in day_sigs if d < start_date):
+            chain.update(f"{day}{day_sigs[day]}".encode())
+        d = start_dt
+        while d <= end_dt:
+            day = d.strftime('%Y-%m-%d')
+            if day in day_sigs:
+                chain.update(f"{day}{day_sigs[day]}".encode())
+            result[day] = chain.hexdigest()
+            d += timedelta(days=1)
+        return result
+
+    d = start_dt
+    while d <= end_dt:
+        h = hashlib.sha1(ENGINE_VERSION.encode())
+        for k in range(window, -1, -1):
+            day = (d - timedelta(days=k)).strftime('%Y-%m-%d')
+            if day in day_sigs:
+                h.update(f"{day}{day_sigs[day]}".encode())
+        result[d.strftime('%Y-%m-%d')] = h.hexdigest()
+        d += timedelta(days=1)
+    return result
+
+
+def _store(conn, entity_type: str, target_date: str, signature: str, version: int, anomalies: list):
+    conn.execute("DELETE FROM anomaly_results WHERE entity_type = ? AND target_date = ?", (entity_type, target_date))
+    id_key = 'campaign' if entity_type == 'campaign' else 'item_id'
+    conn.executemany(
+        "INSERT OR REPLACE INTO anomaly_results (entity_type, target_date, entity_id, rank, payload) VALUES (?, ?, ?, ?, ?)",
+        [(entity_type, target_date, str(a.get(id_key, a.get('id'))), i, json.dumps(a, ensure_ascii=False))
+         for i, a in enumerate(anomalies)]
+    )
+    conn.execute("""
+        INSERT OR REPLACE INTO anomaly_result_dates
+            (entity_type, target_date, source_signature, data_version, engine_version, anomaly_count, computed_at)
+        VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+    """, (entity_type, target_date, signature, version, ENGINE_VERSION, len(anomalies)))
+    conn.commit()
+
+
+def store_results(conn, entity_type: str, target_date: str, anomalies: list, version: int, signature: str = ""):
+    """
+    Store anomalies computed outside this module (e.g. anomaly_state) for target_date.
+
+    With the default empty signature the rows are served only while the source
+    table's data version is still `version`: once it moves, "" never matches a
+    computed signature, so the next reader or refresh recomputes the date.
+    Pass the date's real signature instead to keep them valid across versions.
+    """
+    _store(conn, entity_type, target_date, signature, version, anomalies)
+
+
+def _load(conn, entity_type: str, target_date: str) -> list:
+    rows = conn.execute(
+        "SELECT payload FROM anomaly_results WHERE entity_type = ? AND target_date = ? ORDER BY rank",
+        (entity_type, target_date)
+    ).fetchall()
+    return [json.loads(r[0]) for r in rows]
+
+
+def latest_date(conn, entity_type: str):
+    row = conn.execute(f"SELECT MAX(date) FROM {SOURCES[entity_type]['table']}").fetchone()
+    return row[0] if row else None
+
+
+def get_anomaly_results(entity_type: str, target_date: str, detector) -> list:
+    """
+    Serve anomalies for one date from the results table, recomputing via
+    `detector(target_date)` only when the date's source rows have changed.
+    """
+    conn = get_db_connection()
+    try:
+        init_anomaly_store(conn)
+        if not target_date:
+            target_date = latest_date(conn, entity_type)
+            if not target_date:
+                return []
+
+        version = get_data_version(SOURCES[entity_type]['table'], conn)
+        row = conn.execute(
+            "SELECT source_signature, data_version, engine_version FROM anomaly_result_dates "
+            "WHERE entity_type = ? AND target_date = ?",
+            (entity_type, target_date)
+        ).fetchone()
+        # Version 0: the table was never bumped, so the version says nothing about its rows
+        if row and version and row[1] == version and row[2] == ENGINE_VERSION:
+            return _load(conn, entity_type, target_date)
+
+        # Signatures are seeded with ENGINE_VERSION, so a match also means same engine
+        signature = date_signatures(conn, entity_type, target_date, target_date)[target_date]
+        if row and row[0] == signature:
+            conn.execute(
+                "UPDATE anomaly_result_dates SET data_version = ?, engine_version = ? WHERE entity_type = ? AND target_date = ?",
+                (version, ENGINE_VERSION, entity_type, target_date)
+            )
+            conn.commit()
+            return _load(conn, entity_type, target_date)
+
+        anomalies = detector(target_date)
+        _store(conn, entity_type, target_date, signature, version, anomalies)
+        return anomalies
+    finally:
+        conn.close()
+
+
+def _runs(dates: list, max_days: int):
+    """Consecutive sorted dates split into (first, last) runs of at most max_days"""
+    runs = []
+    for day in dates:
+        dt = datetime.strptime(day, '%Y-%m-%d')
+        if runs:
+            first, last = runs[-1]
+            if (dt - datetime.strptime(last, '%Y-%m-%d')).days == 1 and \
+                    (dt - datetime.strptime(first, '%Y-%m-%d')).days < max_days:
+                runs[-1] = (first, day)
+                continue
+        runs.append((day, day))
+    return runs
+
+
+def refresh_anomaly_results(entity_type: str, start_date: str, end_date: str, range_detector,
+                            force: bool = False) -> dict:
+    """
+    Batch job: make sure every date in [start_date, end_date] has stored
+    results. Dates whose source signature is unchanged are skipped; the rest
+    are detected by `range_detector(first, last) -> {date: anomalies}`, once
+    per run of consecutive dates (at most REFRESH_RUN_DAYS long).
+    """
+    conn = get_db_connection()
+    try:
+        init_anomaly_store(conn)
+        version = get_data_version(SOURCES[entity_type]['table'], conn)
+        signatures = date_signatures(conn, entity_type, start_date, end_date)
+        stored = dict(conn.execute(
+            "SELECT target_date, source_signature FROM anomaly_result_dates WHERE entity_type = ? AND target_date BETWEEN ? AND ?",
+            (entity_type, start_date, end_date)
+        ).fetchall())
+
+        stale = [d for d, signature in signatures.items() if force or stored.get(d) != signature]
+        for first, last in _runs(stale, REFRESH_RUN_DAYS):
+            by_date = range_detector(first, last)
+            for target_date in signatures:
+                if first <= target_date <= last:
+                    _store(conn, entity_type, target_date, signatures[target_date], version,
+                           by_date.get(target_date, []))
+
+        conn.execute(
+            "UPDATE anomaly_result_dates SET data_version = ?, engine_version = ? "
+            "WHERE entity_type = ? AND target_date BETWEEN ? AND ?",
+            (version, ENGINE_VERSION, entity_type, start_date, end_date)
+        )
+        conn.commit()
+        return {"entity_type": entity_type, "dates": len(signatures), "recomputed": len(stale)}
+    finally:
+        conn.close()
@@ -0,0 +1,119 @@
+"""
+Apache Arrow IPC streaming for bulk table reads.
+
+Rows are fetched from the cursor in batches of BATCH_ROWS and each batch is
+written as one Arrow record batch, so the response starts after the first
+batch and memory stays bounded. The schema comes from the declared SQLite
+column types (INTEGER -> int64, REAL / NUMERIC -> float64, anything else ->
+string); values that do not fit a numeric column become null. SQLite keeps
+non-integral floats stored in an INTEGER column as REAL, so such columns are
+promoted to float64 (see promote_real_columns) instead of being truncated.
+
+pyarrow is optional: without it available() is False and the endpoint
+answers with an error instead of the stream.
+"""
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+BATCH_ROWS = 65536
+
+
+def available() -> bool:
+    return pa is not None
+
+
+def arrow_type(declared: str):
+    declared = (declared or '').upper()
+    if 'INT' in declared:
+        return pa.int64()
+    if any(t in declared for t in ('REAL', 'FLOA', 'DOUB', 'NUM', 'DEC')):
+        return pa.float64()
+    return pa.string()
+
+
+def promote_real_columns(conn, table_name: str, columns: list, declared: dict) -> dict:
+    """
+    `declared` with INTEGER columns that hold REAL values (one scan of the
+    table) declared REAL, so they stream as float64.
+    """
+    ints = [c for c in columns if arrow_type(declared.get(c)) == pa.int64()]
+    if not ints:
+        return declared
+    flags = conn.execute(f"""
+        SELECT {", ".join(f"MAX(typeof(\"{c}\") = 'real')" for c in ints)} FROM "{table_name}"
+    """).fetchone()
+    return {**declared, **{c: 'REAL' for c, flag in zip(ints, flags) if flag}}
+
+
+def _to_int(v):
+    if isinstance(v, float) and not v.is_integer():
+        raise ValueError(f"{v} is not integral")
+    return int(v)
+
+
+def _coerce(values: list, typ):
+    if typ == pa.string():
+        return [None if v is None else str(v) for v in values]
+    cast = _to_int if typ == pa.int64() else float
+    out = []
+    for v in values:
+        try:
+            out.append(None if v is None or v == '' else cast(v))
+        except (TypeError, ValueError, OverflowError):
+            out.append(None)
+    return out
+
+
+def _column_array(values: list, typ):
+    try:
+        return pa.array(values, type=typ)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError, ValueError, OverflowError):
+        return pa.array(_coerce(values, typ), type=typ)
+
+
+class _ChunkSink:
+    """Write-only file object collecting the IPC bytes between yields."""
+
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_query(connect, query: str, params: list, columns: list, declared: dict, batch_rows: int = BATCH_ROWS):
+    """
+    Generator of Arrow IPC stream bytes for `query`, whose first len(columns)
+    result columns are `columns` ({column: declared type} in `declared`).
+    connect() opens the connection; it is closed when the stream ends.
+    """
+    schema = pa.schema([(c, arrow_type(declared.get(c))) for c in columns])
+    sink = _ChunkSink()
+    conn = connect()
+    try:
+        cursor = conn.execute(query, params)
+        with pa.ipc.new_stream(sink, schema) as writer:
+            while True:
+                rows = cursor.fetchmany(batch_rows)
+                if not rows:
+                    break
+                arrays = [_column_array(list(values), field.type) for values, field in zip(zip(*rows), schema)]
+                writer.write_batch(pa.record_batch(arrays, schema=schema))
+                yield sink.take()
+        yield sink.take()
+    finally:
+        conn.close()
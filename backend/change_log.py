@@ -0,0 +1,204 @@
+"""
+Import change log for delta sync (/api/tables/{table}/changes).
+
+The import replaces whole tables. replace_table() writes the new content to a
+staging table, diffs it against the current table in SQL (EXCEPT over full
+rows with their multiplicity, so added or removed duplicate rows count) and
+then, in one transaction, swaps it in, bumps the table's data version and
+records the diff at that version as key-level operations (insert / update /
+delete). Readers never see the new rows without the matching version and log.
+
+A key is a group of rows (KEY_COLUMNS, e.g. date + campaign), not
+necessarily a single row. An inserted or updated key means "replace every row
+with this key by the rows returned". Only keys are logged; rows are read from
+the current table when changes are requested. Clients whose since_version is
+older than the logged history (first import, schema change, pruned log) get
+reset=true and must reload the table.
+"""
+import json
+
+from data_version import bump_data_version, get_data_version
+
+KEY_COLUMNS = {
+    'campaign': ['date', 'campaign'],
+    'product': ['date', 'item_id'],
+    'search_term': ['date', 'campaign', 'search_term'],
+    'channel': ['date', 'campaigns'],
+}
+DEFAULT_KEY_COLUMNS = ['date', 'campaign']
+MAX_LOGGED_VERSIONS = 60
+
+
+def init_change_log(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS table_changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            op TEXT NOT NULL,
+            row_key TEXT NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_table_changes ON table_changes (table_name, version)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS table_change_meta (
+            table_name TEXT PRIMARY KEY,
+            min_version INTEGER NOT NULL,
+            key_columns TEXT NOT NULL
+        )
+    """)
+
+
+def _columns(conn, table_name: str) -> list:
+    return [row[1] for row in conn.execute(f'PRAGMA table_info("{table_name}")')]
+
+
+def _quoted(columns: list, alias: str = None) -> str:
+    prefix = f"{alias}." if alias else ""
+    return ", ".join(f'{prefix}"{c}"' for c in columns)
+
+
+def key_columns(table_name: str, columns: list) -> list:
+    """Configured key columns present in the table; all columns when none are"""
+    keys = [c for c in KEY_COLUMNS.get(table_name, DEFAULT_KEY_COLUMNS) if c in columns]
+    return keys or list(columns)
+
+
+def _keys(conn, query: str) -> set:
+    return {tuple(row) for row in conn.execute(query)}
+
+
+def _diff(conn, old: str, new: str, columns: list, keys: list) -> dict:
+    cols, k = _quoted(columns), _quoted(keys)
+    # Each distinct row with its count, so a key whose duplicate rows changed differs too
+    changed = _keys(conn, f"""
+        WITH n AS MATERIALIZED (SELECT {cols}, COUNT(*) AS _rows FROM "{new}" GROUP BY {cols}),
+             o AS MATERIALIZED (SELECT {cols}, COUNT(*) AS _rows FROM "{old}" GROUP BY {cols})
+        SELECT {k} FROM (SELECT * FROM n EXCEPT SELECT * FROM o)
+        UNION
+        SELECT {k} FROM (SELECT * FROM o EXCEPT SELECT * FROM n)
+    """)
+    if not changed:
+        return {"insert": [], "update": [], "delete": []}
+    inserted = _keys(conn, f'SELECT {k} FROM "{new}" EXCEPT SELECT {k} FROM "{old}"')
+    deleted = _keys(conn, f'SELECT {k} FROM "{old}" EXCEPT SELECT {k} FROM "{new}"')
+    return {
+        "insert": sorted(inserted, key=repr),
+        "update": sorted(changed - inserted - deleted, key=repr),
+        "delete": sorted(deleted, key=repr),
+    }
+
+
+def replace_table(conn, table_name: str, df) -> dict:
+    """
+    Replace table_name with DataFrame df, bump its data version and log the diff,
+    all in one transaction. Returns {"keys", "changes", "version"}; changes is None
+    when there was no comparable old table (missing, or columns changed).
+    """
+    staging = f"{table_name}__staging"
+    df.to_sql(staging, conn, if_exists='replace', index=False)
+    old_columns, new_columns = _columns(conn, table_name), _columns(conn, staging)
+    keys = key_columns(table_name, new_columns)
+    changes = None
+    if old_columns and sorted(old_columns) == sorted(new_columns):
+        changes = _diff(conn, table_name, staging, new_columns, keys)
+    replaced = {"keys": keys, "changes": changes}
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        previous_version = get_data_version(table_name, conn)
+        conn.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+        conn.execute(f'ALTER TABLE "{staging}" RENAME TO "{table_name}"')
+        # Invalidates caches / precomputed anomaly results built on this table
+        replaced["version"] = bump_data_version([table_name], conn, commit=False)
+        record_changes(conn, table_name, replaced["version"], previous_version, replaced)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        conn.execute(f'DROP TABLE IF EXISTS "{staging}"')
+        raise
+    return replaced
+
+
+def record_changes(conn, table_name: str, version: int, previous_version: int, replaced: dict):
+    """
+    Log the result of replace_table at `version` (the table's data version before it was
+    previous_version). Runs in the caller's transaction; the caller commits.
+    """
+    init_change_log(conn)
+    meta = conn.execute("SELECT min_version, key_columns FROM table_change_meta WHERE table_name = ?",
+                        (table_name,)).fetchone()
+    keys_json = json.dumps(replaced["keys"])
+    if replaced["changes"] is None or (meta and meta[1] != keys_json):
+        # Nothing comparable before this version: older clients must reload
+        conn.execute("DELETE FROM table_changes WHERE table_name = ?", (table_name,))
+        min_version = version
+    else:
+        min_version = meta[0] if meta else previous_version
+        conn.executemany(
+            "INSERT INTO table_changes (table_name, version, op, row_key) VALUES (?, ?, ?, ?)",
+            [(table_name, version, op, json.dumps(list(key), default=str))
+             for op, keys in replaced["changes"].items() for key in keys])
+
+    # Keep the last MAX_LOGGED_VERSIONS versions of this table
+    cutoff = conn.execute("""
+        SELECT version FROM (SELECT DISTINCT version FROM table_changes WHERE table_name = ? ORDER BY version DESC)
+        LIMIT 1 OFFSET ?
+    """, (table_name, MAX_LOGGED_VERSIONS)).fetchone()
+    if cutoff:
+        conn.execute("DELETE FROM table_changes WHERE table_name = ? AND version <= ?", (table_name, cutoff[0]))
+        min_version = max(min_version, cutoff[0])
+
+    conn.execute("""
+        INSERT INTO table_change_meta (table_name, min_version, key_columns) VALUES (?, ?, ?)
+        ON CONFLICT(table_name) DO UPDATE SET min_version = excluded.min_version, key_columns = excluded.key_columns
+    """, (table_name, min_version, keys_json))
+
+
+def get_changes(conn, table_name: str, since_version: int) -> dict:
+    """
+    Keys changed after since_version, collapsed per key: {"version", "reset",
+    "key_columns", "columns", "inserted": rows, "updated": rows, "deleted": [key values]}.
+    """
+    init_change_log(conn)
+    version = get_data_version(table_name, conn)
+    columns = _columns(conn, table_name)
+    meta = conn.execute("SELECT min_version, key_columns FROM table_change_meta WHERE table_name = ?",
+                        (table_name,)).fetchone()
+    keys = json.loads(meta[1]) if meta else key_columns(table_name, columns)
+    result = {"table": table_name, "since_version": since_version, "version": version, "reset": False,
+              "key_columns": keys, "columns": columns, "inserted": [], "updated": [], "deleted": []}
+    if since_version >= version:
+        return result
+    if meta is None or since_version < meta[0]:
+        result["reset"] = True
+        return result
+
+    first_op, last_op = {}, {}
+    for op, row_key in conn.execute(
+            "SELECT op, row_key FROM table_changes WHERE table_name = ? AND version > ? ORDER BY version, id",
+            (table_name, since_version)):
+        first_op.setdefault(row_key, op)
+        last_op[row_key] = op
+
+    wanted = {}
+    for row_key, op in last_op.items():
+        if op == 'delete':
+            if first_op[row_key] != 'insert':
+                result["deleted"].append(json.loads(row_key))
+        else:
+            wanted[row_key] = 'inserted' if first_op[row_key] == 'insert' else 'updated'
+    if not wanted:
+        return result
+
+    key_defs = ", ".join(f"k{i}" for i in range(len(keys)))
+    conn.execute("DROP TABLE IF EXISTS temp._delta_keys")
+    conn.execute(f"CREATE TEMP TABLE _delta_keys ({key_defs}, bucket TEXT)")
+    conn.executemany(f"INSERT INTO temp._delta_keys VALUES ({', '.join('?' * (len(keys) + 1))})",
+                     [(*json.loads(row_key), bucket) for row_key, bucket in wanted.items()])
+    join = " AND ".join(f't."{c}" IS d.k{i}' for i, c in enumerate(keys))
+    for row in conn.execute(f'SELECT {_quoted(columns, "t")}, d.bucket FROM "{table_name}" t '
+                            f'JOIN temp._delta_keys d ON {join}'):
+        result[row[-1]].append(dict(zip(columns, row[:-1])))
+    conn.execute("DROP TABLE temp._delta_keys")
+    return result
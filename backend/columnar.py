@@ -0,0 +1,78 @@
+"""
+Compact table payloads.
+
+The default table responses are {"columns": [...], "data": [{col: value}, ...]},
+which repeats every column name in every row. Opt-in formats send the names
+once:
+
+- rows:     {"format": "rows", "columns": [...], "rows": [[v1, v2, ...], ...]}
+- columnar: {"format": "columnar", "columns": [...], "data": {col: [values]}}
+
+Rows go straight from cursor tuples into orjson, without a dict per row.
+"""
+from operator import itemgetter
+
+import orjson
+from starlette.responses import Response
+
+FORMATS = ('rows', 'columnar')
+
+
+def format_error(fmt: str):
+    """{"error"} payload for an unsupported fmt, None for no fmt or a valid one."""
+    if fmt and fmt not in FORMATS:
+        return {"error": f"Unsupported format '{fmt}'. Use one of: {', '.join(FORMATS)}"}
+    return None
+
+
+def respond(fmt: str, compute, **extra):
+    """
+    Endpoint helper: validate fmt, run compute() and add `extra` keys to a
+    successful payload. Compact formats are encoded with orjson here; without
+    fmt the dict is returned for FastAPI's own encoding.
+    """
+    error = format_error(fmt)
+    if error:
+        return error
+    result = compute()
+    if extra and isinstance(result, dict) and 'error' not in result:
+        result.update(extra)
+    return Response(dumps(result), media_type="application/json") if fmt else result
+
+
+def check_format(fmt: str):
+    if fmt not in FORMATS:
+        raise ValueError(f"Unsupported format '{fmt}'. Use one of: {', '.join(FORMATS)}")
+
+
+def project(rows: list, columns: list, wanted: list) -> list:
+    """Tuples of `wanted` columns (in that order) from tuples laid out as `columns`."""
+    if wanted == columns:
+        return rows
+    idx = [columns.index(c) for c in wanted]
+    if len(idx) == 1:
+        return [(row[idx[0]],) for row in rows]
+    getter = itemgetter(*idx)
+    return [getter(row) for row in rows]
+
+
+def table_payload(columns: list, rows: list, fmt: str, **extra) -> dict:
+    """Payload for tuples `rows` laid out as `columns`; extra keys are passed through."""
+    check_format(fmt)
+    if fmt == 'rows':
+        payload = {"format": "rows", "columns": columns, "rows": rows}
+    else:
+        arrays = list(zip(*rows)) if rows else [() for _ in columns]
+        payload = {"format": "columnar", "columns": columns, "data": dict(zip(columns, arrays))}
+    payload.update(extra)
+    return payload
+
+
+def records_payload(columns: list, records: list, fmt: str, **extra) -> dict:
+    """Same as table_payload for rows that are already dicts (missing keys -> null)."""
+    return table_payload(columns, [tuple(r.get(c) for c in columns) for r in records], fmt, **extra)
+
+
+def dumps(payload) -> bytes:
+    # NaN / inf become null; numpy scalars and arrays from pandas paths are accepted
+    return orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
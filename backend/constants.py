@@ -0,0 +1,13 @@
+"""
+Table groupings shared by the service and the HTTP layer.
+
+Kept apart from agent_service so http_cache can read them without importing
+the LLM / agent stack.
+"""
+
+# Per-campaign breakdown tables served by /api/campaigns/{name}/details
+CAMPAIGN_DETAIL_TABLES = (
+    'search_term', 'channel', 'asset',
+    'audience', 'age', 'gender',
+    'location_by_cities_all_campaign', 'ad_schedule'
+)
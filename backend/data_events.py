@@ -0,0 +1,128 @@
+"""
+Data-change events for the /api/events Server-Sent Events channel.
+
+Writers publish an event (import finished, anomaly precompute finished, agent
+rules changed) with the affected tables and the resulting data version. Events
+are rows of the data_events table rather than in-process messages, so the
+import script running in its own process reaches the API process too. Each SSE
+connection tails the table by id (a primary-key range read), and a client that
+reconnects with Last-Event-ID gets the events it missed.
+"""
+import asyncio
+import json
+import sqlite3
+
+from ads_db import get_db_connection
+from data_version import bump_data_version, get_data_version
+
+EVENT_TYPES = ('import', 'anomalies', 'rules')
+KEEP_EVENTS = 1000
+POLL_SECONDS = 1.0
+HEARTBEAT_SECONDS = 15.0
+RETRY_MS = 3000
+
+
+def init_data_events(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS data_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event TEXT NOT NULL,
+            tables TEXT NOT NULL,
+            data_version INTEGER NOT NULL,
+            detail TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def publish_event(event: str, tables: list, detail: dict = None, conn=None, bump: bool = True) -> int:
+    """
+    Record `event` for `tables` and return its id. bump=True also bumps the
+    tables' data version first; writers that already bumped (the import) pass False.
+    """
+    if event not in EVENT_TYPES:
+        raise ValueError(f"Unknown event '{event}'. Use one of: {', '.join(EVENT_TYPES)}")
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db_connection()
+    try:
+        version = bump_data_version(tables, conn) if bump else get_data_version(conn=conn)
+        init_data_events(conn)
+        cursor = conn.execute(
+            "INSERT INTO data_events (event, tables, data_version, detail) VALUES (?, ?, ?, ?)",
+            (event, json.dumps(list(tables)), version, json.dumps(detail, default=str) if detail else None))
+        event_id = cursor.lastrowid
+        conn.execute("DELETE FROM data_events WHERE id <= ?", (event_id - KEEP_EVENTS,))
+        conn.commit()
+        return event_id
+    finally:
+        if own_conn:
+            conn.close()
+
+
+def get_events_since(last_id: int, limit: int = 100) -> list:
+    conn = get_db_connection()
+    try:
+        init_data_events(conn)
+        rows = conn.execute("""
+            SELECT id, event, tables, data_version, detail, created_at
+            FROM data_events WHERE id > ? ORDER BY id LIMIT ?
+        """, (last_id, limit)).fetchall()
+    finally:
+        conn.close()
+    return [{
+        "id": row[0],
+        "event": row[1],
+        "tables": json.loads(row[2]),
+        "data_version": row[3],
+        "detail": json.loads(row[4]) if row[4] else None,
+        "created_at": row[5],
+    } for row in rows]
+
+
+def latest_event_id() -> int:
+    conn = get_db_connection()
+    try:
+        init_data_events(conn)
+        return conn.execute("SELECT COALESCE(MAX(id), 0) FROM data_events").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def format_sse(event: str, data: dict, event_id: int = None) -> str:
+    lines = [f"id: {event_id}"] if event_id is not None else []
+    lines += [f"event: {event}", f"data: {json.dumps(data, ensure_ascii=False)}"]
+    return "\n".join(lines) + "\n\n"
+
+
+async def stream_events(last_event_id: int = None, is_disconnected=None):
+    """
+    SSE text stream: a 'connected' event with the current data version, then
+    every event after last_event_id (default: only new ones), with a comment
+    heartbeat so proxies keep the connection open.
+    """
+    if last_event_id is None:
+        last_event_id = await asyncio.to_thread(latest_event_id)
+    version = await asyncio.to_thread(get_data_version)
+    yield f"retry: {RETRY_MS}\n\n"
+    yield format_sse("connected", {"data_version": version, "last_event_id": last_event_id})
+
+    idle = 0.0
+    while True:
+        if is_disconnected is not None and await is_disconnected():
+            return
+        try:
+            events = await asyncio.to_thread(get_events_since, last_event_id)
+        except sqlite3.Error as e:
+            print(f"Data event poll failed: {e}")
+            events = []
+        for event in events:
+            last_event_id = event["id"]
+            yield format_sse(event["event"], event, event["id"])
+        if events:
+            idle = 0.0
+        elif idle >= HEARTBEAT_SECONDS:
+            idle = 0.0
+            yield ": keepalive\n\n"
+        await asyncio.sleep(POLL_SECONDS)
+        idle += POLL_SECONDS
@@ -0,0 +1,81 @@
+"""
+Data version registry.
+
+Every write path that changes an ads table (import_ads_data.py, sync jobs)
+bumps that table's version here. Readers use the versions as cheap cache /
+freshness keys instead of re-scanning the tables themselves.
+
+Versions come from one global counter, so `MAX(version)` is the version of the
+whole database and any table's version says *when* (in counter terms) it last
+changed.
+
+The table is created at startup (AgentService) and by the first bump; lookups
+run once or more per request, so they only read, over pooled connections.
+"""
+import sqlite3
+
+import ads_db
+from ads_db import get_db_connection
+from db_pool import ConnectionPool
+
+read_pool = ConnectionPool(lambda: ads_db.DB_FILE, size=4)
+
+
+def init_data_versions(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS data_versions (
+            table_name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def bump_data_version(tables, conn=None, commit: bool = True) -> int:
+    """
+    Mark `tables` as changed. Returns the new global data version.
+    commit=False leaves the write in the caller's open transaction on `conn`.
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db_connection()
+    try:
+        init_data_versions(conn)
+        row = conn.execute("SELECT COALESCE(MAX(version), 0) FROM data_versions").fetchone()
+        new_version = (row[0] or 0) + 1
+        conn.executemany("""
+            INSERT INTO data_versions (table_name, version, updated_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(table_name) DO UPDATE SET version = excluded.version, updated_at = excluded.updated_at
+        """, [(t, new_version) for t in tables])
+        if commit or own_conn:
+            conn.commit()
+        return new_version
+    finally:
+        if own_conn:
+            conn.close()
+
+
+def _read_versions(conn) -> dict:
+    try:
+        return {name: version for name, version in conn.execute("SELECT table_name, version FROM data_versions")}
+    except sqlite3.OperationalError as e:
+        if 'no such table' in str(e):
+            return {}  # nothing was ever bumped
+        raise
+
+
+def get_data_versions(conn=None) -> dict:
+    """{table_name: version} for every table that has ever been bumped."""
+    if conn is not None:
+        return _read_versions(conn)
+    with read_pool.connection() as pooled:
+        return _read_versions(pooled)
+
+
+def get_data_version(table: str = None, conn=None) -> int:
+    """Version of one table (0 if never bumped), or the global version when table is None."""
+    versions = get_data_versions(conn)
+    if table is None:
+        return max(versions.values(), default=0)
+    return versions.get(table, 0)
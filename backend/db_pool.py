@@ -0,0 +1,58 @@
+"""
+Reusable SQLite read connections for concurrent queries.
+
+sqlite3 releases the GIL while a statement runs, so independent reads on
+separate connections overlap in threads. Connections are handed out LIFO and
+returned after use; at most `size` idle connections are kept, extra ones are
+closed. Connections are opened with check_same_thread=False because a
+connection may be reused by a different worker thread later (never by two
+threads at once).
+"""
+import queue
+import sqlite3
+from contextlib import contextmanager
+
+
+class ConnectionPool:
+    def __init__(self, db_file, size: int = 8):
+        """db_file: path, or a callable returning it (read on every new connection)"""
+        self.db_file = db_file
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def _connect(self):
+        path = self.db_file() if callable(self.db_file) else self.db_file
+        return sqlite3.connect(path, check_same_thread=False)
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        conn.row_factory = None
+        reusable = True
+        try:
+            yield conn
+        except sqlite3.Error:
+            reusable = False
+            raise
+        finally:
+            self._release(conn, reusable)
+
+    def _release(self, conn, reusable: bool):
+        if reusable:
+            if conn.in_transaction:
+                conn.rollback()
+            try:
+                self._idle.put_nowait(conn)
+                return
+            except queue.Full:
+                pass
+        conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
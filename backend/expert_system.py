@@ -6,15 +6,10 @@ import json
 
 # --- Config & Helpers ---
 
-DB_FILE = 'ads_data.sqlite' # Relative path assuming running from root or adjusted in usage
-
 def get_db_connection():
-    # Helper assuming this file is imported where DB_FILE is accessible or passed
-    # For standalone, we define it here, but ideally we share with agent_service
-    import os
-    # Assuming running from D:\ads_manager
-    db_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ads_data.sqlite')
-    return sqlite3.connect(db_path)
+    # Shared with agent_service and the anomaly modules (see ads_db.py)
+    import ads_db
+    return sqlite3.connect(ads_db.DB_FILE)
 
 def query_db(query: str, params: tuple = ()) -> List[Dict[str, Any]]:
     conn = get_db_connection()
@@ -45,65 +40,98 @@ class ContextGuard:
         ('2026-06-01', '2026-06-20'), # 618 大促
     ]
 
+    # SQLite 变量上限保护: IN (...) 查询按批次拆分
+    BATCH_SIZE = 500
+
     @staticmethod
     def check_risk(campaign_context: Dict[str, Any], target_date: str) -> Dict[str, Any]:
         """
         返回风险评估结果。
         输出: { "status": "PASS" | "BLOCK" | "MARK", "reasons": [...] }
         """
-        reasons = []
-        status = "PASS"
         campaign_name = campaign_context.get('campaign', 'Unknown')
-        
-        # 1. 大促期与预热期保护 (Promotion & Lead-up)
+        return ContextGuard.check_risk_batch([campaign_name], target_date)[campaign_name]
+
+    @staticmethod
+    def check_risk_batch(campaign_names: List[str], target_date: str) -> Dict[str, Dict[str, Any]]:
+        """
+        批量风险评估: 对同一 target_date 的所有异常系列一次性计算
+        (大促期 / 72H 调价冷却期 / 冷启动)，用 2 条集合查询代替每个系列 2 条查询。
+        输出: { campaign: { "status": ..., "reasons": [...] } }
+        """
+        # 1. 大促期与预热期保护 (Promotion & Lead-up) - 与系列无关，只算一次
         # 预热期: 大促开始前 3 天
+        promo_reasons = []
+        target_dt = datetime.strptime(target_date, '%Y-%m-%d')
         for start, end in ContextGuard.PROMOTION_PERIODS:
             start_dt = datetime.strptime(start, '%Y-%m-%d')
-            target_dt = datetime.strptime(target_date, '%Y-%m-%d')
             lead_up_start = start_dt - timedelta(days=3)
-            
+
             if start <= target_date <= end:
-                status = "MARK"
-                reasons.append(f"处于大促期间 ({start} 至 {end}) - 触发保护机制，建议观察。")
+                promo_reasons.append(f"处于大促期间 ({start} 至 {end}) - 触发保护机制，建议观察。")
             elif lead_up_start <= target_dt < start_dt:
-                status = "MARK"
-                reasons.append(f"大促预热期 (大促将于 {start} 开始) - 数据可能剧烈波动，仅做标记。")
-        
-        # 2. 调价冷却期保护 (72H Budget Shift)
-        # 查询过去 3 天的预算历史
-        budget_query = """
-            SELECT budget FROM campaign 
-            WHERE campaign = ? AND date <= ? AND date >= date(?, '-3 days')
-            ORDER BY date DESC
-        """
-        budgets = query_db(budget_query, (campaign_name, target_date, target_date))
-        if budgets and len(budgets) >= 2:
-            budget_values = [b['budget'] for b in budgets if b['budget'] is not None]
-            if len(set(budget_values)) > 1:
-                status = "MARK"
-                reasons.append("调价冷却期: 过去 72 小时内检测到预算变动，数据尚未稳定，建议维持现状。")
-
-        # 3. 冷启动 / 学习期保护 (Cold Start / Learning Phase)
-        query = """
-            SELECT SUM(cost) as cost, SUM(conversions) as conv, COUNT(date) as days, MIN(date) as first_day
-            FROM campaign
-            WHERE campaign = ? AND date <= ?
-        """
-        res = query_db(query, (campaign_name, target_date))
-        if res and res[0]['first_day'] is not None:
-            stats = res[0]
-            first_day_dt = datetime.strptime(stats['first_day'], '%Y-%m-%d')
-            target_dt = datetime.strptime(target_date, '%Y-%m-%d')
-            days_diff = (target_dt - first_day_dt).days
-            
-            if days_diff < 7:
-                status = "BLOCK"
-                reasons.append(f"冷启动保护: 该系列上线仅 {days_diff + 1} 天 (不足 7 天)，严禁进行削减操作。")
-            elif (stats['conv'] or 0) < 30:
-                 # 学习期通常判定为“系统提示”而非硬性风险拦截
-                 reasons.append("进入学习期: 累计转化数 < 30，系统仍在优化人群模型。")
-
-        return {"status": status, "reasons": reasons}
+                promo_reasons.append(f"大促预热期 (大促将于 {start} 开始) - 数据可能剧烈波动，仅做标记。")
+
+        names = list(dict.fromkeys(campaign_names))
+        budget_history = {name: [] for name in names}
+        cold_start = {}
+
+        conn = get_db_connection()
+        conn.row_factory = sqlite3.Row
+        try:
+            for i in range(0, len(names), ContextGuard.BATCH_SIZE):
+                chunk = names[i:i + ContextGuard.BATCH_SIZE]
+                placeholders = ",".join("?" * len(chunk))
+
+                # 2. 调价冷却期: 过去 3 天的预算历史
+                rows = conn.execute(f"""
+                    SELECT campaign, budget FROM campaign
+                    WHERE campaign IN ({placeholders}) AND date <= ? AND date >= date(?, '-3 days')
+                    ORDER BY campaign, date DESC
+                """, (*chunk, target_date, target_date)).fetchall()
+                for r in rows:
+                    budget_history[r['campaign']].append(r['budget'])
+
+                # 3. 冷启动 / 学习期: 截至 target_date 的累计数据
+                rows = conn.execute(f"""
+                    SELECT campaign, SUM(cost) as cost, SUM(conversions) as conv, COUNT(date) as days, MIN(date) as first_day
+                    FROM campaign
+                    WHERE campaign IN ({placeholders}) AND date <= ?
+                    GROUP BY campaign
+                """, (*chunk, target_date)).fetchall()
+                for r in rows:
+                    cold_start[r['campaign']] = dict(r)
+        except Exception as e:
+            print(f"DB Error in ExpertSystem: {e}")
+        finally:
+            conn.close()
+
+        results = {}
+        for name in names:
+            reasons = list(promo_reasons)
+            status = "MARK" if promo_reasons else "PASS"
+
+            budgets = budget_history.get(name, [])
+            if len(budgets) >= 2:
+                budget_values = [b for b in budgets if b is not None]
+                if len(set(budget_values)) > 1:
+                    status = "MARK"
+                    reasons.append("调价冷却期: 过去 72 小时内检测到预算变动，数据尚未稳定，建议维持现状。")
+
+            stats = cold_start.get(name)
+            if stats and stats['first_day'] is not None:
+                first_day_dt = datetime.strptime(stats['first_day'], '%Y-%m-%d')
+                days_diff = (target_dt - first_day_dt).days
+
+                if days_diff < 7:
+                    status = "BLOCK"
+                    reasons.append(f"冷启动保护: 该系列上线仅 {days_diff + 1} 天 (不足 7 天)，严禁进行削减操作。")
+                elif (stats['conv'] or 0) < 30:
+                    # 学习期通常判定为“系统提示”而非硬性风险拦截
+                    reasons.append("进入学习期: 累计转化数 < 30，系统仍在优化人群模型。")
+
+            results[name] = {"status": status, "reasons": reasons}
+        return results
 
 # --- 2. ExpertEngines (确定性专家规则) ---
 
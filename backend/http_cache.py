@@ -0,0 +1,257 @@
+"""
+HTTP caching and compression for the read endpoints.
+
+ConditionalGetMiddleware gives GET responses under CACHEABLE_PREFIXES a weak
+ETag built from the request (path, query, Accept) and the data versions of the
+tables that endpoint reads (ETAG_TABLES, data_version.py), so a write to one
+table does not invalidate the ETags of endpoints that never read it. Detection
+endpoints are also keyed on the anomaly engine version. Endpoints reading a
+table that was never bumped are not tagged (see ALWAYS_BUMPED). A request
+whose If-None-Match matches gets 304 before the endpoint runs, so the query is
+skipped entirely. The bearer token is still checked first. Only complete 200
+responses that are not {"error": ...} bodies are tagged.
+
+CompressionMiddleware compresses complete (non-streamed) responses of at
+least MINIMUM_SIZE bytes with brotli when the client accepts it and the
+optional `brotli` package is installed, otherwise gzip, in a worker thread. Streamed responses
+(NDJSON, Arrow) pass through untouched so the first rows are not delayed.
+"""
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import re
+from urllib.parse import parse_qs
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+import auth
+from constants import CAMPAIGN_DETAIL_TABLES
+from anomaly_rootcause import DIMENSIONS as ROOT_CAUSE_DIMENSIONS
+from anomaly_store import ENGINE_VERSION
+from data_version import get_data_versions
+
+logger = logging.getLogger(__name__)
+
+CACHEABLE_PREFIXES = ('/api/tables/', '/api/anomalies/', '/api/kpi/')
+CACHEABLE_PATTERNS = (re.compile(r'^/api/campaigns/[^/]+/(details(/[^/]+)?|root-cause)$'),)
+
+
+def _detail_tables(match, params: dict) -> list:
+    requested = [t.strip() for t in ','.join(params.get('tables', [])).split(',') if t.strip()]
+    return requested or list(CAMPAIGN_DETAIL_TABLES)
+
+
+def _ewma_state(params: dict) -> list:
+    """mode=ewma serves the stored EWMA scores, which change when the precompute job advances them"""
+    return ['anomaly_ewma_state'] if params.get('mode') == ['ewma'] else []
+
+
+# Tables whose every writer bumps the version, so "never bumped" means "never written".
+# Any other table without a version is served without an ETag: its writers may not bump
+# (e.g. agent_custom_rules), and a 304 keyed on a version that never moves would be stale.
+ALWAYS_BUMPED = ('user_preferences', 'anomaly_ewma_state')
+
+# Pseudo-table for endpoints whose output depends on the detection rules:
+# its "version" is anomaly_store.ENGINE_VERSION
+ANOMALY_ENGINE = '@anomaly_engine'
+
+# (path pattern, tables(match, query params)) of the tables each endpoint reads; first match wins.
+# A cacheable path without a rule falls back to every table's version.
+ETAG_TABLES = (
+    (re.compile(r'^/api/tables/([^/]+)/changes$'), lambda m, q: [m.group(1)]),
+    (re.compile(r'^/api/tables/product/items/[^/]+$'), lambda m, q: ['product']),
+    (re.compile(r'^/api/tables/([^/]+)$'), lambda m, q: [m.group(1), 'user_preferences']),
+    (re.compile(r'^/api/campaigns/[^/]+/details/([^/]+)$'), lambda m, q: [m.group(1)]),
+    (re.compile(r'^/api/campaigns/[^/]+/details$'), _detail_tables),
+    (re.compile(r'^/api/campaigns/[^/]+/root-cause$'),
+     lambda m, q: [ANOMALY_ENGINE, 'campaign'] + [d['table'] for d in ROOT_CAUSE_DIMENSIONS.values()]),
+    (re.compile(r'^/api/anomalies/campaign(/|$)'), lambda m, q: [ANOMALY_ENGINE, 'campaign'] + _ewma_state(q)),
+    (re.compile(r'^/api/anomalies/product(/|$)'), lambda m, q: [ANOMALY_ENGINE, 'product'] + _ewma_state(q)),
+    (re.compile(r'^/api/anomalies/history$'), lambda m, q: [ANOMALY_ENGINE, 'campaign', 'product']),
+    (re.compile(r'^/api/kpi/summary$'), lambda m, q: ['campaign']),
+)
+# Error payloads are small; larger JSON bodies are not parsed to look for one
+ERROR_CHECK_MAX_BYTES = 64 * 1024
+MINIMUM_SIZE = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/')
+
+
+def _header(scope, name: bytes) -> str:
+    for key, value in scope.get('headers', []):
+        if key == name:
+            return value.decode('latin-1')
+    return ''
+
+
+def is_cacheable(path: str) -> bool:
+    return path.startswith(CACHEABLE_PREFIXES) or any(p.match(path) for p in CACHEABLE_PATTERNS)
+
+
+def etag_tables(path: str, query: str):
+    """Tables whose versions key the ETag of `path`, or None for all tables"""
+    for pattern, tables in ETAG_TABLES:
+        match = pattern.match(path)
+        if match:
+            return tables(match, parse_qs(query))
+    return None
+
+
+def etag_versions(path: str, query: str):
+    """
+    Data versions the ETag of `path` depends on, or None when one of its tables
+    has never been bumped (blocking: reads data_versions)
+    """
+    versions = get_data_versions()
+    tables = etag_tables(path, query)
+    if tables is None:
+        return (ENGINE_VERSION, max(versions.values(), default=0))
+    if any(t not in versions and t != ANOMALY_ENGINE and t not in ALWAYS_BUMPED for t in tables):
+        return None
+    return tuple(ENGINE_VERSION if t == ANOMALY_ENGINE else versions.get(t, 0) for t in tables)
+
+
+def compute_etag(path: str, query: str, accept: str, versions: tuple) -> str:
+    params = '&'.join(sorted(query.split('&'))) if query else ''
+    raw = f"{versions}|{path}|{params}|{accept}"
+    return f'W/"{hashlib.sha1(raw.encode("utf-8")).hexdigest()[:20]}"'
+
+
+def is_error_body(headers, body: bytes) -> bool:
+    """True for a JSON {"error": ...} payload (endpoints report errors with status 200)"""
+    content_type = dict((k.lower(), v) for k, v in headers).get(b'content-type', b'')
+    if not content_type.startswith(b'application/json') or len(body) > ERROR_CHECK_MAX_BYTES:
+        return False
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        return False
+    return isinstance(payload, dict) and 'error' in payload
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == '*':
+        return True
+    # Weak comparison: ignore W/ prefixes
+    wanted = etag[2:] if etag.startswith('W/') else etag
+    return any((t.strip()[2:] if t.strip().startswith('W/') else t.strip()) == wanted
+               for t in if_none_match.split(','))
+
+
+def _authorized(scope) -> bool:
+    authorization = _header(scope, b'authorization')
+    if not authorization.lower().startswith('bearer '):
+        return False
+    return auth.verify_token(authorization[7:].strip()) is not None
+
+
+class ConditionalGetMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'GET' or not is_cacheable(scope['path']):
+            return await self.app(scope, receive, send)
+        query = scope.get('query_string', b'').decode('latin-1')
+        try:
+            versions = await asyncio.to_thread(etag_versions, scope['path'], query)
+        except Exception as e:
+            logger.warning("ETag version lookup failed for %s: %s", scope['path'], e)
+            return await self.app(scope, receive, send)
+        if versions is None:
+            return await self.app(scope, receive, send)
+
+        etag = compute_etag(scope['path'], query, _header(scope, b'accept'), versions)
+        if_none_match = _header(scope, b'if-none-match')
+        if if_none_match and _etag_matches(if_none_match, etag) and _authorized(scope):
+            await send({'type': 'http.response.start', 'status': 304,
+                        'headers': [(b'etag', etag.encode('latin-1')), (b'vary', b'Accept, Accept-Encoding')]})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        start = None
+
+        async def send_with_etag(message):
+            # Hold a 200 start until the first body chunk shows whether the response may be tagged
+            nonlocal start
+            if message['type'] == 'http.response.start' and message['status'] == 200:
+                start = message
+                return
+            if start is not None and message['type'] == 'http.response.body':
+                headers = list(start.get('headers', []))
+                # Streamed responses can report an error after the headers, so only complete bodies are tagged
+                if not message.get('more_body', False) and not is_error_body(headers, message.get('body', b'')):
+                    headers.append((b'etag', etag.encode('latin-1')))
+                    headers.append((b'cache-control', b'private, no-cache'))
+                await send({**start, 'headers': headers})
+                start = None
+            await send(message)
+
+        await self.app(scope, receive, send_with_etag)
+
+
+def _pick_encoding(accept_encoding: str):
+    accepted = {part.split(';')[0].strip().lower() for part in accept_encoding.split(',')}
+    if brotli is not None and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size: int = MINIMUM_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        encoding = _pick_encoding(_header(scope, b'accept-encoding'))
+        if not encoding:
+            return await self.app(scope, receive, send)
+
+        start = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start, passthrough
+            if passthrough:
+                return await send(message)
+            if message['type'] == 'http.response.start':
+                start = message
+                return
+            if message['type'] != 'http.response.body':
+                return await send(message)
+
+            body = message.get('body', b'')
+            headers = {k.lower(): v for k, v in start.get('headers', [])}
+            content_type = headers.get(b'content-type', b'').decode('latin-1')
+            if (message.get('more_body', False) or b'content-encoding' in headers or len(body) < self.minimum_size
+                    or not content_type.startswith(COMPRESSIBLE_TYPES)):
+                passthrough = True
+                await send(start)
+                return await send(message)
+
+            # Off the event loop: a multi-MB body takes tens of milliseconds to compress
+            compressed = await asyncio.to_thread(compress, body, encoding)
+            new_headers = [(k, v) for k, v in start.get('headers', []) if k.lower() != b'content-length']
+            new_headers += [(b'content-encoding', encoding.encode('latin-1')),
+                            (b'content-length', str(len(compressed)).encode('latin-1')),
+                            (b'vary', b'Accept-Encoding')]
+            await send({**start, 'headers': new_headers})
+            await send({'type': 'http.response.body', 'body': compressed})
+
+        await self.app(scope, receive, send_compressed)
@@ -0,0 +1,121 @@
+"""
+Account KPI summary (cost, conversions, conv_value, ROAS, CPA, ...) for any
+date range, with the previous period of the same length for comparison.
+
+The campaign table is reduced once per data version to a daily rollup per
+campaign_type holding running totals, so the totals of a range are two
+bisects and a subtraction per metric instead of a scan of the raw rows.
+"""
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+import schema_catalog
+import table_query
+
+METRICS = ('cost', 'conversions', 'conv_value', 'clicks', 'impr')
+DEFAULT_DAYS = 7
+
+
+def _series(dates: list, values: dict) -> dict:
+    """Running totals with a leading 0, so the sum over dates[i:j] is cum[j] - cum[i]"""
+    return {"dates": dates, "cum": {m: list(accumulate(v, initial=0.0)) for m, v in values.items()}}
+
+
+def build_rollup(conn) -> dict:
+    """Daily totals of the campaign table, account-wide and per campaign_type"""
+    columns = schema_catalog.table_columns(conn, 'campaign')
+    if not columns:
+        raise ValueError("campaign table not found")
+    metrics = [m for m in METRICS if m in columns]
+    type_expr = "COALESCE(t.campaign_type, 'Unknown')" if 'campaign_type' in columns else "'Unknown'"
+    sums = ", ".join(f"TOTAL({table_query.value_expr(m, columns[m])})" for m in metrics)
+    rows = conn.execute(f"""
+        SELECT t.date, {type_expr}, {sums}
+        FROM campaign t
+        WHERE t.date IS NOT NULL
+        GROUP BY 1, 2
+        ORDER BY 1
+    """).fetchall()
+
+    account_dates, account_values = [], {m: [] for m in metrics}
+    by_type = {}
+    for date, campaign_type, *values in rows:
+        if not account_dates or account_dates[-1] != date:
+            account_dates.append(date)
+            for m in metrics:
+                account_values[m].append(0.0)
+        dates, type_values = by_type.setdefault(campaign_type, ([], {m: [] for m in metrics}))
+        dates.append(date)
+        for m, v in zip(metrics, values):
+            account_values[m][-1] += v
+            type_values[m].append(v)
+
+    return {
+        "metrics": metrics,
+        "min_date": account_dates[0] if account_dates else None,
+        "max_date": account_dates[-1] if account_dates else None,
+        "account": _series(account_dates, account_values),
+        "types": {t: _series(dates, values) for t, (dates, values) in by_type.items()},
+    }
+
+
+def range_totals(series: dict, start_date: str, end_date: str) -> dict:
+    i = bisect_left(series["dates"], start_date)
+    j = bisect_right(series["dates"], end_date)
+    totals = {m: cum[j] - cum[i] for m, cum in series["cum"].items()}
+    totals["days"] = max(j - i, 0)
+    return totals
+
+
+def kpis(totals: dict) -> dict:
+    cost, conversions = totals.get('cost', 0.0), totals.get('conversions', 0.0)
+    conv_value, clicks, impr = totals.get('conv_value', 0.0), totals.get('clicks', 0.0), totals.get('impr', 0.0)
+    out = {m: round(v, 2) for m, v in totals.items()}
+    out["roas"] = round(conv_value / cost, 4) if cost else 0.0
+    out["cpa"] = round(cost / conversions, 2) if conversions else 0.0
+    out["ctr"] = round(clicks / impr * 100, 2) if impr else 0.0
+    out["cpc"] = round(cost / clicks, 2) if clicks else 0.0
+    return out
+
+
+def _change_pct(current: dict, previous: dict) -> dict:
+    return {k: round((current[k] - previous[k]) / previous[k] * 100, 2) if previous.get(k) else None
+            for k in current if k != 'days'}
+
+
+def _compare(series: dict, current: tuple, previous: tuple) -> dict:
+    curr = kpis(range_totals(series, *current))
+    prev = kpis(range_totals(series, *previous))
+    return {"current": curr, "previous": prev, "change_pct": _change_pct(curr, prev)}
+
+
+def summarize(rollup: dict, start_date: str = None, end_date: str = None) -> dict:
+    """
+    KPIs of [start_date, end_date] (default: the last DEFAULT_DAYS days of data)
+    and of the equally long period right before it, account-wide and per campaign_type.
+    """
+    if not rollup["max_date"]:
+        return {"start_date": None, "end_date": None, "account": None, "by_campaign_type": []}
+    end_date = end_date or rollup["max_date"]
+    end = datetime.strptime(end_date, '%Y-%m-%d')
+    start = datetime.strptime(start_date, '%Y-%m-%d') if start_date else end - timedelta(days=DEFAULT_DAYS - 1)
+    if start > end:
+        raise ValueError("start_date must not be after end_date")
+    prev_end = start - timedelta(days=1)
+    prev_start = prev_end - (end - start)
+
+    fmt = lambda d: d.strftime('%Y-%m-%d')
+    current, previous = (fmt(start), fmt(end)), (fmt(prev_start), fmt(prev_end))
+    by_type = [{"campaign_type": t, **_compare(series, current, previous)} for t, series in rollup["types"].items()]
+    by_type.sort(key=lambda r: r["current"].get("cost", 0.0), reverse=True)
+    return {
+        "start_date": current[0],
+        "end_date": current[1],
+        "previous_start_date": previous[0],
+        "previous_end_date": previous[1],
+        "data_start": rollup["min_date"],
+        "data_end": rollup["max_date"],
+        "account": _compare(rollup["account"], current, previous),
+        "by_campaign_type": by_type,
+    }
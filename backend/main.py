@@ -1,6 +1,7 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Header
+from fastapi import FastAPI, Depends, HTTPException, status, Header, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordBearer
 from pydantic import BaseModel
 from typing import Optional, List
@@ -12,9 +13,18 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from agent_service import AgentService
 import auth
+import columnar
+import arrow_stream
+import data_events
+from http_cache import ConditionalGetMiddleware, CompressionMiddleware
 
 app = FastAPI()
 
+# ETag / 304 for read endpoints and compression of large responses (see http_cache.py).
+# ConditionalGetMiddleware is added first (innermost) so it inspects uncompressed bodies.
+app.add_middleware(ConditionalGetMiddleware)
+app.add_middleware(CompressionMiddleware)
+
 # Allow CORS for React Frontend (default port 5173)
 app.add_middleware(
     CORSMiddleware,
@@ -49,6 +59,19 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         )
     return username
 
+async def get_stream_user(token: Optional[str] = None, authorization: Optional[str] = Header(None)):
+    """Bearer header, or ?token= for EventSource clients (which cannot set headers)"""
+    if not token and authorization and authorization.lower().startswith('bearer '):
+        token = authorization[7:].strip()
+    username = auth.verify_token(token) if token else None
+    if not username:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid or expired token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return username
+
 # --- Data Models ---
 class Message(BaseModel):
     role: str
@@ -66,6 +89,17 @@ class PreferenceUpdateRequest(BaseModel):
     is_pinned: Optional[int] = None
     display_order: Optional[int] = None
 
+class PreferenceItem(BaseModel):
+    item_identifier: str
+    is_pinned: Optional[int] = None
+    display_order: Optional[int] = None
+
+class PreferenceBatchRequest(BaseModel):
+    table_name: str
+    order: Optional[List[str]] = None
+    pinned: Optional[List[str]] = None
+    items: Optional[List[PreferenceItem]] = None
+
 class ResetPreferenceRequest(BaseModel):
     table_name: str
 
@@ -73,6 +107,16 @@ class CustomRuleRequest(BaseModel):
     table_name: str
     rule_prompt: str
 
+class BacktestRequest(BaseModel):
+    entity_type: str = 'campaign'
+    start_date: Optional[str] = None
+    end_date: Optional[str] = None
+    ratio_down: Optional[List[float]] = None
+    ratio_up: Optional[List[float]] = None
+    consecutive_days: Optional[List[int]] = None
+    baseline_days: Optional[List[int]] = None
+    top: int = 20
+
 # --- Public Endpoints ---
 
 @app.get("/")
@@ -117,20 +161,130 @@ def get_tables(current_user: str = Depends(get_current_user)):
     return {"tables": agent.get_tables()}
 
 @app.get("/api/tables/{table_name}")
-def get_table_data(table_name: str, start_date: Optional[str] = None, end_date: Optional[str] = None, current_user: str = Depends(get_current_user)):
-    return agent.get_table_data(table_name, start_date, end_date)
+def get_table_data(
+    table_name: str,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    sort_by: Optional[str] = None,
+    sort_dir: str = 'desc',
+    columns: Optional[str] = None,
+    filter: Optional[List[str]] = Query(None),
+    format: Optional[str] = None,
+    mode: Optional[str] = None,
+    search: Optional[str] = None,
+    accept: Optional[str] = Header(None),
+    current_user: str = Depends(get_current_user)
+):
+    """
+    mode=summary (product only): one row per item_id over the date range with
+    aggregates and trends, paged (limit, cursor, sort_by, sort_dir, search on title / item_id).
+    Accept: application/vnd.apache.arrow.stream streams the whole filtered table
+    as Arrow IPC record batches (limit caps the rows; cursor is ignored); the
+    data version is sent in the X-Data-Version header.
+    Without paging params: every row (previous behaviour).
+    With any of them: {columns, data, next_cursor, total} for one page, pinned rows first.
+    columns: comma-separated projection. filter: repeatable column:op:value
+    (op: eq | ne | gt | gte | lt | lte | contains).
+    format: rows | columnar for a compact payload (column names sent once).
+    Every response carries the table's data "version" (since_version for /changes).
+    """
+    column_list = [c.strip() for c in columns.split(',') if c.strip()] if columns else None
+    error = columnar.format_error(format)
+    if error:
+        return error
+    # Read before the rows: an import in between makes the client re-fetch changes, never miss them
+    version = agent.get_table_version(table_name)
+    if mode == 'summary':
+        if table_name != 'product':
+            return {"error": "mode=summary is only supported for the product table"}
+        return columnar.respond(format, lambda: agent.get_product_summary(
+            start_date, end_date, limit=limit or 100, cursor=cursor,
+            sort_by=sort_by, sort_dir=sort_dir, search=search, fmt=format), version=version)
+    if accept and arrow_stream.ARROW_MEDIA_TYPE in accept:
+        stream = agent.stream_table_arrow(table_name, start_date, end_date, sort_by=sort_by, sort_dir=sort_dir,
+                                          columns=column_list, filters=filter, limit=limit)
+        if isinstance(stream, dict):
+            return stream
+        return StreamingResponse(stream, media_type=arrow_stream.ARROW_MEDIA_TYPE,
+                                 headers={"X-Data-Version": str(version)})
+    if any(p is not None for p in (limit, cursor, sort_by, columns, filter)):
+        return columnar.respond(format, lambda: agent.get_table_page(
+            table_name, start_date, end_date, limit=limit or 100, cursor=cursor, sort_by=sort_by,
+            sort_dir=sort_dir, columns=column_list,
+            filters=filter, fmt=format
+        ), version=version)
+    return columnar.respond(format, lambda: agent.get_table_data(table_name, start_date, end_date, fmt=format),
+                            version=version)
+
+@app.get("/api/tables/{table_name}/changes")
+def get_table_changes(table_name: str, since_version: int, current_user: str = Depends(get_current_user)):
+    """
+    Delta sync: {version, reset, key_columns, inserted, updated, deleted} since a data version.
+    Rows of an inserted / updated key replace all rows with that key; reset=true means reload the table.
+    """
+    return agent.get_table_changes(table_name, since_version)
+
+@app.get("/api/tables/product/items/{item_id}")
+def get_product_daily(item_id: str, start_date: Optional[str] = None, end_date: Optional[str] = None, format: Optional[str] = None, current_user: str = Depends(get_current_user)):
+    """Daily rows of one product (drill-down from mode=summary)"""
+    version = agent.get_table_version('product')
+    return columnar.respond(format, lambda: agent.get_product_daily(item_id, start_date, end_date, fmt=format),
+                            version=version)
 
 @app.get("/api/campaigns/{campaign_name}/details")
-def get_campaign_details(campaign_name: str, start_date: Optional[str] = None, end_date: Optional[str] = None, current_user: str = Depends(get_current_user)):
-    return agent.get_campaign_details(campaign_name, start_date, end_date)
+def get_campaign_details(
+    campaign_name: str,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    format: Optional[str] = None,
+    tables: Optional[str] = None,
+    limit: Optional[int] = None,
+    offset: int = 0,
+    current_user: str = Depends(get_current_user)
+):
+    """
+    All detail tables (or the comma-separated `tables`), fetched concurrently.
+    limit / offset page every table. format: rows | columnar for compact per-table payloads
+    """
+    table_list = [t.strip() for t in tables.split(',') if t.strip()] if tables else None
+    return columnar.respond(format, lambda: agent.get_campaign_details(
+        campaign_name, start_date, end_date, fmt=format, tables=table_list, limit=limit, offset=offset))
+
+@app.get("/api/campaigns/{campaign_name}/details/{table_name}")
+def get_campaign_detail_table(
+    campaign_name: str,
+    table_name: str,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    limit: int = 100,
+    offset: int = 0,
+    format: Optional[str] = None,
+    current_user: str = Depends(get_current_user)
+):
+    """One detail table of a campaign: {columns, data, total, offset, limit}"""
+    return columnar.respond(format, lambda: agent.get_campaign_detail_table(
+        campaign_name, table_name, start_date, end_date, limit, offset, fmt=format))
 
 @app.get("/api/campaigns/{campaign_name}/anomaly-details")
 def get_campaign_anomaly_details(campaign_name: str, start_date: Optional[str] = None, end_date: Optional[str] = None, current_user: str = Depends(get_current_user)):
     """Get ONLY anomaly data for a campaign - filtered by hard rules"""
     return agent.get_campaign_anomaly_details(campaign_name, start_date, end_date)
 
+@app.get("/api/campaigns/{campaign_name}/root-cause")
+def get_campaign_root_cause(campaign_name: str, target_date: Optional[str] = None, current_user: str = Depends(get_current_user)):
+    """Top segments (search term, geo, age, gender, channel, schedule) behind the ROAS / CPA change"""
+    return agent.get_campaign_root_cause(campaign_name, target_date)
+
 @app.get("/api/anomalies/campaign")
-async def get_campaign_anomalies(target_date: str = None, current_user: str = Depends(get_current_user)):
+async def get_campaign_anomalies(target_date: str = None, mode: str = 'rules', current_user: str = Depends(get_current_user)):
+    """
+    mode: rules (default) | ewma (statistical detector, sorted by score;
+    {date, as_of, pending, anomalies}, pending until the precompute job has scored the date)
+    """
+    if mode == 'ewma':
+        return await run_in_threadpool(agent.get_ewma_anomalies, 'campaign', target_date)
     anomalies = agent.get_campaign_anomalies(target_date=target_date)
     return anomalies
 
@@ -139,18 +293,98 @@ async def get_campaign_anomalies_date_range(current_user: str = Depends(get_curr
     """Get the analyzable date range for campaign anomalies"""
     return agent.get_campaign_analyzable_date_range()
 
+@app.get("/api/anomalies/history")
+def get_anomaly_history(
+    start_date: str,
+    end_date: str,
+    entity_type: str = 'all',
+    counts_only: bool = False,
+    current_user: str = Depends(get_current_user)
+):
+    """Per-day anomaly sets and counts for campaigns and/or products over a date range"""
+    return agent.get_anomaly_history(start_date, end_date, entity_type, counts_only)
+
 @app.get("/api/anomalies/product/date-range")
 async def get_product_anomalies_date_range(current_user: str = Depends(get_current_user)):
     """Get the analyzable date range for product anomalies"""
     return agent.get_product_analyzable_date_range()
 
 @app.get("/api/anomalies/product")
-async def get_product_anomalies(target_date: str = None, current_user: str = Depends(get_current_user)):
-    # Note: Removed pagination logic from main.py to match previous state if it wasn't fully implemented in agent_service
-    # If pagination is needed, it should be handled here or in agent_service. 
-    # For now, returning full list as per previous working state.
-    anomalies = agent.get_product_anomalies(target_date=target_date)
-    return anomalies
+async def get_product_anomalies(
+    target_date: str = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    sort_by: Optional[str] = None,
+    sort_dir: str = 'desc',
+    title: Optional[str] = None,
+    min_cost: Optional[float] = None,
+    reason: Optional[str] = None,
+    stream: bool = False,
+    mode: str = 'rules',
+    current_user: str = Depends(get_current_user)
+):
+    """
+    Without paging/filter params: full list sorted by curr_cost (previous behaviour).
+    With any of them: {items, next_cursor, total, totals} for one page.
+    sort_by: cost | ctr_change | cpc_change | clicks
+    stream=true: NDJSON, one anomaly per line as detection progresses, then a summary line.
+    mode=ewma: statistical detector (EWMA + day-of-week factors), sorted by score,
+    as {date, as_of, pending, anomalies}; pending until the precompute job has scored the date.
+    """
+    if mode == 'ewma':
+        return await run_in_threadpool(agent.get_ewma_anomalies, 'product', target_date)
+    if stream:
+        return StreamingResponse(agent.stream_product_anomalies(target_date), media_type="application/x-ndjson")
+    if any(p is not None for p in (limit, cursor, sort_by, title, min_cost, reason)):
+        return agent.get_product_anomalies_page(
+            target_date=target_date, limit=limit or 100, cursor=cursor, sort_by=sort_by,
+            sort_dir=sort_dir, title=title, min_cost=min_cost, reason=reason
+        )
+    return agent.get_product_anomalies(target_date=target_date)
+
+@app.post("/api/anomalies/backtest")
+def backtest_anomaly_thresholds(req: BacktestRequest, current_user: str = Depends(get_current_user)):
+    """Alert counts / overlap / hit rates of a threshold grid over every historical date"""
+    grid = {
+        "ratio_down": req.ratio_down,
+        "ratio_up": req.ratio_up,
+        "consecutive_days": req.consecutive_days,
+        "baseline_days": req.baseline_days,
+    }
+    return agent.backtest_anomaly_thresholds(req.entity_type, grid, req.start_date, req.end_date, req.top)
+
+@app.post("/api/anomalies/precompute")
+def precompute_anomalies(force: bool = False, current_user: str = Depends(get_current_user)):
+    """Store campaign/product anomalies for every analyzable date (only changed dates are recomputed)"""
+    return agent.precompute_anomalies(force=force)
+
+@app.get("/api/kpi/summary")
+def get_kpi_summary(start_date: Optional[str] = None, end_date: Optional[str] = None, current_user: str = Depends(get_current_user)):
+    """Cost / conversions / conv_value / ROAS / CPA totals, account-wide and per campaign_type, vs the previous period"""
+    return agent.get_kpi_summary(start_date, end_date)
+
+@app.get("/api/events")
+async def stream_data_events(
+    request: Request,
+    last_event_id: Optional[int] = Header(None),
+    since: Optional[int] = None,
+    current_user: str = Depends(get_stream_user)
+):
+    """
+    Server-Sent Events: import / anomalies / rules events with the affected tables
+    and the new data version. Last-Event-ID (or ?since=) replays missed events.
+    """
+    start = last_event_id if last_event_id is not None else since
+    return StreamingResponse(
+        data_events.stream_events(start, request.is_disconnected),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/api/cache/stats")
+def get_cache_stats(current_user: str = Depends(get_current_user)):
+    """Hit/miss counters of the data-versioned result cache"""
+    return agent.get_cache_stats()
 
 @app.post("/api/preferences")
 def update_preference(req: PreferenceUpdateRequest, current_user: str = Depends(get_current_user)):
@@ -162,6 +396,19 @@ def update_preference(req: PreferenceUpdateRequest, current_user: str = Depends(
     )
     return response
 
+@app.post("/api/preferences/batch")
+def update_preferences_batch(req: PreferenceBatchRequest, current_user: str = Depends(get_current_user)):
+    """
+    One transaction for a whole reorder / pin set: order = identifiers in display order,
+    pinned = the full pin set, items = individual {item_identifier, is_pinned, display_order} changes
+    """
+    return agent.update_preferences_batch(
+        table_name=req.table_name,
+        order=req.order,
+        pinned=req.pinned,
+        items=[item.model_dump() for item in req.items] if req.items else None
+    )
+
 @app.post("/api/preferences/reset")
 def reset_preferences(req: ResetPreferenceRequest, current_user: str = Depends(get_current_user)):
     response = agent.reset_preferences(req.table_name)
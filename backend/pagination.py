@@ -0,0 +1,57 @@
+"""
+Keyset (cursor) pagination helpers.
+
+A cursor is an opaque url-safe token holding the sort value and id of the
+last row of the previous page, so the next page starts strictly after it
+even if rows were appended in between (no OFFSET drift).
+"""
+import base64
+import json
+from bisect import bisect_left, bisect_right
+
+
+def encode_cursor(values) -> str:
+    raw = json.dumps(values, separators=(',', ':'), default=str).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str):
+    """Inverse of encode_cursor. Raises ValueError on a malformed token."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        return json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {e}")
+
+
+def page_sorted(rows: list, sort_key, id_key: str, limit: int, cursor: str = None, descending: bool = True):
+    """
+    Page through `rows` ordered by (sort_key(row), str(row[id_key])).
+
+    Returns (page_rows, next_cursor); next_cursor is None on the last page.
+    Raises ValueError on a malformed cursor or one that does not match the sort.
+    """
+    keyed = sorted((((sort_key(r), str(r[id_key])), r) for r in rows), key=lambda kr: kr[0])
+    keys = [k for k, _ in keyed]
+    n = len(keyed)
+    if cursor:
+        # JSON turns tuple sort keys into lists; restore them so they compare with keys
+        cursor_key = tuple(tuple(v) if isinstance(v, list) else v for v in decode_cursor(cursor))
+
+    try:
+        if descending:
+            # rows strictly after the cursor = keys below it = the tail of the reversed list
+            start = n - bisect_left(keys, cursor_key) if cursor else 0
+        else:
+            start = bisect_right(keys, cursor_key) if cursor else 0
+    except TypeError:
+        # a cursor from another sort (e.g. a text key against numbers)
+        raise ValueError("Invalid cursor: it does not match the requested sort")
+    if descending:
+        keyed.reverse()
+
+    page = keyed[start:start + limit]
+    next_cursor = None
+    if page and start + limit < n:
+        next_cursor = encode_cursor(list(page[-1][0]))
+    return [r for _, r in page], next_cursor
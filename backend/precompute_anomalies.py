@@ -0,0 +1,55 @@
+"""
+Anomaly precompute job
+Stores campaign / product anomalies for every analyzable date in anomaly_results.
+Only dates whose underlying data changed since the last run are recomputed,
+and the EWMA detector state is advanced to the latest day.
+
+With --incremental, only the latest imported day is evaluated by advancing the
+persisted rolling state (cost independent of the 45-day window); the EWMA
+detector state is advanced at the same time.
+
+运行方式（导入新数据后执行）：
+python precompute_anomalies.py [--force]
+python precompute_anomalies.py --incremental [YYYY-MM-DD]
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from agent_service import AgentService
+
+
+def precompute_anomalies(force: bool = False):
+    service = AgentService()
+    summary = service.precompute_anomalies(force=force)
+    for entity_type, info in summary.items():
+        if 'error' in info:
+            print(f"❌ {entity_type}: {info['error']}")
+        elif 'days' in info:
+            print(f"✅ {entity_type} @ {info['date']}: {info['days']} days scored")
+        else:
+            print(f"✅ {entity_type}: {info['recomputed']}/{info['dates']} dates recomputed")
+    return summary
+
+
+def advance_anomalies(new_date: str = None):
+    service = AgentService()
+    summary = service.advance_anomaly_state(new_date)
+    for entity_type, info in summary.items():
+        if 'error' in info:
+            print(f"❌ {entity_type}: {info['error']}")
+        elif 'days' in info:
+            print(f"✅ {entity_type} @ {info['date']}: {info['days']} days scored")
+        else:
+            print(f"✅ {entity_type} @ {info['date']}: {info['anomalies']} anomalies")
+    return summary
+
+
+if __name__ == "__main__":
+    if '--incremental' in sys.argv:
+        dates = [a for a in sys.argv[1:] if not a.startswith('--')]
+        advance_anomalies(dates[0] if dates else None)
+    else:
+        precompute_anomalies(force='--force' in sys.argv)
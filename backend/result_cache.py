@@ -0,0 +1,92 @@
+"""
+In-process result cache for read endpoints.
+
+Keys include the data version of the tables the result was computed from
+(see data_version.py), so an import automatically makes old entries
+unreachable; they are then pushed out by LRU eviction. The cache is bounded
+both by entry count and by the approximate JSON size of the cached values.
+
+Cached values are shared between requests and must be treated as read-only.
+"""
+import json
+import threading
+from collections import OrderedDict
+
+
+class ResultCache:
+    def __init__(self, max_entries: int = 256, max_bytes: int = 256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return (found, value) and mark the entry as recently used."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[0]
+
+    def put(self, key, value):
+        size = _approx_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def get_or_compute(self, key, compute, cacheable=None):
+        """
+        Cached value for key, else compute() and store it. If compute raises,
+        or cacheable(value) is false, nothing is stored.
+        """
+        found, value = self.get(key)
+        if found:
+            return value
+        value = compute()
+        if cacheable is None or cacheable(value):
+            self.put(key, value)
+        return value
+
+    def invalidate(self, predicate=None):
+        """Drop every entry (or those whose key matches `predicate`)."""
+        with self._lock:
+            for key in [k for k in self._entries if predicate is None or predicate(k)]:
+                _, size = self._entries.pop(key)
+                self._bytes -= size
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+            }
+
+
+def _approx_size(value) -> int:
+    try:
+        return len(json.dumps(value, default=str))
+    except (TypeError, ValueError):
+        return 0
@@ -0,0 +1,88 @@
+"""
+In-memory schema catalog.
+
+Tables, columns (with declared types), indexes and row counts of the ads
+database, read once and kept in memory so request paths do not query
+sqlite_master / PRAGMA table_info every time.
+
+The catalog is keyed on (database file, data version of the ads tables, PRAGMA
+schema_version) and rebuilt when any of them changes: imports bump the data
+version (data_version.py), and DDL outside the import (new tables, ALTER)
+bumps schema_version. Versions of the app's own tables (APP_TABLES) are left
+out, so saving a preference or advancing a detector does not recount every
+table. Checking the
+key is one small query.
+"""
+import sqlite3
+import threading
+
+_lock = threading.Lock()
+_state = {"key": None, "tables": {}}
+
+# Versioned tables written by the app itself rather than by imports
+APP_TABLES = ('user_preferences', 'anomaly_ewma_state')
+
+
+def _catalog_key(conn) -> tuple:
+    db_file, schema_version = conn.execute("""
+        SELECT (SELECT file FROM pragma_database_list WHERE name = 'main'),
+               (SELECT schema_version FROM pragma_schema_version)
+    """).fetchone()
+    # Versions share one counter, so the max over the ads tables moves whenever any of them is bumped
+    placeholders = ', '.join('?' for _ in APP_TABLES)
+    try:
+        version = conn.execute(
+            f"SELECT COALESCE(MAX(version), 0) FROM data_versions WHERE table_name NOT IN ({placeholders})",
+            APP_TABLES
+        ).fetchone()[0]
+    except sqlite3.OperationalError:
+        version = 0
+    return db_file, version, schema_version
+
+
+def build_catalog(conn) -> dict:
+    """{table: {"columns": {column: declared type}, "indexes": [...], "row_count": n}} in sqlite_master order"""
+    tables = {}
+    for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall():
+        tables[name] = {
+            "columns": {row[1]: (row[2] or '').upper() for row in conn.execute(f'PRAGMA table_info("{name}")')},
+            "indexes": [row[1] for row in conn.execute(f'PRAGMA index_list("{name}")')],
+            "row_count": conn.execute(f'SELECT COUNT(*) FROM "{name}"').fetchone()[0],
+        }
+    return tables
+
+
+def get_catalog(conn) -> dict:
+    """Current catalog for the database behind `conn` (rebuilt only when its key changed)"""
+    key = _catalog_key(conn)
+    if _state["key"] == key:
+        return _state["tables"]
+    with _lock:
+        if _state["key"] != key:
+            _state["tables"] = build_catalog(conn)
+            _state["key"] = key
+        return _state["tables"]
+
+
+def invalidate():
+    with _lock:
+        _state["key"] = None
+
+
+def list_tables(conn) -> list:
+    return list(get_catalog(conn))
+
+
+def table_exists(conn, table_name: str) -> bool:
+    return table_name in get_catalog(conn)
+
+
+def table_columns(conn, table_name: str) -> dict:
+    """{column: declared type} in table order, or {} for a missing table"""
+    info = get_catalog(conn).get(table_name)
+    return dict(info["columns"]) if info else {}
+
+
+def row_count(conn, table_name: str) -> int:
+    info = get_catalog(conn).get(table_name)
+    return info["row_count"] if info else 0
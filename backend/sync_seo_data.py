@@ -14,6 +14,8 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
+from data_version import bump_data_version
+
 def get_db_connection():
     db_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ads_data.sqlite')
     return sqlite3.connect(db_path)
@@ -138,6 +140,8 @@ def sync_seo_data():
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
             ''', (page['url'], page['clicks'], page['impressions'], page['ctr'], page['position'], 
                   meta.get('title', ''), meta.get('description', ''), start_str, end_str))
+        # Re-keys cached / ETagged reads of seo_pages
+        bump_data_version(['seo_pages'], conn, commit=False)
         
         conn.commit()
         conn.close()
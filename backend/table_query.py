@@ -0,0 +1,115 @@
+"""
+SQL building blocks for paged table reads (/api/tables/{table_name}).
+
+Every column name that comes from the request (sort_by, columns, filters) is
+checked against the schema catalog (schema_catalog.py) before it is
+interpolated; values are always bound parameters. Exported metrics are often text ('$1,234.50', '3.2%'), so
+sorting and range filters on such columns use a cleaned numeric expression.
+
+Keyset cursors (pagination.encode_cursor) hold the full ORDER BY key of the
+last row: (pinned, display order, sort value, rowid). The next page starts
+strictly after it, so pinned rows stay first and appended rows cause no drift.
+"""
+import schema_catalog
+
+FILTER_OPS = {'eq': '=', 'ne': '!=', 'gt': '>', 'gte': '>=', 'lt': '<', 'lte': '<=', 'contains': 'LIKE'}
+NUMERIC_TYPES = ('INT', 'REAL', 'FLOA', 'DOUB', 'NUM', 'DEC')
+NUMERIC_SAMPLE_ROWS = 50
+MAX_PAGE_SIZE = 5000
+
+
+def table_columns(conn, table_name: str) -> dict:
+    """{column: declared type} in table order. Raises ValueError for unknown tables."""
+    if not schema_catalog.table_exists(conn, table_name):
+        raise ValueError(f"Unknown table '{table_name}'")
+    return schema_catalog.table_columns(conn, table_name)
+
+
+def numeric_expr(column: str, alias: str = 't') -> str:
+    return f"CAST(REPLACE(REPLACE(REPLACE({alias}.\"{column}\", '$', ''), ',', ''), '%', '') AS REAL)"
+
+
+def value_expr(column: str, declared: str, alias: str = 't') -> str:
+    """Column as a number: as is when declared numeric, cleaned (numeric_expr) otherwise"""
+    if any(t in (declared or '') for t in NUMERIC_TYPES):
+        return f'{alias}."{column}"'
+    return numeric_expr(column, alias)
+
+
+def _looks_numeric(value) -> bool:
+    if isinstance(value, (int, float)):
+        return True
+    try:
+        float(str(value).replace('$', '').replace(',', '').replace('%', ''))
+        return True
+    except ValueError:
+        return False
+
+
+def is_numeric_column(conn, table_name: str, column: str, declared: str) -> bool:
+    """Declared numeric, or a text column whose sampled non-empty values all parse as numbers."""
+    if any(t in declared for t in NUMERIC_TYPES):
+        return True
+    if column == 'date':
+        return False
+    sample = [row[0] for row in conn.execute(
+        f'SELECT "{column}" FROM "{table_name}" WHERE "{column}" IS NOT NULL AND "{column}" != \'\' LIMIT ?',
+        (NUMERIC_SAMPLE_ROWS,))]
+    return bool(sample) and all(_looks_numeric(v) for v in sample)
+
+
+def sort_expression(conn, table_name: str, column: str, columns: dict) -> str:
+    """ORDER BY expression for a column; NULLs are coalesced so keyset comparisons stay total."""
+    if column not in columns:
+        raise ValueError(f"Unknown sort column '{column}'")
+    if is_numeric_column(conn, table_name, column, columns[column]):
+        return f"COALESCE({numeric_expr(column)}, 0)"
+    return f"COALESCE(t.\"{column}\", '')"
+
+
+def escape_like(value: str) -> str:
+    """Escape LIKE wildcards (% and _) so a value matches literally with ESCAPE '\\'"""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def parse_filters(conn, table_name: str, filters: list, columns: dict) -> tuple:
+    """
+    'column:op:value' strings -> (sql conditions, params).
+    op: eq | ne | gt | gte | lt | lte | contains. gt/gte/lt/lte compare
+    numerically on numeric columns.
+    """
+    conditions, params = [], []
+    for f in filters or []:
+        parts = f.split(':', 2)
+        if len(parts) != 3:
+            raise ValueError(f"Invalid filter '{f}', expected column:op:value")
+        column, op, value = parts
+        if column not in columns:
+            raise ValueError(f"Unknown filter column '{column}'")
+        if op not in FILTER_OPS:
+            raise ValueError(f"Unsupported filter op '{op}'. Use one of: {', '.join(FILTER_OPS)}")
+        if op == 'contains':
+            conditions.append(f"t.\"{column}\" LIKE ? ESCAPE '\\'")
+            params.append(f"%{escape_like(value)}%")
+        elif op in ('gt', 'gte', 'lt', 'lte') and is_numeric_column(conn, table_name, column, columns[column]):
+            conditions.append(f"{numeric_expr(column)} {FILTER_OPS[op]} ?")
+            params.append(float(value))
+        else:
+            conditions.append(f"t.\"{column}\" {FILTER_OPS[op]} ?")
+            params.append(value)
+    return conditions, params
+
+
+def keyset_condition(keys: list, values: list) -> tuple:
+    """
+    Rows strictly after `values` in the order of keys [(expr, descending), ...]:
+    (k1 > v1) OR (k1 = v1 AND k2 > v2) OR ... with > / < per key direction.
+    """
+    if not isinstance(values, list) or len(values) != len(keys):
+        raise ValueError("Invalid cursor: key mismatch")
+    clauses, params = [], []
+    for i, (expr, descending) in enumerate(keys):
+        terms = [f"{keys[j][0]} = ?" for j in range(i)] + [f"{expr} {'<' if descending else '>'} ?"]
+        clauses.append("(" + " AND ".join(terms) + ")")
+        params.extend(values[:i + 1])
+    return "(" + " OR ".join(clauses) + ")", params
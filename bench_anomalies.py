@@ -0,0 +1,340 @@
+"""
+Anomaly detection benchmark + golden-output regression check.
+
+Generates deterministic synthetic campaign / product histories at several
+scales, then for each scale:
+- times get_campaign_anomalies_logic, get_product_anomalies_logic and
+  AgentService.get_campaign_anomaly_details on a few target dates
+- records the peak Python/NumPy allocation of each call (tracemalloc, in a
+  separate run so tracing does not distort the timings; worker processes of
+  the sharded mode are not traced) and the process RSS
+- compares every output with bench_golden/<scale>.json
+
+Usage:
+    python bench_anomalies.py                      # small scale
+    python bench_anomalies.py small medium large
+    python bench_anomalies.py medium --update-golden
+    python bench_anomalies.py small --workers=4    # also time the sharded product mode
+
+Generated databases are cached in bench_data/ (git-ignored). Only the small
+golden file is committed; the first run of a larger scale writes its golden
+from the current engine. A golden file is only valid for the generator in
+this script: regenerate the goldens with --update-golden whenever the
+generator changes, never to make a failing engine pass.
+"""
+import os
+import sys
+import json
+import math
+import time
+import sqlite3
+import tracemalloc
+
+try:
+    import resource  # Unix only (max RSS)
+except ImportError:
+    resource = None
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(ROOT, 'backend'))
+
+DATA_DIR = os.path.join(ROOT, 'bench_data')
+GOLDEN_DIR = os.path.join(ROOT, 'bench_golden')
+
+SCALES = {
+    'small': {'campaigns': 50, 'items': 1000, 'days': 90},
+    'medium': {'campaigns': 500, 'items': 20000, 'days': 180},
+    'large': {'campaigns': 5000, 'items': 100000, 'days': 365},
+}
+FIRST_DATE = '2025-01-01'
+SEED = 20250101
+BENCH_DATES = 3          # target dates per scale (spread over the last 30 days)
+DETAIL_CAMPAIGNS = 3     # campaigns timed with get_campaign_anomaly_details
+ITEM_CHUNK = 5000        # product rows are generated / written per item chunk
+
+CAMPAIGN_TYPES = ['Search', 'Performance Max', 'Display']
+SEARCH_TERMS = ['buy shoes', 'running shoes free', 'shoe repair', 'best sneakers', 'how to clean shoes', 'shoes sale']
+MATCH_TYPES = ['Broad match', 'Phrase match', 'Exact match']
+CHANNELS = ['Search', 'Display', 'YouTube', 'Discover']
+
+
+# =============================================================================
+# Synthetic data
+# =============================================================================
+
+def _grid(rng, n_entities: int, days: int, skip: float, max_start: int):
+    """(entity, day) pairs: each entity starts on a random day and skips some days."""
+    start = rng.integers(0, max(1, max_start), n_entities)
+    ent, day = np.divmod(np.arange(n_entities * days), days)
+    keep = (day >= start[ent]) & (rng.random(len(ent)) >= skip)
+    return ent[keep], day[keep], start
+
+
+def _campaign_frame(rng, n: int, days: int, dates) -> pd.DataFrame:
+    ent, day, start = _grid(rng, n, days, 0.05, days // 3)
+    base_roas = rng.uniform(1, 6, n)
+    base_conv = rng.uniform(0, 20, n)
+    # Periodic efficiency dips so every scale has anomalies
+    drift = np.where((day - start[ent]) % 17 > 12, 0.5, 1.0)
+    conv = np.maximum(0.0, rng.normal(base_conv[ent] * drift, 3))
+    cost = rng.uniform(20, 200, len(ent))
+    conv_value = conv * rng.uniform(5, 30, len(ent)) * drift * base_roas[ent] / 3
+    budget = pd.Series(np.where(rng.random(len(ent)) < 0.03, rng.integers(50, 200, len(ent)).astype(float), np.nan))
+    budget = budget.groupby(ent).ffill().fillna(100.0)
+    return pd.DataFrame({
+        'date': dates[day],
+        'campaign': [f"Camp {e:05d}" for e in ent],
+        'campaign_type': np.array(CAMPAIGN_TYPES)[ent % 3],
+        'cost': np.round(cost, 2),
+        'conv_value': np.round(conv_value, 2),
+        'conversions': np.round(conv, 2),
+        'roas': np.round(np.where(cost > 0, conv_value / cost, 0), 4),
+        'cpa': np.round(np.where(conv > 0, cost / np.maximum(conv, 1e-9), 0), 4),
+        'budget': budget.to_numpy(),
+        'clicks': (cost * 3).astype(int),
+        'impr': (cost * 50).astype(int),
+    })
+
+
+def _dimension_frames(rng, camp: pd.DataFrame) -> dict:
+    """search_term / channel / age / gender rows for get_campaign_anomaly_details."""
+    n = len(camp)
+    def rows(labels, col):
+        pick = rng.integers(0, len(labels), n)
+        cost = np.round(camp['cost'].to_numpy() * rng.uniform(0.05, 0.5, n), 2)
+        conv = np.where(rng.random(n) < 0.3, 0.0, np.round(camp['conversions'].to_numpy() * rng.uniform(0, 0.5, n), 2))
+        return pd.DataFrame({'date': camp['date'], 'campaign': camp['campaign'], col: np.array(labels)[pick],
+                             'cost': cost, 'conversions': conv})
+    search_term = rows(SEARCH_TERMS, 'search_term')
+    search_term['match_type'] = np.array(MATCH_TYPES)[rng.integers(0, len(MATCH_TYPES), n)]
+    search_term['interactions'] = rng.integers(0, 40, n)
+    channel = rows(CHANNELS, 'channels').rename(columns={'campaign': 'campaigns'})
+    channel['results_value'] = np.round(channel['cost'] * rng.uniform(0, 5, n), 2)
+    return {
+        'search_term': search_term,
+        'channel': channel,
+        'age': rows(['18-24', '25-34', '35-44', '45-54', '55-64', '65+'], 'age'),
+        'gender': rows(['Male', 'Female', 'Unknown'], 'gender'),
+    }
+
+
+def _product_frame(rng, first_item: int, n: int, days: int, dates) -> pd.DataFrame:
+    ent, day, start = _grid(rng, n, days, 0.1, days // 2)
+    ctr0 = rng.uniform(0.5, 5, n)
+    cpc0 = rng.uniform(0.1, 2, n)
+    drift = np.where((day - start[ent]) % 13 > 9, 0.6, 1.0)
+    ctr = np.maximum(0, rng.normal(ctr0[ent] * drift, 0.3))
+    cpc = np.maximum(0, rng.normal(cpc0[ent] / drift, 0.1))
+    clicks = (rng.integers(0, 30, len(ent)) * drift).astype(int)
+    items = ent + first_item
+    # Raw export formatting ('$' / '%' strings) so the loaders' cleaning is exercised
+    return pd.DataFrame({
+        'date': dates[day],
+        'title': [f"Product {i}" for i in items],
+        'item_id': (1000 + items).astype(str),
+        'clicks': clicks,
+        'impr': (clicks / np.maximum(ctr, 0.1) * 100).astype(int),
+        'ctr': pd.Series(ctr).map('{:.2f}%'.format).to_numpy(),
+        'avg_cpc': pd.Series(cpc).map('${:.2f}'.format).to_numpy(),
+        'cost': pd.Series(clicks * cpc).map('{:.2f}'.format).to_numpy(),
+    })
+
+
+def generate(scale: str) -> str:
+    """Create (or reuse) the synthetic DB for a scale and return its path."""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    path = os.path.join(DATA_DIR, f"{scale}_{SEED}.sqlite")
+    if os.path.exists(path):
+        return path
+
+    cfg = SCALES[scale]
+    rng = np.random.default_rng(SEED)
+    dates = np.array(pd.date_range(FIRST_DATE, periods=cfg['days']).strftime('%Y-%m-%d'))
+    tmp = path + '.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    conn = sqlite3.connect(tmp)
+    try:
+        camp = _campaign_frame(rng, cfg['campaigns'], cfg['days'], dates)
+        camp.to_sql('campaign', conn, index=False)
+        for table, frame in _dimension_frames(rng, camp).items():
+            frame.to_sql(table, conn, index=False)
+        for first in range(0, cfg['items'], ITEM_CHUNK):
+            n = min(ITEM_CHUNK, cfg['items'] - first)
+            _product_frame(rng, first, n, cfg['days'], dates).to_sql('product', conn, index=False, if_exists='append')
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp, path)
+    return path
+
+
+# =============================================================================
+# Benchmark
+# =============================================================================
+
+def _use_db(path: str):
+    # Every backend module (agent_service, expert_system, data_version, anomaly_*) connects via ads_db
+    import ads_db
+    ads_db.DB_FILE = path
+
+
+def _timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def _peak_mb(fn, *args, **kwargs) -> float:
+    tracemalloc.start()
+    try:
+        fn(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    finally:
+        tracemalloc.stop()
+
+
+def _target_dates(path: str) -> list:
+    conn = sqlite3.connect(path)
+    try:
+        last = pd.Timestamp(conn.execute("SELECT MAX(date) FROM campaign").fetchone()[0])
+    finally:
+        conn.close()
+    offsets = np.linspace(29, 0, BENCH_DATES).astype(int)
+    return [(last - pd.Timedelta(days=int(o))).strftime('%Y-%m-%d') for o in offsets]
+
+
+def run_scale(scale: str, workers: int = 1) -> tuple:
+    """Returns (timings, outputs) for one scale."""
+    import agent_service
+    from agent_service import AgentService, get_campaign_anomalies_logic, get_product_anomalies_logic
+
+    t0 = time.perf_counter()
+    path = generate(scale)
+    print(f"[{scale}] data ready in {time.perf_counter() - t0:.1f}s: {path}")
+    _use_db(path)
+    dates = _target_dates(path)
+    service = AgentService()
+
+    calls = {
+        'campaign_anomalies': lambda d: get_campaign_anomalies_logic(d),
+        'product_anomalies': lambda d: get_product_anomalies_logic(d, workers=1),
+    }
+    if workers > 1:
+        calls[f'product_anomalies_x{workers}'] = lambda d: get_product_anomalies_logic(d, workers=workers)
+
+    timings, outputs = {}, {'campaign_anomalies': {}, 'product_anomalies': {}, 'campaign_anomaly_details': {}}
+    for name, call in calls.items():
+        seconds = []
+        for d in dates:
+            result, elapsed = _timed(call, d)
+            seconds.append(elapsed)
+            outputs.setdefault(name, {})[d] = result
+        timings[name] = {'seconds': seconds, 'peak_mb': _peak_mb(call, dates[-1])}
+
+    # Details for the top flagged campaigns of the last date (or the first campaigns)
+    flagged = [a['campaign'] for a in outputs['campaign_anomalies'][dates[-1]]]
+    conn = sqlite3.connect(path)
+    try:
+        names = [r[0] for r in conn.execute("SELECT DISTINCT campaign FROM campaign ORDER BY campaign")]
+    finally:
+        conn.close()
+    detail_campaigns = list(dict.fromkeys(flagged + names))[:DETAIL_CAMPAIGNS]
+    start_date = (pd.Timestamp(dates[-1]) - pd.Timedelta(days=29)).strftime('%Y-%m-%d')
+    seconds = []
+    for campaign in detail_campaigns:
+        result, elapsed = _timed(service.get_campaign_anomaly_details, campaign, start_date, dates[-1])
+        seconds.append(elapsed)
+        outputs['campaign_anomaly_details'][campaign] = result
+    timings['campaign_anomaly_details'] = {
+        'seconds': seconds,
+        'peak_mb': _peak_mb(service.get_campaign_anomaly_details, detail_campaigns[0], start_date, dates[-1]),
+    }
+
+    # The sharded mode is checked against the serial result, not stored in the golden file
+    for name in list(outputs):
+        if name.startswith('product_anomalies_x'):
+            diff = _diff(outputs['product_anomalies'], outputs.pop(name), name)
+            if diff:
+                print(f"[{scale}] MISMATCH {diff}")
+                timings[name]['mismatch'] = diff
+    return timings, outputs
+
+
+# =============================================================================
+# Golden files
+# =============================================================================
+
+def _diff(expected, actual, path: str = '$'):
+    """First difference between two JSON-like values (floats compared with rel 1e-9), or None."""
+    if isinstance(expected, float) or isinstance(actual, float):
+        if isinstance(expected, (int, float)) and isinstance(actual, (int, float)) and \
+                math.isclose(expected, actual, rel_tol=1e-9, abs_tol=1e-12):
+            return None
+        return f"{path}: expected {expected!r}, got {actual!r}"
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        if set(expected) != set(actual):
+            return f"{path}: keys differ {sorted(set(expected) ^ set(actual), key=str)}"
+        for k in expected:
+            d = _diff(expected[k], actual[k], f"{path}.{k}")
+            if d:
+                return d
+        return None
+    if isinstance(expected, list) and isinstance(actual, list):
+        if len(expected) != len(actual):
+            return f"{path}: length {len(expected)} != {len(actual)}"
+        for i, (e, a) in enumerate(zip(expected, actual)):
+            d = _diff(e, a, f"{path}[{i}]")
+            if d:
+                return d
+        return None
+    return None if expected == actual else f"{path}: expected {expected!r}, got {actual!r}"
+
+
+def check_golden(scale: str, outputs: dict, update: bool) -> bool:
+    path = os.path.join(GOLDEN_DIR, f"{scale}.json")
+    # Normalise through JSON so tuples / numpy scalars compare like the stored file
+    outputs = json.loads(json.dumps(outputs, ensure_ascii=False, default=str))
+    if update or not os.path.exists(path):
+        os.makedirs(GOLDEN_DIR, exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'seed': SEED, 'scale': SCALES[scale], 'outputs': outputs}, f, ensure_ascii=False, indent=1, sort_keys=True)
+        print(f"[{scale}] golden written: {path}")
+        return True
+    with open(path, encoding='utf-8') as f:
+        golden = json.load(f)
+    if golden.get('seed') != SEED or golden.get('scale') != SCALES[scale]:
+        print(f"[{scale}] golden was generated with different settings, rerun with --update-golden")
+        return False
+    diff = _diff(golden['outputs'], outputs)
+    print(f"[{scale}] golden {'OK' if diff is None else 'MISMATCH ' + diff}")
+    return diff is None
+
+
+def report(scale: str, timings: dict):
+    print(f"[{scale}] {'function':<28} {'mean s':>8} {'max s':>8} {'peak MB':>8}")
+    for name, t in timings.items():
+        s = t['seconds']
+        print(f"[{scale}] {name:<28} {sum(s) / len(s):>8.3f} {max(s):>8.3f} {t['peak_mb']:>8.1f}")
+    if resource:
+        print(f"[{scale}] process max RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+
+
+if __name__ == "__main__":
+    scales = [a for a in sys.argv[1:] if not a.startswith('--')] or ['small']
+    update = '--update-golden' in sys.argv
+    workers = next((int(a.split('=', 1)[1]) for a in sys.argv[1:] if a.startswith('--workers=')), 1)
+    unknown = [s for s in scales if s not in SCALES]
+    if unknown:
+        sys.exit(f"Unknown scale(s) {unknown}, expected one of {list(SCALES)}")
+
+    ok = True
+    for scale in scales:
+        timings, outputs = run_scale(scale, workers)
+        report(scale, timings)
+        ok = check_golden(scale, outputs, update) and ok
+        ok = ok and not any('mismatch' in t for t in timings.values())
+    sys.exit(0 if ok else 1)
@@ -5,6 +5,10 @@ import glob
 import re
 import sys
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+from data_events import publish_event
+from change_log import replace_table
+
 # Force utf-8 output to avoid console crashes
 try:
     sys.stdout.reconfigure(encoding='utf-8')
@@ -60,6 +64,7 @@ def parse_date(filename):
 
 def import_data():
     conn = sqlite3.connect(DB_PATH)
+    imported_rows = {}
     
     folders = [f for f in os.listdir(BASE_DIR) if os.path.isdir(os.path.join(BASE_DIR, f))]
     
@@ -209,8 +214,12 @@ def import_data():
         # Actually since we start fresh, 'replace' is fine for the whole batch concat.
         
         try:
-            final_df.to_sql(table_name, conn, if_exists='replace', index=False)
-            conn.commit()
+            # Swap in the new rows, bump the table's data version (invalidating caches /
+            # precomputed anomaly results) and log the diff for delta sync, in one transaction
+            replaced = replace_table(conn, table_name, final_df)
+            imported_rows[table_name] = len(final_df)
+            if replaced['changes'] is not None:
+                safe_print(f"     Δ {', '.join(f'{len(v)} {k}' for k, v in replaced['changes'].items())} keys")
             safe_print(f"  ✅ Imported {len(final_df)} rows into {table_name}")
             
             # Verify columns
@@ -222,6 +231,13 @@ def import_data():
         except Exception as e:
              safe_print(f"  ❌ Failed to save table {table_name}: {e}")
 
+    if imported_rows:
+        # Tell connected clients (/api/events) which tables to refetch
+        try:
+            publish_event('import', list(imported_rows), {"rows": imported_rows}, conn, bump=False)
+        except Exception as e:
+            safe_print(f"  ⚠️ Failed to publish import event: {e}")
+
     conn.close()
     safe_print("\n🎉 Import Data Complete!")
 